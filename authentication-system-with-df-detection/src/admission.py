@@ -0,0 +1,261 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+from src.metrics import metrics
+
+ADMISSION_ADMITTED = metrics.counter("audioshield_admission_admitted_total", "Requests given a slot in a model lane", ("lane",))
+ADMISSION_REJECTED = metrics.counter(
+    "audioshield_admission_rejected_total", "Requests shed by admission control", ("lane", "reason")
+)
+ADMISSION_QUEUED = metrics.gauge("audioshield_admission_queued", "Requests waiting for a slot in each model lane", ("lane",))
+ADMISSION_ACTIVE = metrics.gauge("audioshield_admission_active", "Requests holding a slot in each model lane", ("lane",))
+ADMISSION_WAIT_SECONDS = metrics.histogram(
+    "audioshield_admission_wait_seconds", "Time an admitted request queued for its lane slot", ("lane",)
+)
+
+# Lower value is served first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Priority of whatever request or task is running; set once per request by AdmissionController.admit,
+# and inherited by the tasks it spawns
+REQUEST_PRIORITY = contextvars.ContextVar("request_priority", default=PRIORITY_NORMAL)
+
+
+class Overloaded(Exception):
+    # reason: "queue_full", "deadline" (would wait, or has waited, longer than the lane allows)
+    # or "shed" (pushed out of a full queue by a higher priority request)
+    def __init__(self, lane, reason, retry_after):
+        self.lane = lane
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"Server busy ({lane}: {reason.replace('_', ' ')}), retry in {retry_after}s")
+
+
+@dataclass
+class LaneConfig:
+    # Requests running the lane's model at once
+    concurrency: int = 1
+    # Requests allowed to wait for a slot, beyond that they are turned away immediately
+    queue_size: int = 16
+    # Seconds a request may wait for a slot before it is dropped
+    max_wait: float = 10.0
+    # Slots PRIORITY_LOW requests may hold at once, the rest stay free for interactive requests
+    # (None = a quarter of concurrency, at least one)
+    low_priority_limit: int = None
+
+    def __post_init__(self):
+        if self.low_priority_limit is None:
+            self.low_priority_limit = max(1, self.concurrency // 4)
+
+
+def lane_config_from_env(name, concurrency, queue_size, max_wait):
+    # e.g. ADMIT_WHISPER_CONCURRENCY=2, ADMIT_WHISPER_QUEUE=8, ADMIT_WHISPER_MAX_WAIT=15, ADMIT_WHISPER_LOW_LIMIT=1
+    prefix = f"ADMIT_{name.upper()}_"
+    low_priority_limit = os.environ.get(prefix + "LOW_LIMIT")
+    return LaneConfig(
+        concurrency=max(1, int(os.environ.get(prefix + "CONCURRENCY", concurrency))),
+        queue_size=max(0, int(os.environ.get(prefix + "QUEUE", queue_size))),
+        max_wait=float(os.environ.get(prefix + "MAX_WAIT", max_wait)),
+        low_priority_limit=max(1, int(low_priority_limit)) if low_priority_limit else None,
+    )
+
+
+class _Lane:
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.active = 0
+        self.low_active = 0
+        # Heap of [priority, arrival, deadline, future]
+        self.waiters = []
+        # Moving average of the time a request holds a slot, for wait estimates and Retry-After
+        self.service_seconds = None
+        self.admitted = 0
+        self.rejected = {}
+
+
+class AdmissionController:
+    # Bounded, priority ordered admission per model lane (Whisper, deepfake, speaker). Each lane runs
+    # at most `concurrency` requests; the rest wait in a queue of at most `queue_size`, served by
+    # priority then arrival. A request is turned away with Overloaded instead of queueing when the
+    # queue is full or its estimated wait is already past the lane's max_wait, and dropped if it
+    # waits longer than that. When the queue is full a higher priority request takes the place of
+    # the lowest priority waiter. PRIORITY_LOW requests are also turned away at arrival while a higher
+    # priority request is queueing in any lane, since they compete for the same CPUs even when they
+    # use a different model.
+    # Lanes are asyncio based and bound to the serving event loop.
+
+    def __init__(self, lanes, enabled=True):
+        self.lanes = {name: _Lane(name, config) for name, config in lanes.items()}
+        self.enabled = enabled
+        self._arrivals = itertools.count()
+
+    def _can_run(self, lane, priority):
+        if lane.active >= lane.config.concurrency:
+            return False
+        return priority < PRIORITY_LOW or lane.low_active < lane.config.low_priority_limit
+
+    def _estimated_wait(self, lane, priority):
+        # Queue ahead of this priority times the average slot hold; 0 until a hold has been measured
+        ahead = sum(1 for waiter in lane.waiters if waiter[0] <= priority)
+        if lane.service_seconds is None or (lane.active < lane.config.concurrency and ahead == 0):
+            return 0.0
+        return (ahead + 1) * lane.service_seconds / lane.config.concurrency
+
+    def _retry_after(self, lane):
+        # Time for the current queue to drain, at least a second
+        service = lane.service_seconds if lane.service_seconds is not None else 1.0
+        backlog = (len(lane.waiters) + lane.active) * service / lane.config.concurrency
+        return max(1, min(60, math.ceil(backlog)))
+
+    def _reject(self, lane, reason):
+        lane.rejected[reason] = lane.rejected.get(reason, 0) + 1
+        ADMISSION_REJECTED.inc(lane.name, reason)
+        return Overloaded(lane.name, reason, self._retry_after(lane))
+
+    def _displaceable(self, lane, priority):
+        # Lowest priority, latest arrival waiter if it ranks below priority
+        if not lane.waiters:
+            return None
+        worst = max(lane.waiters, key=lambda waiter: (waiter[0], waiter[1]))
+        return worst if worst[0] > priority else None
+
+    def _remove(self, lane, waiter):
+        lane.waiters.remove(waiter)
+        heapq.heapify(lane.waiters)
+        ADMISSION_QUEUED.dec(lane.name)
+
+    def admit(self, lanes, priority=PRIORITY_NORMAL):
+        # Called when a request arrives, before its upload is read or decoded: sets the request's
+        # priority and fails fast with Overloaded if any lane it needs would not take it
+        REQUEST_PRIORITY.set(priority)
+        if not self.enabled:
+            return
+        if priority >= PRIORITY_LOW:
+            for lane in self.lanes.values():
+                if any(waiter[0] < priority for waiter in lane.waiters):
+                    raise self._reject(lane, "shed")
+        for name in lanes:
+            lane = self.lanes[name]
+            if len(lane.waiters) >= lane.config.queue_size and self._displaceable(lane, priority) is None:
+                raise self._reject(lane, "queue_full")
+            if self._estimated_wait(lane, priority) > lane.config.max_wait:
+                raise self._reject(lane, "deadline")
+
+    @asynccontextmanager
+    async def slot(self, name, priority=None):
+        # Holds one of the lane's slots for the duration of the block
+        if not self.enabled:
+            yield
+            return
+        lane = self.lanes[name]
+        priority = REQUEST_PRIORITY.get() if priority is None else priority
+        queued = time.perf_counter()
+
+        low = priority >= PRIORITY_LOW
+        if self._can_run(lane, priority) and not any(waiter[0] <= priority for waiter in lane.waiters):
+            lane.active += 1
+            lane.low_active += low
+        else:
+            await self._wait(lane, priority, queued)
+
+        started = time.perf_counter()
+        lane.admitted += 1
+        ADMISSION_ADMITTED.inc(name)
+        ADMISSION_ACTIVE.inc(name)
+        ADMISSION_WAIT_SECONDS.observe(started - queued, name)
+        try:
+            yield
+        finally:
+            held = time.perf_counter() - started
+            lane.service_seconds = held if lane.service_seconds is None else 0.8 * lane.service_seconds + 0.2 * held
+            ADMISSION_ACTIVE.dec(name)
+            self._release(lane, low)
+
+    async def _wait(self, lane, priority, queued):
+        if self._estimated_wait(lane, priority) > lane.config.max_wait:
+            raise self._reject(lane, "deadline")
+        if len(lane.waiters) >= lane.config.queue_size:
+            worst = self._displaceable(lane, priority)
+            if worst is None:
+                raise self._reject(lane, "queue_full")
+            self._remove(lane, worst)
+            worst[3].set_exception(self._reject(lane, "shed"))
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = [priority, next(self._arrivals), queued + lane.config.max_wait, future]
+        heapq.heappush(lane.waiters, waiter)
+        ADMISSION_QUEUED.inc(lane.name)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=lane.config.max_wait)
+        except asyncio.TimeoutError:
+            if not future.done():
+                self._remove(lane, waiter)
+                future.cancel()
+                raise self._reject(lane, "deadline")
+        except asyncio.CancelledError:
+            # Client went away: give back a slot granted in the meantime, or leave the queue
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self._release(lane, priority >= PRIORITY_LOW)
+            elif waiter in lane.waiters:
+                self._remove(lane, waiter)
+                future.cancel()
+            raise
+        # Granted, unless it was shed from the queue
+        future.result()
+
+    def _release(self, lane, low):
+        # Hand the freed slot to the best waiter that is still within its deadline
+        lane.active -= 1
+        lane.low_active -= low
+        now = time.perf_counter()
+        while lane.waiters and lane.active < lane.config.concurrency:
+            waiter = lane.waiters[0]
+            future = waiter[3]
+            if not future.done() and waiter[2] >= now and not self._can_run(lane, waiter[0]):
+                # Only PRIORITY_LOW waiters are left and they are at their limit
+                break
+            heapq.heappop(lane.waiters)
+            ADMISSION_QUEUED.dec(lane.name)
+            if future.done():
+                continue
+            if waiter[2] < now:
+                future.set_exception(self._reject(lane, "deadline"))
+                continue
+            lane.active += 1
+            lane.low_active += waiter[0] >= PRIORITY_LOW
+            future.set_result(True)
+
+    def stats(self):
+        return {
+            name: {
+                "concurrency": lane.config.concurrency,
+                "queue_size": lane.config.queue_size,
+                "max_wait": lane.config.max_wait,
+                "low_priority_limit": lane.config.low_priority_limit,
+                "active": lane.active,
+                "low_priority_active": lane.low_active,
+                "queued": len(lane.waiters),
+                "service_seconds": round(lane.service_seconds, 4) if lane.service_seconds is not None else None,
+                "admitted": lane.admitted,
+                "rejected": dict(lane.rejected),
+            }
+            for name, lane in self.lanes.items()
+        }
+
+
+async def with_priority(priority, coro):
+    # Run coro at another priority, e.g. speculative work that should give way to real requests.
+    # Only for a fresh task (asyncio.create_task(with_priority(...))), the priority sticks to the context
+    REQUEST_PRIORITY.set(priority)
+    return await coro
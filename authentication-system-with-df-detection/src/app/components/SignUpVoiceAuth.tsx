@@ -3,8 +3,9 @@
 SignUpVoiceAuth.tsx
 
 A model interface that guides users through a 3-step voice registration process.
-Users record 3 audio samples, each of which is sent to the backend to extract embeddings.
-Once all samples are recorded, the average embedding is returned via `onComplete`.
+Users record 3 audio samples. Once all samples are recorded they are sent to the backend together,
+which embeds them in one batch and returns the averaged, normalised template via `onComplete`,
+together with the speaker backend and sample rate it was made with (stored alongside the template).
 This is used during sign-up or profile setup to register the user's voice identity.
 
 */
@@ -14,16 +15,22 @@ This is used during sign-up or profile setup to register the user's voice identi
 import { useEffect, useRef, useState } from "react";
 import { FaMicrophone, FaRedo } from "react-icons/fa";
 import RecordingCountdown from "@/app/components/RecordingCountdown";
-import { averageVectors } from "@/utils/voiceAverage";
+
+export interface VoiceTemplate {
+  embedding: number[];
+  backend: string;
+  sampleRate: number;
+}
 
 interface VoiceModelProps {
   onClose: () => void;
-  onComplete: (avgEmbedding: number[]) => void;
+  onComplete: (template: VoiceTemplate) => void;
 }
 
 export default function VoiceModel({ onClose, onComplete }: VoiceModelProps) {
   const [step, setStep] = useState(1); // tracks current recording step (1 to 3)
-  const [embeddings, setEmbeddings] = useState<number[][]>([]); // stores embeddings for each sample
+  const [samples, setSamples] = useState<Blob[]>([]); // recorded audio for each sample
+  const [enrolling, setEnrolling] = useState(false); // waiting on the backend to build the template
   const [recording, setRecording] = useState(false); // recording state toggle
   const [audioURL, setAudioURL] = useState<string | null>(null); // preview audio blob URL
   const [error, setError] = useState<string | null>(null); // display error messages
@@ -45,12 +52,12 @@ export default function VoiceModel({ onClose, onComplete }: VoiceModelProps) {
     return () => window.removeEventListener("keydown", handler);
   }, [onClose]);
 
-  // Helper to send audio blob to backend and get back the voice embedding
-  const extractEmbedding = async (blob: Blob): Promise<number[]> => {
+  // Helper to send every recorded sample to the backend and get back the enrollment template
+  const enrollSamples = async (blobs: Blob[]): Promise<VoiceTemplate> => {
     const form = new FormData();
-    form.append("file", blob, "sample.webm");
+    blobs.forEach((blob, i) => form.append("files", blob, `sample${i + 1}.webm`));
 
-    const res = await fetch("http://localhost:8000/extract-embedding/", {
+    const res = await fetch("http://localhost:8000/enroll-embedding/", {
       method: "POST",
       body: form,
     });
@@ -61,7 +68,11 @@ export default function VoiceModel({ onClose, onComplete }: VoiceModelProps) {
       throw new Error("Embedding extraction failed");
     }
 
-    return data.embedding;
+    return {
+      embedding: data.embedding,
+      backend: data.backend,
+      sampleRate: data.sample_rate,
+    };
   };
 
   // Start recording audio sample from the microphone
@@ -80,20 +91,14 @@ export default function VoiceModel({ onClose, onComplete }: VoiceModelProps) {
         if (e.data.size > 0) audioChunks.current.push(e.data);
       };
 
-      // when recording stops, process audio and send to backend
-      recorder.onstop = async () => {
+      // when recording stops, keep the audio for this step (a re-record replaces it)
+      recorder.onstop = () => {
         stream.getTracks().forEach((t) => t.stop()); // stop all mic input
         setRecording(false);
 
         const blob = new Blob(audioChunks.current, { type: "audio/webm" });
         setAudioURL(URL.createObjectURL(blob)); // set preview audio
-
-        try {
-          const vec = await extractEmbedding(blob); // send to backend
-          setEmbeddings((prev) => [...prev, vec]); // add to embedding list
-        } catch {
-          setError("Failed to extract embedding. Please retry this sample.");
-        }
+        setSamples((prev) => [...prev.slice(0, step - 1), blob]);
       };
 
       recorder.start();
@@ -117,10 +122,10 @@ export default function VoiceModel({ onClose, onComplete }: VoiceModelProps) {
   };
 
   // Progress to next sample or finish if all 3 are done
-  const handleNext = () => {
+  const handleNext = async () => {
     // Check if current sample was actually recorded
-    if (!audioURL || embeddings.length < step) {
-      setError("Please record and wait for embedding.");
+    if (!audioURL || samples.length < step) {
+      setError("Please record this sample first.");
       return;
     }
 
@@ -129,9 +134,15 @@ export default function VoiceModel({ onClose, onComplete }: VoiceModelProps) {
       setAudioURL(null); // clear audio for next round
       setError(null);
     } else {
-      // Final step: average embeddings and return to parent
-      const avg = averageVectors(embeddings);
-      onComplete(avg);
+      // Final step: embed all samples in one request and return the template to parent
+      setEnrolling(true);
+      try {
+        onComplete(await enrollSamples(samples));
+      } catch {
+        setError("Failed to extract embedding. Please re-record and try again.");
+      } finally {
+        setEnrolling(false);
+      }
     }
   };
 
@@ -178,8 +189,8 @@ export default function VoiceModel({ onClose, onComplete }: VoiceModelProps) {
                 <FaRedo /> Re‑record Sample
               </button>
 
-              <button onClick={handleNext} className="btn-primary">
-                {step < 3 ? "Next Sample" : "Finish Registration"}
+              <button onClick={handleNext} className="btn-primary" disabled={enrolling}>
+                {step < 3 ? "Next Sample" : enrolling ? "Processing…" : "Finish Registration"}
               </button>
             </div>
           </>
@@ -65,6 +65,8 @@ export default function SettingsPage() {
       //Re-authenticate the user with their current credentials
       const cred = EmailAuthProvider.credential(user.email, password);
       await reauthenticateWithCredential(user, cred);
+      //Token taken now, the voice server still needs it once the account is gone
+      const idToken = await user.getIdToken();
 
       const uid = user.uid;
       const tasks: Promise<any>[] = [];
@@ -85,6 +87,17 @@ export default function SettingsPage() {
 
       //Wait for all deletions to finish before removing the user
       await Promise.all(tasks);
+
+      //Drop the cached copy of the embedding on the voice server; the cache expires on its own,
+      //so an unreachable server must not stop the account deletion
+      const invalidateForm = new FormData();
+      invalidateForm.append("uid", uid);
+      fetch("http://localhost:8000/invalidate-embedding/", {
+        method: "POST",
+        headers: { Authorization: `Bearer ${idToken}` },
+        body: invalidateForm,
+      }).catch((err) => console.warn("Could not invalidate the cached embedding:", err));
+
       await deleteUser(user); // remove from Firebase Auth
       await signOut(auth);
       router.replace("/");
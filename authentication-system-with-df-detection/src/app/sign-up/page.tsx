@@ -17,7 +17,7 @@ import { createUserWithEmailAndPassword } from "firebase/auth";
 import { auth, db } from "@/firebase";
 import { doc, setDoc, serverTimestamp } from "firebase/firestore";
 import Link from "next/link";
-import VoiceModel from "@/app/components/SignUpVoiceAuth";
+import VoiceModel, { VoiceTemplate } from "@/app/components/SignUpVoiceAuth";
 import PasswordInput from "@/app/components/PasswordInput";
 import EmailInput from "@/app/components/InputEmail";
 import OTPInput from "@/app/components/OTPInput";
@@ -34,7 +34,7 @@ export default function SignUpPage() {
   // Voice modal state
   const [showVoiceModal, setShowVoiceModal] = useState(false);
   const [voiceRegistered, setVoiceRegistered] = useState(false);
-  const [avgEmbedding, setAvgEmbedding] = useState<number[] | null>(null); // final voice vector
+  const [voiceTemplate, setVoiceTemplate] = useState<VoiceTemplate | null>(null); // final voice vector
 
   // OTP state
   const [otpSent, setOtpSent] = useState(false);
@@ -51,10 +51,10 @@ export default function SignUpPage() {
     email.trim() !== "" &&
     password !== "" &&
     confirmPassword !== "" &&
-    avgEmbedding !== null;
+    voiceTemplate !== null;
 
-  const handleVoiceComplete = (avgEmb: number[]) => {
-    setAvgEmbedding(avgEmb);
+  const handleVoiceComplete = (template: VoiceTemplate) => {
+    setVoiceTemplate(template);
     setVoiceRegistered(true);
     setShowVoiceModal(false);
   };
@@ -68,7 +68,7 @@ export default function SignUpPage() {
       return;
     }
 
-    if (!avgEmbedding) {
+    if (!voiceTemplate) {
       setError("Please record your voice.");
       return;
     }
@@ -78,8 +78,11 @@ export default function SignUpPage() {
       const uid = cred.user.uid;
       setUserUID(uid);
 
+      // The voice server compares the template with embeddings made by the same backend at the same rate
       await setDoc(doc(db, "voiceEmbeddings", uid), {
-        embedding: avgEmbedding,
+        embedding: voiceTemplate.embedding,
+        backend: voiceTemplate.backend,
+        sampleRate: voiceTemplate.sampleRate,
         createdAt: serverTimestamp(),
       });
 
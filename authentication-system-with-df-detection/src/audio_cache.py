@@ -0,0 +1,110 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+def content_key(data: bytes) -> str:
+    # Identical uploads (retries, or the same clip sent to several endpoints) get the same key
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return 8 * len(value)
+    return 0
+
+
+def _freeze(value):
+    # Cached values are shared between requests, so don't let anyone modify them in place
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        value.flags.writeable = False
+    elif isinstance(value, list):
+        value = tuple(value)
+    return value
+
+
+class AudioArtifactCache:
+    # Content-addressed cache of the work done on an uploaded recording: the decoded waveform,
+    # the deepfake feature tensors and the speaker embedding.
+    # Entries are keyed by (kind, hash of the uploaded bytes, preprocessing parameters), and the
+    # least recently used ones are evicted once max_entries or max_bytes is exceeded.
+
+    def __init__(self, max_entries=512, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max(1, int(max_entries))
+        self.max_bytes = max(1, int(max_bytes))
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = {}
+        self.misses = {}
+        self.evictions = 0
+
+    def get(self, kind, key, params=()):
+        with self._lock:
+            entry = self._entries.get((kind, key, params))
+            if entry is None:
+                self.misses[kind] = self.misses.get(kind, 0) + 1
+                return None
+            self._entries.move_to_end((kind, key, params))
+            self.hits[kind] = self.hits.get(kind, 0) + 1
+            return entry[0]
+
+    def peek(self, kind, key, params=()):
+        # Lookup without touching the LRU order or the hit/miss counters
+        with self._lock:
+            entry = self._entries.get((kind, key, params))
+            return None if entry is None else entry[0]
+
+    def put(self, kind, key, params, value):
+        value = _freeze(value)
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return value
+
+        with self._lock:
+            old = self._entries.pop((kind, key, params), None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[(kind, key, params)] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            kinds = {}
+            for kind in sorted(set(self.hits) | set(self.misses)):
+                hits, misses = self.hits.get(kind, 0), self.misses.get(kind, 0)
+                kinds[kind] = {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
+
+            hits, misses = sum(self.hits.values()), sum(self.misses.values())
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+                "evictions": self.evictions,
+                "kinds": kinds,
+            }
@@ -0,0 +1,154 @@
+import os
+import subprocess
+import threading
+
+import librosa
+import numpy as np
+
+from src.metrics import timed
+
+# ffmpeg binary used for decoding, same one pydub would pick up
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+
+
+class AudioDecodeError(RuntimeError):
+    pass
+
+
+def _ffmpeg_command(sr, max_duration=None, input_format=None, streaming=False):
+    cmd = [FFMPEG_BINARY, "-nostdin", "-hide_banner", "-loglevel", "error"]
+    if streaming:
+        # Start decoding once a small header has arrived instead of probing megabytes of input,
+        # and push every decoded packet straight to stdout
+        cmd += ["-probesize", "32768"]
+    if input_format:
+        cmd += ["-f", input_format]
+    cmd += ["-i", "pipe:0"]
+    if max_duration is not None:
+        cmd += ["-t", f"{max_duration:.3f}"]
+    cmd += ["-vn", "-ac", "1", "-ar", str(sr), "-f", "f32le", "-acodec", "pcm_f32le"]
+    if streaming:
+        cmd += ["-flush_packets", "1"]
+    return cmd + ["pipe:1"]
+
+
+@timed("decode")
+def decode_audio_bytes(data: bytes, sr: int = 22050, max_duration: float = None, input_format: str = None) -> np.ndarray:
+    # Decode an uploaded recording (WebM/Opus, WAV, ...) entirely in memory.
+    # Bytes go to ffmpeg over stdin and come back on stdout as mono float32 PCM at the requested
+    # sample rate, so no temp files are written. With max_duration ffmpeg stops decoding once it
+    # has produced that many seconds.
+    cmd = _ffmpeg_command(sr, max_duration, input_format)
+
+    try:
+        proc = subprocess.run(cmd, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    except FileNotFoundError:
+        raise AudioDecodeError(f"ffmpeg not found ({FFMPEG_BINARY}), install it or set FFMPEG_BINARY")
+
+    if proc.returncode != 0:
+        raise AudioDecodeError(f"ffmpeg failed to decode audio: {proc.stderr.decode(errors='ignore').strip()}")
+
+    y = np.frombuffer(proc.stdout, dtype=np.float32)
+    if y.size == 0:
+        raise AudioDecodeError("Decoded audio is empty.")
+
+    # frombuffer gives a read-only view, librosa/torch need a writable array
+    return y.copy()
+
+
+def resample_audio(y: np.ndarray, orig_sr: int, target_sr: int) -> np.ndarray:
+    # In-memory resample so one decode can feed consumers at different sample rates
+    if orig_sr == target_sr:
+        return y
+    return librosa.resample(y, orig_sr=orig_sr, target_sr=target_sr)
+
+
+class StreamingDecoder:
+    # Decodes a recording while it is still being uploaded (e.g. MediaRecorder WebM chunks over a
+    # WebSocket). One ffmpeg process lives for the whole stream: chunks are written to its stdin
+    # as they arrive and a reader thread collects the float32 PCM it emits.
+
+    def __init__(self, sr: int = 22050, max_duration: float = None, input_format: str = None):
+        self.sr = sr
+        try:
+            self._proc = subprocess.Popen(
+                _ffmpeg_command(sr, max_duration, input_format, streaming=True),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+        except FileNotFoundError:
+            raise AudioDecodeError(f"ffmpeg not found ({FFMPEG_BINARY}), install it or set FFMPEG_BINARY")
+
+        self._lock = threading.Lock()
+        self._chunks = []
+        self._samples = 0
+        self._stderr = b""
+        self._stdin_open = True
+
+        self._reader = threading.Thread(target=self._read_stdout, daemon=True)
+        self._reader.start()
+        self._err_reader = threading.Thread(target=self._read_stderr, daemon=True)
+        self._err_reader.start()
+
+    def _read_stdout(self):
+        leftover = b""
+        while True:
+            data = self._proc.stdout.read1(65536)
+            if not data:
+                break
+            # Only whole float32 samples are kept, a split sample waits for the next read
+            data = leftover + data
+            usable = len(data) - len(data) % 4
+            leftover = data[usable:]
+            if usable:
+                samples = np.frombuffer(data[:usable], dtype=np.float32).copy()
+                with self._lock:
+                    self._chunks.append(samples)
+                    self._samples += samples.size
+
+    def _read_stderr(self):
+        self._stderr = self._proc.stderr.read()
+
+    @property
+    def seconds(self) -> float:
+        return self._samples / self.sr
+
+    def feed(self, chunk: bytes):
+        if not self._stdin_open:
+            return
+        try:
+            self._proc.stdin.write(chunk)
+            self._proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            # ffmpeg already stopped (max_duration reached or bad input), close() reports errors
+            self._stdin_open = False
+
+    def snapshot(self) -> np.ndarray:
+        # Everything decoded so far as one contiguous array
+        with self._lock:
+            if len(self._chunks) > 1:
+                self._chunks = [np.concatenate(self._chunks)]
+            return self._chunks[0] if self._chunks else np.zeros(0, dtype=np.float32)
+
+    def close(self) -> np.ndarray:
+        # Signal end of input, wait for ffmpeg to flush the remaining audio and return all of it
+        if self._stdin_open:
+            self._stdin_open = False
+            try:
+                self._proc.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+        self._reader.join()
+        self._err_reader.join()
+        returncode = self._proc.wait()
+
+        y = self.snapshot()
+        if returncode != 0 and y.size == 0:
+            raise AudioDecodeError(f"ffmpeg failed to decode audio: {self._stderr.decode(errors='ignore').strip()}")
+        if y.size == 0:
+            raise AudioDecodeError("Decoded audio is empty.")
+        return y
+
+    def abort(self):
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.wait()
@@ -0,0 +1,124 @@
+import os
+
+import numpy as np
+
+# QUALITY_GATE: "reject" (unusable audio gets a 422 before any model runs), "flag" (the report is
+# attached to the response and the audio is scored anyway) or "off"
+QUALITY_GATE = os.environ.get("QUALITY_GATE", "reject")
+
+QUALITY_FRAME_SECONDS = float(os.environ.get("QUALITY_FRAME_SECONDS", "0.02"))
+# A frame is speech if its RMS is above the absolute floor and within QUALITY_DYNAMIC_RANGE_DB of the loudest frame
+QUALITY_SILENCE_DB = float(os.environ.get("QUALITY_SILENCE_DB", "-50"))
+QUALITY_DYNAMIC_RANGE_DB = float(os.environ.get("QUALITY_DYNAMIC_RANGE_DB", "40"))
+QUALITY_MIN_SPEECH_SECONDS = float(os.environ.get("QUALITY_MIN_SPEECH_SECONDS", "1.0"))
+QUALITY_MIN_SPEECH_RATIO = float(os.environ.get("QUALITY_MIN_SPEECH_RATIO", "0.05"))
+QUALITY_CLIP_LEVEL = float(os.environ.get("QUALITY_CLIP_LEVEL", "0.99"))
+QUALITY_MAX_CLIPPED_RATIO = float(os.environ.get("QUALITY_MAX_CLIPPED_RATIO", "0.01"))
+# Kept either side of the first/last speech frame, so word onsets and tails aren't cut off
+QUALITY_PAD_SECONDS = float(os.environ.get("QUALITY_PAD_SECONDS", "0.15"))
+
+ISSUE_MESSAGES = {
+    "empty": "No audio was decoded.",
+    "silent": "No speech detected, check the microphone.",
+    "too_short": "Not enough speech, record a longer sample.",
+    "low_speech_ratio": "The recording is mostly silence.",
+    "clipped": "The recording is clipped, move away from the microphone or lower the input volume.",
+}
+
+
+class AudioQualityError(ValueError):
+    def __init__(self, report):
+        self.report = report
+        self.reason = report["issues"][0]
+        super().__init__(ISSUE_MESSAGES[self.reason])
+
+    def content(self):
+        return {"error": str(self), "reason": self.reason, "quality": self.report}
+
+
+def frame_energy_db(y, frame_length):
+    # RMS of non-overlapping frames in dBFS, the ragged tail is zero padded into one last frame
+    n_frames = max(1, -(-len(y) // frame_length))
+    frames = np.zeros(n_frames * frame_length, dtype=np.float32)
+    frames[:len(y)] = y
+    frames = frames.reshape(n_frames, frame_length)
+    rms = np.sqrt(np.einsum("ij,ij->i", frames, frames) / frame_length)
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+
+def assess_audio(y, sr):
+    # Energy, speech ratio, clipping and effective duration of a decoded mono waveform in one pass
+    # over the buffer. Returns a JSON-ready report, "issues" is empty when the audio is usable and
+    # "voiced" is the (start, end) span in seconds that holds the speech
+    y = np.asarray(y, dtype=np.float32)
+    duration = len(y) / sr
+    if len(y) == 0:
+        return {"ok": False, "issues": ["empty"], "duration": 0.0, "speech_seconds": 0.0, "speech_ratio": 0.0,
+                "clipped_ratio": 0.0, "peak_db": None, "rms_db": None, "voiced": [0.0, 0.0]}
+
+    frame_length = max(1, int(sr * QUALITY_FRAME_SECONDS))
+    energy_db = frame_energy_db(y, frame_length)
+    peak_frame_db = float(energy_db.max())
+    speech = energy_db > max(QUALITY_SILENCE_DB, peak_frame_db - QUALITY_DYNAMIC_RANGE_DB)
+
+    magnitude = np.abs(y)
+    peak = float(magnitude.max())
+    clipped_ratio = float(np.count_nonzero(magnitude >= QUALITY_CLIP_LEVEL)) / len(y)
+    rms_db = float(10 * np.log10(max(float(np.dot(y, y)) / len(y), 1e-20)))
+
+    speech_frames = np.flatnonzero(speech)
+    speech_seconds = min(len(speech_frames) * frame_length / sr, duration)
+    if len(speech_frames):
+        pad = int(sr * QUALITY_PAD_SECONDS)
+        start = max(0, speech_frames[0] * frame_length - pad)
+        end = min(len(y), (speech_frames[-1] + 1) * frame_length + pad)
+        voiced = [round(start / sr, 3), round(end / sr, 3)]
+    else:
+        voiced = [0.0, 0.0]
+
+    issues = []
+    if not len(speech_frames):
+        issues.append("silent")
+    elif speech_seconds < QUALITY_MIN_SPEECH_SECONDS:
+        issues.append("too_short")
+    elif speech_seconds / duration < QUALITY_MIN_SPEECH_RATIO:
+        issues.append("low_speech_ratio")
+    if clipped_ratio > QUALITY_MAX_CLIPPED_RATIO:
+        issues.append("clipped")
+
+    return {
+        "ok": not issues,
+        "issues": issues,
+        "duration": round(duration, 3),
+        "speech_seconds": round(speech_seconds, 3),
+        "speech_ratio": round(speech_seconds / duration, 4),
+        "clipped_ratio": round(clipped_ratio, 5),
+        "peak_db": round(float(20 * np.log10(max(peak, 1e-10))), 2),
+        "rms_db": round(rms_db, 2),
+        "voiced": voiced,
+    }
+
+
+def voiced_span(n_samples, sr, report):
+    # (start, end) sample indices of the report's voiced span at rate sr; the span is in seconds so
+    # the same report trims resampled copies of the waveform too. Everything when nothing was detected
+    if report is None or report["voiced"][1] <= report["voiced"][0]:
+        return 0, n_samples
+    start, end = report["voiced"]
+    return min(int(start * sr), n_samples), min(int(round(end * sr)), n_samples)
+
+
+def voiced_region(y, sr, report):
+    start, end = voiced_span(len(y), sr, report)
+    return y[start:end]
+
+
+def check_audio(y, sr, mode=None):
+    # (voiced waveform, report); raises AudioQualityError in reject mode, report is None when the gate is off
+    mode = mode or QUALITY_GATE
+    if mode == "off":
+        return y, None
+    report = assess_audio(y, sr)
+    if not report["ok"] and mode == "reject":
+        raise AudioQualityError(report)
+    return voiced_region(y, sr, report), report
@@ -0,0 +1,321 @@
+"""
+Offline batch scoring of an audio corpus with the deepfake model and/or speaker embeddings.
+
+Files are decoded and their features extracted in a multiprocessing pool (one single-threaded worker per
+core); the parent process batches the fusion model forward passes and streams rows to CSV or Parquet.
+Rows are written as soon as their batch is scored, so an interrupted run can simply be restarted with the
+same output: files already present in it are skipped.
+
+    python -m src.batch_score --input /data/corpus --output scores.csv
+    python -m src.batch_score --manifest files.txt --output scores.parquet --tasks deepfake,embedding --runtime int8
+
+CSV output is one file (embeddings as JSON lists); Parquet output is a directory of part files (needs pyarrow).
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+
+import torch
+
+from src.audio_decode import decode_audio_bytes
+from src.deepfake_preprocess_audio import DF_FEATURE_ORDER, dfwaveform_features
+from src.deepfake_runtime import DEFAULT_ARTIFACT, DEFAULT_PTH, load_runtime
+from src.speaker_backends import configured_backend, embed_one
+
+AUDIO_EXTENSIONS = (".wav", ".webm", ".flac", ".mp3", ".ogg", ".m4a", ".opus")
+COLUMNS = ["path", "duration_seconds", "bonafide_probability", "prediction", "embedding", "error"]
+SR = 22050
+
+
+def find_audio_files(root):
+    paths = []
+    for directory, _, names in os.walk(root):
+        paths.extend(os.path.join(directory, name) for name in names if name.lower().endswith(AUDIO_EXTENSIONS))
+    return sorted(paths)
+
+
+def read_manifest(path):
+    # Plain text (one path per line) or CSV with a "path" column; relative paths are relative to the manifest
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, newline="") as f:
+        if path.lower().endswith(".csv"):
+            entries = [row["path"] for row in csv.DictReader(f)]
+        else:
+            entries = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    return [entry if os.path.isabs(entry) else os.path.join(base, entry) for entry in entries]
+
+
+class CsvResultWriter:
+    def __init__(self, path):
+        self.path = path
+        self._repair_tail()
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, "a", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=COLUMNS)
+        if new:
+            self._writer.writeheader()
+
+    def _repair_tail(self):
+        # A run killed mid-write can leave half a row behind, cut the file back to the last full line
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    @staticmethod
+    def scored_paths(path, retry_errors=False):
+        if not os.path.exists(path):
+            return set()
+        with open(path, newline="") as f:
+            return {
+                row["path"] for row in csv.DictReader(f)
+                if row.get("path") and not (retry_errors and row.get("error"))
+            }
+
+    def write(self, rows):
+        for row in rows:
+            row = dict(row)
+            if row.get("embedding") is not None:
+                row["embedding"] = json.dumps(row["embedding"])
+            self._writer.writerow(row)
+        # Flushed per batch so a crash loses at most the batch in flight
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetResultWriter:
+    # Parquet files can't be appended to, so each scored batch becomes its own part file, written as
+    # soon as it arrives: nothing is held in memory and a crash loses at most the batch in flight
+    def __init__(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa, self._pq = pa, pq
+        self.path = path
+        self._schema = pa.schema([
+            ("path", pa.string()),
+            ("duration_seconds", pa.float64()),
+            ("bonafide_probability", pa.float64()),
+            ("prediction", pa.string()),
+            ("embedding", pa.list_(pa.float32())),
+            ("error", pa.string()),
+        ])
+        os.makedirs(path, exist_ok=True)
+        self._part = len([n for n in os.listdir(path) if n.endswith(".parquet")])
+
+    @staticmethod
+    def scored_paths(path, retry_errors=False):
+        if not os.path.isdir(path):
+            return set()
+        import pyarrow.parquet as pq
+
+        done = set()
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".parquet"):
+                table = pq.read_table(os.path.join(path, name), columns=["path", "error"]).to_pydict()
+                done.update(p for p, e in zip(table["path"], table["error"]) if not (retry_errors and e))
+        return done
+
+    def write(self, rows):
+        if not rows:
+            return
+        columns = {name: [row.get(name) for row in rows] for name in COLUMNS}
+        table = self._pa.Table.from_pydict(columns, schema=self._schema)
+        # Written under a temporary name first so a half-written part is never read back on resume
+        final = os.path.join(self.path, f"part-{self._part:05d}.parquet")
+        self._pq.write_table(table, final + ".tmp")
+        os.replace(final + ".tmp", final)
+        self._part += 1
+
+    def close(self):
+        pass
+
+
+def result_writer(path, fmt=None):
+    fmt = fmt or ("parquet" if path.lower().endswith(".parquet") else "csv")
+    return (ParquetResultWriter if fmt == "parquet" else CsvResultWriter), fmt
+
+
+# --- worker side ---------------------------------------------------------------------------------
+
+_worker_options = {}
+_speaker_backend = None
+
+
+def _init_worker(options):
+    # One process per core, so each worker sticks to a single intra-op thread
+    torch.set_num_threads(1)
+    _worker_options.update(options)
+
+
+def extract_file(path):
+    # Decode one file and compute what the parent needs: deepfake features and/or the speaker embedding
+    options = _worker_options
+    result = {"path": path}
+    try:
+        with open(path, "rb") as f:
+            y = decode_audio_bytes(f.read(), SR, options["max_seconds"])
+        result["duration_seconds"] = round(len(y) / SR, 3)
+
+        if options["deepfake"]:
+            # Same 8 s decode cutoff and 6 s window as the /deepfake-auth-predict/ endpoint
+            features = dfwaveform_features(y[:int(SR * options["df_seconds"])], SR, 6.0, (128, 259), options["pooled"])
+            if features is None:
+                raise RuntimeError("Feature extraction failed.")
+            result["features"] = [features[k] for k in DF_FEATURE_ORDER]
+
+        if options["embedding"]:
+            # Same backend and rate as the server (SPEAKER_BACKEND / SPEAKER_SAMPLE_RATE), loaded once per worker
+            global _speaker_backend
+            if _speaker_backend is None:
+                backend_class, sample_rate = configured_backend()
+                _speaker_backend = backend_class.load(sample_rate=sample_rate)
+            result["embedding"] = embed_one(_speaker_backend, y, SR)
+    except Exception as e:
+        # Kept on one line so every CSV record is exactly one line (see CsvResultWriter._repair_tail)
+        result["error"] = " ".join(f"{type(e).__name__}: {e}".split())
+    return result
+
+
+# --- parent side ---------------------------------------------------------------------------------
+
+class DeepfakeScorer:
+    def __init__(self, runtime, pth, artifact, pooled):
+        self.model = load_runtime(runtime, pth_path=pth, artifact_path=artifact)
+        self.forward = self.model.forward_pooled if pooled else self.model
+
+    def __call__(self, feature_lists):
+        stacked = [torch.cat(tensors, dim=0) for tensors in zip(*feature_lists)]
+        with torch.no_grad():
+            return self.forward(*stacked).view(-1).tolist()
+
+
+def _submit_all(pool, paths, results, slots):
+    # Keeps at most `slots` files in flight so results can't pile up faster than the model consumes them
+    for path in paths:
+        slots.acquire()
+        pool.apply_async(extract_file, (path,), callback=results.put,
+                         error_callback=lambda e, path=path: results.put({"path": path, "error": repr(e)}))
+
+
+def score_files(paths, writer, args):
+    deepfake = "deepfake" in args.tasks
+    scorer = DeepfakeScorer(args.runtime, args.pth, args.artifact, args.pooled) if deepfake else None
+
+    options = {
+        "deepfake": deepfake,
+        "embedding": "embedding" in args.tasks,
+        "pooled": args.pooled,
+        "df_seconds": args.df_seconds,
+        # Deepfake-only runs never need more than the first df_seconds of audio
+        "max_seconds": None if "embedding" in args.tasks else args.df_seconds,
+    }
+
+    results = queue.Queue()
+    slots = threading.BoundedSemaphore(max(args.batch_size, 1) * args.workers * 2)
+    context = multiprocessing.get_context("spawn")
+    started = time.perf_counter()
+    done = errors = 0
+    pending = []
+
+    def flush():
+        nonlocal errors
+        if not pending:
+            return
+        if scorer is not None:
+            scored = [item for item in pending if "features" in item]
+            try:
+                probs = scorer([item["features"] for item in scored]) if scored else []
+            except Exception as e:
+                probs = []
+                for item in scored:
+                    item["error"] = f"Model forward failed: {e}"
+            for item, prob in zip(scored, probs):
+                item["bonafide_probability"] = round(prob, 6)
+                item["prediction"] = "bonafide" if prob >= 0.5 else "spoof"
+
+        errors += sum(1 for item in pending if item.get("error"))
+        writer.write([{name: item.get(name) for name in COLUMNS} for item in pending])
+        pending.clear()
+
+    with context.Pool(args.workers, initializer=_init_worker, initargs=(options,), maxtasksperchild=args.max_tasks_per_child) as pool:
+        producer = threading.Thread(target=_submit_all, args=(pool, paths, results, slots), daemon=True)
+        producer.start()
+
+        for _ in range(len(paths)):
+            item = results.get()
+            slots.release()
+            pending.append(item)
+            if len(pending) >= args.batch_size:
+                flush()
+
+            done += 1
+            if done % args.progress_every == 0 or done == len(paths):
+                elapsed = time.perf_counter() - started
+                rate = done / elapsed if elapsed else 0.0
+                eta = (len(paths) - done) / rate if rate else 0.0
+                print(f"[batch_score] {done}/{len(paths)} files, {rate:.1f} files/s, {errors} errors, eta {eta:.0f}s",
+                      file=sys.stderr)
+        flush()
+
+    return {"files": len(paths), "errors": errors, "seconds": round(time.perf_counter() - started, 2)}
+
+
+def main(argv=None):
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Score an audio corpus with the deepfake model and/or speaker embeddings")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", help="directory to scan recursively for audio files")
+    source.add_argument("--manifest", help="text file with one path per line, or CSV with a 'path' column")
+    parser.add_argument("--output", required=True, help="results .csv file or .parquet directory")
+    parser.add_argument("--format", choices=["csv", "parquet"], default=None, help="default: from the output extension")
+    parser.add_argument("--tasks", default="deepfake", help="comma separated: deepfake, embedding")
+    parser.add_argument("--workers", type=int, default=max(1, cpus - 1), help="feature extraction processes")
+    parser.add_argument("--model-threads", type=int, default=1, help="torch threads for the batched model in the parent")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--runtime", choices=["eager", "int8", "torchscript"], default="eager")
+    parser.add_argument("--pth", default=DEFAULT_PTH)
+    parser.add_argument("--artifact", default=DEFAULT_ARTIFACT)
+    parser.add_argument("--no-pooled", dest="pooled", action="store_false", help="feed padded 2-D features to forward()")
+    parser.add_argument("--df-seconds", type=float, default=8.0, help="audio decoded for the deepfake window")
+    parser.add_argument("--retry-errors", action="store_true", help="re-score files whose rows have an error (new rows are appended)")
+    parser.add_argument("--max-tasks-per-child", type=int, default=None)
+    parser.add_argument("--progress-every", type=int, default=500)
+    args = parser.parse_args(argv)
+    args.tasks = {t.strip() for t in args.tasks.split(",") if t.strip()}
+    if not args.tasks <= {"deepfake", "embedding"}:
+        parser.error("--tasks accepts deepfake and/or embedding")
+    torch.set_num_threads(max(1, args.model_threads))
+
+    paths = find_audio_files(args.input) if args.input else read_manifest(args.manifest)
+    writer_cls, fmt = result_writer(args.output, args.format)
+
+    # Resume: anything already in the output is skipped
+    done = writer_cls.scored_paths(args.output, args.retry_errors)
+    todo = [p for p in dict.fromkeys(paths) if p not in done]
+    print(f"[batch_score] {len(paths)} files, {len(paths) - len(todo)} already scored, {len(todo)} to do", file=sys.stderr)
+    if not todo:
+        return 0
+
+    writer = writer_cls(args.output)
+    try:
+        summary = score_files(todo, writer, args)
+    finally:
+        writer.close()
+    print(json.dumps({"output": args.output, "format": fmt, **summary}))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
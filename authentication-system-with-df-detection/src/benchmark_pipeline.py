@@ -0,0 +1,393 @@
+"""
+Per-stage microbenchmarks for the audio pipeline.
+
+Each stage (WebM conversion, decode, preprocessing, every deepfake feature, the fusion model forward
+at several batch sizes, speaker embedding, embedding comparison and Whisper per model size) is timed
+on its own and reported with median / p95 latency, throughput and peak resident memory.
+
+Runs offline on CPU: when a checkpoint is missing the model is randomly initialised with the same
+architecture, so latencies stay representative (Whisper decoding length excepted, random weights
+decode until the token limit). Results are written as JSON; pass --baseline with an older report
+to get per-stage ratios.
+
+    python -m src.benchmark_pipeline --out benchmarks/pipeline.json
+    python -m src.benchmark_pipeline --audio sample.webm --stages feature. --baseline benchmarks/pipeline.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import librosa
+import numpy as np
+import torch
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from src.audio_decode import decode_audio_bytes
+from src.deepfake_preprocess_audio import (
+    dfpreprocess_audio, dfextract_features_from_audio, dfextract_pooled_features_from_audio,
+    dfcompute_spectral_frames, _df_mel_basis, _df_chroma_basis, _dfharmonic,
+)
+from src.deepfake_runtime import DEFAULT_PTH, load_fp32_model, example_inputs, example_pooled_inputs
+from src.speaker_backends import VOICE_MODEL_PATH, EcapaBackend, FusionBackend
+
+SR = 22050
+SPEAKER_MODEL_DIR = "pretrained_models/spkrec-ecapa-voxceleb"
+
+# (n_audio_state/n_text_state, heads, layers) of the released Whisper sizes, for random-weight fallbacks
+WHISPER_DIMS = {
+    "tiny": (384, 6, 4),
+    "base": (512, 8, 6),
+    "small": (768, 12, 12),
+    "medium": (1024, 16, 24),
+    "large": (1280, 20, 32),
+    "turbo": (1280, 20, 32),
+}
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        if resource is None:
+            return 0
+        # Process-wide peak; kB on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class PeakMemory:
+    # Samples resident memory in a background thread while a stage runs, so allocations made by
+    # torch and native librosa/numpy code are seen (tracemalloc only sees Python allocations)
+
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.start = self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, _rss_bytes())
+
+    def __enter__(self):
+        self.start = self.peak = _rss_bytes()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss_bytes())
+
+
+def time_stage(fn, repeats=10, warmup=2, items=1):
+    # items: clips processed per call, used for throughput (batch size for the model forward)
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    with PeakMemory() as memory:
+        for _ in range(repeats):
+            started = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - started)
+
+    times = np.array(times) * 1000.0
+    median = float(np.median(times))
+    return {
+        "repeats": repeats,
+        "items_per_call": items,
+        "median_ms": round(median, 3),
+        "p95_ms": round(float(np.percentile(times, 95)), 3),
+        "mean_ms": round(float(times.mean()), 3),
+        "min_ms": round(float(times.min()), 3),
+        "throughput_per_s": round(1000.0 * items / median, 2) if median > 0 else None,
+        "peak_rss_mb": round(memory.peak / 2**20, 1),
+        "rss_delta_mb": round((memory.peak - memory.start) / 2**20, 1),
+    }
+
+
+def synthetic_audio(seconds=6.0, sr=SR, seed=0):
+    # Voiced-speech-like test signal: a 120 Hz harmonic stack with vibrato, syllable-rate
+    # amplitude modulation and background noise
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    f0 = 120 + 15 * np.sin(2 * np.pi * 0.7 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / sr
+    y = sum(np.sin(k * phase) / k for k in range(1, 12))
+    y *= 0.5 * (1 + np.sin(2 * np.pi * 4 * t))
+    y += 0.02 * rng.standard_normal(len(t))
+    return (0.3 * y / np.max(np.abs(y))).astype(np.float32)
+
+
+def synthetic_webm(y, path, sr=SR):
+    from pydub import AudioSegment
+
+    pcm = (np.clip(y, -1, 1) * 32767).astype(np.int16).tobytes()
+    AudioSegment(data=pcm, sample_width=2, frame_rate=sr, channels=1).export(path, format="webm")
+    return path
+
+
+class RandomSpeakerModel:
+    # spkrec-ecapa-voxceleb architecture (Fbank -> sentence mean norm -> ECAPA-TDNN) with random weights,
+    # used when the pretrained model is not on disk
+    def __init__(self):
+        from speechbrain.lobes.features import Fbank
+        from speechbrain.lobes.models.ECAPA_TDNN import ECAPA_TDNN
+        from speechbrain.processing.features import InputNormalization
+
+        self.compute_features = Fbank(n_mels=80)
+        self.mean_var_norm = InputNormalization(norm_type="sentence", std_norm=False)
+        self.embedding_model = ECAPA_TDNN(
+            80, channels=[1024, 1024, 1024, 1024, 3072], kernel_sizes=[5, 3, 3, 3, 1],
+            dilations=[1, 2, 3, 4, 1], attention_channels=128, lin_neurons=192,
+        ).eval()
+
+    def encode_batch(self, wavs, wav_lens=None):
+        if wav_lens is None:
+            wav_lens = torch.ones(wavs.shape[0])
+        with torch.no_grad():
+            feats = self.mean_var_norm(self.compute_features(wavs), wav_lens)
+            return self.embedding_model(feats, wav_lens)
+
+
+def load_speaker_backend(name):
+    # Returns (backend, "checkpoint" | "random"); never downloads
+    if name == "ecapa":
+        if os.path.exists(os.path.join(SPEAKER_MODEL_DIR, "hyperparams.yaml")):
+            return EcapaBackend.load(source=SPEAKER_MODEL_DIR), "checkpoint"
+        return EcapaBackend(RandomSpeakerModel()), "random"
+    if name == "fusion":
+        if os.path.exists(VOICE_MODEL_PATH):
+            return FusionBackend.load(), "checkpoint"
+        from src.voice_audio import AudioFusionModel
+
+        return FusionBackend(AudioFusionModel()), "random"
+    raise ValueError(f"Unknown speaker backend '{name}'")
+
+
+def load_whisper_model(name):
+    # Returns (model, "checkpoint" | "random"); never downloads
+    import whisper
+    from whisper.model import ModelDimensions, Whisper
+
+    root = os.path.join(os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "whisper")
+    url = whisper._MODELS.get(name)
+    if url and os.path.exists(os.path.join(root, os.path.basename(url))):
+        return whisper.load_model(name, device="cpu", download_root=root), "checkpoint"
+
+    base = name.split(".")[0].split("-")[0]
+    if base not in WHISPER_DIMS:
+        raise ValueError(f"No checkpoint or known dimensions for Whisper model '{name}'")
+    state, heads, layers = WHISPER_DIMS[base]
+    v3 = base in ("large", "turbo") and name not in ("large-v1", "large-v2")
+    dims = ModelDimensions(
+        n_mels=128 if v3 else 80, n_audio_ctx=1500, n_audio_state=state, n_audio_head=heads, n_audio_layer=layers,
+        n_vocab=(51864 if name.endswith(".en") else 51866 if v3 else 51865), n_text_ctx=448, n_text_state=state,
+        n_text_head=heads, n_text_layer=4 if base == "turbo" else layers,
+    )
+    torch.manual_seed(0)
+    return Whisper(dims).eval(), "random"
+
+
+def feature_stages(y, sr=SR):
+    # Each feature dfextract_raw_features computes, timed from the same inputs it gets in the pipeline
+    frames = dfcompute_spectral_frames(y)
+    stft, magnitude, power = frames["stft"], frames["magnitude"], frames["power"]
+    mel = np.einsum("...ft,mf->...mt", power, _df_mel_basis(sr), optimize=True)
+    mel_db = librosa.power_to_db(mel)
+
+    def chroma():
+        tuning = librosa.estimate_tuning(S=power, sr=sr, bins_per_octave=12)
+        basis = _df_chroma_basis(sr, tuning)
+        return librosa.util.normalize(np.einsum("cf,...ft->...ct", basis, power, optimize=True), norm=np.inf, axis=-2)
+
+    return {
+        "feature.stft": lambda: dfcompute_spectral_frames(y),
+        "feature.mel_spectrogram": lambda: np.einsum("...ft,mf->...mt", power, _df_mel_basis(sr), optimize=True),
+        "feature.mfcc": lambda: librosa.feature.mfcc(S=librosa.power_to_db(mel), n_mfcc=20),
+        "feature.chroma": chroma,
+        "feature.tonnetz": lambda: librosa.feature.tonnetz(y=_dfharmonic(y, stft), sr=sr),
+        "feature.spectral_contrast": lambda: librosa.feature.spectral_contrast(S=magnitude, sr=sr),
+        "feature.pitch": lambda: librosa.yin(y, fmin=50, fmax=300, sr=sr),
+        "feature.energy": lambda: librosa.feature.rms(y=y),
+        "feature.zcr": lambda: librosa.feature.zero_crossing_rate(y),
+        "feature.onset_strength": lambda: librosa.onset.onset_strength(S=mel_db, sr=sr),
+        "feature.spectral_centroid": lambda: librosa.feature.spectral_centroid(S=magnitude, sr=sr),
+    }
+
+
+def run_benchmarks(args):
+    stages, weights, skipped = {}, {}, {}
+    selected = [s for s in (args.stages or "").split(",") if s]
+
+    def wanted(name):
+        return not selected or any(s in name for s in selected)
+
+    def bench(name, fn, items=1, repeats=None):
+        if not wanted(name):
+            return
+        print(f"[bench] {name}", file=sys.stderr)
+        try:
+            stages[name] = time_stage(fn, repeats or args.repeats, args.warmup, items)
+        except Exception as e:
+            # e.g. pydub without ffprobe; the rest of the suite still runs
+            skipped[name] = str(e)
+
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    try:
+        # Fixture clip if given, otherwise a synthetic one written out as WebM like the frontend sends
+        if args.audio:
+            webm_path = os.path.join(workdir, "clip" + os.path.splitext(args.audio)[1])
+            shutil.copy(args.audio, webm_path)
+        else:
+            webm_path = synthetic_webm(synthetic_audio(args.seconds), os.path.join(workdir, "clip.webm"))
+        with open(webm_path, "rb") as f:
+            audio_bytes = f.read()
+        y_raw = decode_audio_bytes(audio_bytes, SR)
+        y = dfpreprocess_audio(y_raw, sr=SR, target_duration=6.0)
+
+        # The server functions live in main.py, which also pulls in its serving dependencies
+        server = None
+        if any(wanted(name) for name in ("convert_webm_to_wav", "get_embedding", "compare_embeddings", "enroll_sequential[3]", "enroll_batched[3]")):
+            try:
+                from src import main as server
+            except Exception as e:
+                skipped["server"] = f"could not import src.main: {e}"
+
+        if server is not None and webm_path.endswith(".webm"):
+            bench("convert_webm_to_wav", lambda: server.convert_webm_to_wav(webm_path))
+        bench("decode_audio_bytes", lambda: decode_audio_bytes(audio_bytes, SR))
+        bench("dfpreprocess_audio", lambda: dfpreprocess_audio(y_raw, sr=SR, target_duration=6.0))
+        for name, fn in feature_stages(y).items():
+            bench(name, fn)
+        bench("dfextract_features_from_audio", lambda: dfextract_features_from_audio(y, SR))
+        bench("dfextract_pooled_features_from_audio", lambda: dfextract_pooled_features_from_audio(y, SR))
+
+        if wanted("deepfake_forward_pooled"):
+            has_checkpoint = os.path.exists(args.df_pth)
+            weights["deepfake"] = "checkpoint" if has_checkpoint else "random"
+            model = load_fp32_model(args.df_pth if has_checkpoint else None)
+            for batch_size in args.batch_sizes:
+                inputs = tuple(torch.randn_like(x) for x in example_inputs(batch_size))
+                pooled = tuple(torch.randn_like(x) for x in example_pooled_inputs(batch_size))
+                with torch.no_grad():
+                    bench(f"deepfake_forward[b={batch_size}]", lambda: model(*inputs), items=batch_size)
+                    bench(f"deepfake_forward_pooled[b={batch_size}]", lambda: model.forward_pooled(*pooled), items=batch_size)
+            del model
+
+        if server is not None:
+            try:
+                backend, weights["speaker"] = load_speaker_backend(server.SPEAKER_BACKEND)
+                server.registry.register("speaker", lambda: backend)
+                embedding = server.get_embedding(y_raw, SR)
+                bench("get_embedding", lambda: server.get_embedding(y_raw, SR))
+                # Enrollment: three utterances one at a time vs one padded batch
+                utterances = [librosa.resample(y_raw[:int(SR * seconds)], orig_sr=SR, target_sr=server.SPEAKER_SAMPLE_RATE)
+                              for seconds in (4.0, 5.0, 6.0)]
+                bench("enroll_sequential[3]", lambda: [server.get_embedding(u) for u in utterances])
+                bench("enroll_batched[3]", lambda: server.get_embeddings_batch(utterances))
+                other = list(np.roll(embedding, 1))
+                bench("compare_embeddings", lambda: server.compare_embeddings(embedding, other), repeats=max(args.repeats, 100))
+            except Exception as e:
+                skipped["get_embedding"] = str(e)
+
+        y_16k = librosa.resample(y_raw, orig_sr=SR, target_sr=16000)
+        weights["whisper"] = {}
+        for name in args.whisper_models:
+            if not wanted(f"whisper_transcribe[{name}]"):
+                continue
+            try:
+                model, source = load_whisper_model(name)
+            except Exception as e:
+                skipped[f"whisper[{name}]"] = str(e)
+                continue
+            weights["whisper"][name] = source
+            bench(
+                f"whisper_transcribe[{name}]",
+                lambda: model.transcribe(y_16k, language="en", temperature=0.0, fp16=False, condition_on_previous_text=False),
+                repeats=args.whisper_repeats,
+            )
+            del model
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "torch": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "librosa": librosa.__version__,
+            "numpy": np.__version__,
+        },
+        "config": {
+            "audio": args.audio or f"synthetic {args.seconds:g} s",
+            "audio_seconds": round(len(y_raw) / SR, 2),
+            "repeats": args.repeats,
+            "warmup": args.warmup,
+            "batch_sizes": args.batch_sizes,
+        },
+        "weights": weights,
+        "skipped": skipped,
+        "stages": stages,
+    }
+
+
+def compare_reports(report, baseline):
+    # current / baseline median per stage, > 1 means slower than the baseline
+    ratios = {}
+    for name, stage in report["stages"].items():
+        old = baseline.get("stages", {}).get(name)
+        if old and old.get("median_ms"):
+            ratios[name] = round(stage["median_ms"] / old["median_ms"], 3)
+    return ratios
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time each stage of the audio pipeline")
+    parser.add_argument("--out", default=None, help="write the JSON report here")
+    parser.add_argument("--audio", default=None, help="fixture clip (WebM/WAV); a synthetic clip is used if omitted")
+    parser.add_argument("--seconds", type=float, default=6.0, help="length of the synthetic clip")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--batch-sizes", default="1,4,8,16", help="fusion model batch sizes")
+    parser.add_argument("--whisper-models", default="tiny,base", help="comma separated Whisper sizes, empty to skip")
+    parser.add_argument("--whisper-repeats", type=int, default=3)
+    parser.add_argument("--df-pth", default=DEFAULT_PTH, help="deepfake checkpoint (random weights if missing)")
+    parser.add_argument("--stages", default=None, help="only run stages whose name contains one of these (comma separated)")
+    parser.add_argument("--baseline", default=None, help="earlier report to compare medians against")
+    args = parser.parse_args(argv)
+    args.batch_sizes = [int(b) for b in args.batch_sizes.split(",") if b]
+    args.whisper_models = [m for m in args.whisper_models.split(",") if m]
+
+    report = run_benchmarks(args)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["vs_baseline"] = compare_reports(report, json.load(f))
+
+    print(json.dumps(report, indent=2))
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
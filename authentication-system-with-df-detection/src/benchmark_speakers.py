@@ -0,0 +1,259 @@
+"""
+Compare the speaker-embedding backends (see src/speaker_backends.py) on latency, memory and EER.
+
+For every backend the model is loaded (resident memory before/after), a single utterance and a batch
+are timed, every utterance of the corpus is embedded, and all same/different speaker pairs are scored
+with cosine similarity to get the equal error rate. FAR/FRR are also reported at the server's
+verification threshold.
+
+The corpus is a directory with one sub-directory per speaker (VoxCeleb layout, nested folders are
+fine). Without --audio-dir a synthetic corpus is used: harmonic "voices" that differ in pitch and
+formants, which checks the plumbing but says nothing about real-world accuracy. Missing checkpoints
+fall back to randomly initialised weights like src.benchmark_pipeline; the report records which.
+
+    python -m src.benchmark_speakers --audio-dir datasets/vox1_subset_test --out benchmarks/speakers.json
+"""
+
+import argparse
+import datetime
+import gc
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import torch
+
+from src.audio_decode import decode_audio_bytes
+from src.benchmark_pipeline import PeakMemory, _rss_bytes, load_speaker_backend, time_stage
+
+AUDIO_EXTENSIONS = (".wav", ".flac", ".mp3", ".ogg", ".webm", ".m4a")
+SR = 22050
+
+
+def load_corpus(audio_dir, max_per_speaker=None):
+    # [(speaker, path)], the speaker is the first directory under audio_dir
+    items = []
+    for root, _, files in os.walk(audio_dir):
+        for name in sorted(files):
+            if name.lower().endswith(AUDIO_EXTENSIONS):
+                path = os.path.join(root, name)
+                speaker = os.path.relpath(path, audio_dir).split(os.sep)[0]
+                items.append((speaker, path))
+    items.sort()
+    if max_per_speaker:
+        counts, kept = {}, []
+        for speaker, path in items:
+            counts[speaker] = counts.get(speaker, 0) + 1
+            if counts[speaker] <= max_per_speaker:
+                kept.append((speaker, path))
+        items = kept
+    return items
+
+
+def synthetic_voice(f0, formants, seconds, sr, rng):
+    # Harmonic stack shaped by a speaker's formant envelope, with per-utterance intonation,
+    # syllable-rate amplitude modulation and background noise
+    t = np.arange(int(seconds * sr)) / sr
+    contour = f0 * (1 + 0.08 * np.sin(2 * np.pi * rng.uniform(0.3, 1.2) * t + rng.uniform(0, 2 * np.pi)))
+    phase = 2 * np.pi * np.cumsum(contour) / sr
+    y = np.zeros_like(t)
+    for k in range(1, int(0.45 * sr / f0)):
+        gain = sum(np.exp(-((k * f0 - centre) / width) ** 2) for centre, width in formants) + 0.02
+        y += gain * np.sin(k * phase) / np.sqrt(k)
+    y *= 0.55 + 0.45 * np.sin(2 * np.pi * rng.uniform(3, 5) * t + rng.uniform(0, 2 * np.pi))
+    y += 0.03 * np.std(y) * rng.standard_normal(len(t))
+    return (0.3 * y / np.max(np.abs(y))).astype(np.float32)
+
+
+def synthetic_corpus(speakers=8, per_speaker=4, seconds=4.0, sr=SR, seed=0):
+    rng = np.random.default_rng(seed)
+    clips = []
+    for s in range(speakers):
+        f0 = rng.uniform(90, 220)
+        formants = [(rng.uniform(300, 900), 120), (rng.uniform(900, 2300), 180), (rng.uniform(2300, 3500), 250)]
+        for _ in range(per_speaker):
+            clips.append((f"synthetic_{s:02d}", synthetic_voice(f0, formants, seconds, sr, rng)))
+    return clips
+
+
+def compute_eer(scores, labels):
+    # Equal error rate and the threshold where false accepts and false rejects meet
+    scores, labels = np.asarray(scores, dtype=np.float64), np.asarray(labels, dtype=bool)
+    order = np.argsort(-scores, kind="stable")
+    sorted_scores, sorted_labels = scores[order], labels[order]
+    positives, negatives = sorted_labels.sum(), (~sorted_labels).sum()
+    if positives == 0 or negatives == 0:
+        return None, None
+    # Accepting the first i + 1 pairs: false accepts among them, false rejects among the rest
+    far = np.cumsum(~sorted_labels) / negatives
+    frr = 1.0 - np.cumsum(sorted_labels) / positives
+    i = int(np.argmin(np.abs(far - frr)))
+    return float((far[i] + frr[i]) / 2), float(sorted_scores[i])
+
+
+def rates_at(scores, labels, threshold):
+    scores, labels = np.asarray(scores), np.asarray(labels, dtype=bool)
+    accepted = scores >= threshold
+    return {
+        "threshold": threshold,
+        "far": round(float(accepted[~labels].mean()), 4) if (~labels).any() else None,
+        "frr": round(float((~accepted[labels]).mean()), 4) if labels.any() else None,
+    }
+
+
+def pair_trials(speakers, max_trials=None, seed=0):
+    # Every pair of utterances, labelled same/different speaker
+    pairs = list(itertools.combinations(range(len(speakers)), 2))
+    if max_trials and len(pairs) > max_trials:
+        rng = np.random.default_rng(seed)
+        pairs = [pairs[i] for i in sorted(rng.choice(len(pairs), max_trials, replace=False))]
+    return pairs, [speakers[i] == speakers[j] for i, j in pairs]
+
+
+def count_parameters(model):
+    # SpeechBrain keeps its modules in .mods, the random ECAPA stand-in in .embedding_model
+    module = getattr(model, "mods", None) or getattr(model, "embedding_model", None) or model
+    return sum(p.numel() for p in module.parameters()) if isinstance(module, torch.nn.Module) else None
+
+
+def benchmark_backend(name, clips_at, args, trials, labels):
+    gc.collect()
+    rss_before = _rss_bytes()
+    started = time.perf_counter()
+    with PeakMemory() as load_memory:
+        backend, weights = load_speaker_backend(name)
+        backend.encode_batch([np.zeros(backend.sample_rate, dtype=np.float32)])  # warm up
+    load_seconds = time.perf_counter() - started
+    rss_loaded = _rss_bytes()
+
+    parameters = count_parameters(backend.model)
+
+    clips = clips_at(backend.sample_rate)
+    batch = clips[:args.batch_size]
+    report = {
+        "weights": weights,
+        "sample_rate": backend.sample_rate,
+        "embedding_dim": backend.embedding_dim,
+        "parameters": parameters,
+        "load_seconds": round(load_seconds, 3),
+        "load_rss_delta_mb": round((rss_loaded - rss_before) / 2**20, 1),
+        "load_peak_rss_mb": round(load_memory.peak / 2**20, 1),
+        "latency": {
+            "single": time_stage(lambda: backend.encode_batch(batch[:1]), args.repeats, args.warmup),
+            f"batch_{len(batch)}": time_stage(lambda: backend.encode_batch(batch), args.repeats, args.warmup, len(batch)),
+        },
+    }
+
+    # Whole corpus in batches, then every trial scored with cosine similarity
+    started = time.perf_counter()
+    with PeakMemory() as memory:
+        embeddings = np.concatenate([
+            backend.encode_batch(clips[i:i + args.batch_size]) for i in range(0, len(clips), args.batch_size)
+        ])
+    elapsed = time.perf_counter() - started
+    embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    scores = [float(embeddings[i] @ embeddings[j]) for i, j in trials]
+
+    eer, eer_threshold = compute_eer(scores, labels)
+    report["corpus"] = {
+        "seconds": round(elapsed, 3),
+        "utterances_per_s": round(len(clips) / elapsed, 2) if elapsed > 0 else None,
+        "peak_rss_mb": round(memory.peak / 2**20, 1),
+    }
+    report["eer"] = round(eer, 4) if eer is not None else None
+    report["eer_threshold"] = round(eer_threshold, 4) if eer_threshold is not None else None
+    report["at_threshold"] = rates_at(scores, labels, args.threshold)
+
+    del backend
+    gc.collect()
+    return report
+
+
+def run_benchmarks(args):
+    if args.audio_dir:
+        items = load_corpus(args.audio_dir, args.max_per_speaker)
+        speakers = [speaker for speaker, _ in items]
+        raw = []
+        for _, path in items:
+            with open(path, "rb") as f:
+                raw.append(f.read())
+        decoded = {}
+
+        def clips_at(sr):
+            if sr not in decoded:
+                decoded[sr] = [decode_audio_bytes(data, sr, args.max_seconds) for data in raw]
+            return decoded[sr]
+    else:
+        corpus = synthetic_corpus(args.speakers, args.per_speaker, args.seconds)
+        speakers = [speaker for speaker, _ in corpus]
+
+        def clips_at(sr):
+            import librosa
+
+            return [librosa.resample(y, orig_sr=SR, target_sr=sr) if sr != SR else y for _, y in corpus]
+
+    trials, labels = pair_trials(speakers, args.max_trials)
+    backends, skipped = {}, {}
+    for name in args.backends:
+        print(f"[bench] {name}", file=sys.stderr)
+        try:
+            backends[name] = benchmark_backend(name, clips_at, args, trials, labels)
+        except Exception as e:
+            skipped[name] = str(e)
+
+    return {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "torch": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+        },
+        "config": {
+            "corpus": args.audio_dir or f"synthetic {args.speakers} speakers x {args.per_speaker}",
+            "utterances": len(speakers),
+            "speakers": len(set(speakers)),
+            "trials": len(trials),
+            "target_trials": int(sum(labels)),
+            "batch_size": args.batch_size,
+            "repeats": args.repeats,
+        },
+        "skipped": skipped,
+        "backends": backends,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare speaker-embedding backends on latency, memory and EER")
+    parser.add_argument("--audio-dir", default=None, help="one sub-directory per speaker; synthetic voices if omitted")
+    parser.add_argument("--backends", default="ecapa,fusion", help="comma separated backend names")
+    parser.add_argument("--out", default=None, help="write the JSON report here")
+    parser.add_argument("--max-per-speaker", type=int, default=None)
+    parser.add_argument("--max-seconds", type=float, default=10.0, help="decode cutoff per utterance")
+    parser.add_argument("--max-trials", type=int, default=20000, help="sample this many pairs if there are more")
+    parser.add_argument("--speakers", type=int, default=8, help="synthetic corpus size")
+    parser.add_argument("--per-speaker", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=4.0)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--threshold", type=float, default=0.6, help="verification threshold to report FAR/FRR at")
+    args = parser.parse_args(argv)
+    args.backends = [b for b in args.backends.split(",") if b]
+
+    report = run_benchmarks(args)
+    print(json.dumps(report, indent=2))
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
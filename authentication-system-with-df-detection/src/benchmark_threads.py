@@ -0,0 +1,271 @@
+"""
+Sweep thread-budget configurations (see src/thread_budget.py) under concurrent load and report
+throughput and latency percentiles, to size machines and pick THREAD_BUDGET_MODE / STAGE_* settings.
+
+Every configuration runs in a fresh process, since BLAS pools and torch's inter-op pool can only be
+sized once per process. The process loads Whisper, the deepfake fusion model and the speaker
+backend, and pushes requests through a StageExecutor the way /authenticate/ does. Each request
+resamples the clip to 16 kHz, then runs Whisper passphrase verification, deepfake features plus
+forward, and the speaker embedding at the same time. `concurrency` clients send requests back to
+back (closed loop) until --requests have completed; the first --warmup requests are not counted.
+
+A configuration is a name, environment overrides (THREAD_BUDGET_MODE, BLAS_THREADS,
+STAGE_<NAME>_THREADS / _CORES / _LIMIT, STAGE_THREAD_WORKERS, ...) and a concurrency. By default
+--modes x --concurrency x --thread-workers is swept; --configs takes a JSON list of
+{"name": ..., "env": {...}, "concurrency": N} instead. Missing checkpoints fall back to random
+weights like src.benchmark_pipeline.
+
+    python -m src.benchmark_threads --modes off,budget,pinned --concurrency 1,4,8 --out benchmarks/threads.json
+    python -m src.benchmark_threads --configs sweep.json --whisper base --requests 64
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+SR = 22050
+PASSPHRASE = "my voice is my password"
+
+
+def percentiles(latencies):
+    latencies = np.asarray(latencies) * 1000.0
+    return {
+        "mean_ms": round(float(latencies.mean()), 1),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 1),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 1),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 1),
+        "max_ms": round(float(latencies.max()), 1),
+    }
+
+
+# --- worker side (one process per configuration) ------------------------------------------------
+
+def load_models(args):
+    # Imported here so the parent never loads torch and every child picks up its env first
+    import torch
+
+    from src.benchmark_pipeline import load_speaker_backend, load_whisper_model
+    from src.deepfake_runtime import DEFAULT_PTH, load_fp32_model
+    from src.whisper_verify import PassphraseVerifier
+
+    weights = {}
+    verifier = None
+    if args.whisper != "none":
+        whisper_model, weights["whisper"] = load_whisper_model(args.whisper)
+        verifier = PassphraseVerifier(whisper_model)
+    weights["deepfake"] = "checkpoint" if os.path.exists(DEFAULT_PTH) else "random"
+    deepfake = load_fp32_model(DEFAULT_PTH if weights["deepfake"] == "checkpoint" else None)
+    speaker, weights["speaker"] = load_speaker_backend(args.speaker_backend)
+    torch.manual_seed(0)
+    return verifier, deepfake, speaker, weights
+
+
+def load_clip(args):
+    from src.audio_decode import decode_audio_bytes
+    from src.benchmark_pipeline import synthetic_audio
+
+    if args.audio:
+        with open(args.audio, "rb") as f:
+            return decode_audio_bytes(f.read(), SR, args.seconds)
+    return synthetic_audio(args.seconds)
+
+
+async def drive(handle, concurrency, requests, warmup):
+    # Warm-up requests run first on their own, so the timed window starts with every model hot. Then
+    # a closed loop: each client starts its next request as soon as its previous one returns.
+    # Returns (latencies, wall seconds, process CPU seconds) of the timed window
+    for _ in range(warmup):
+        await handle()
+
+    latencies, remaining = [], requests
+
+    async def client():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            await handle()
+            latencies.append(time.perf_counter() - started)
+
+    started, cpu_started = time.perf_counter(), time.process_time()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - started, time.process_time() - cpu_started
+
+
+def run_worker(spec, args):
+    import torch
+
+    from src.audio_decode import resample_audio
+    from src.deepfake_preprocess_audio import DF_FEATURE_ORDER, dfwaveform_features
+    from src.thread_budget import configure_process_threads, describe_budgets, plan_stage_budgets
+    from src.worker_pool import StageExecutor, server_stage_configs
+
+    applied = configure_process_threads()
+    stages = plan_stage_budgets(server_stage_configs())
+    verifier, deepfake, speaker, weights = load_models(args)
+    y = load_clip(args)
+
+    def forward(inputs):
+        with torch.no_grad():
+            return deepfake.forward_pooled(*inputs).view(-1).tolist()
+
+    async def main():
+        pool = StageExecutor(
+            stages=stages,
+            thread_workers=int(os.environ.get("STAGE_THREAD_WORKERS", os.cpu_count() or 4)),
+        )
+
+        async def score_deepfake():
+            features = await pool.run("features", dfwaveform_features, y[:int(SR * 8.0)], SR, 6.0, (128, 259), True)
+            return await pool.run("deepfake_model", forward, [features[k] for k in DF_FEATURE_ORDER])
+
+        async def handle():
+            y_16k = await pool.run("decode", resample_audio, y, SR, 16000)
+            y_speaker = y_16k if speaker.sample_rate == 16000 else \
+                await pool.run("decode", resample_audio, y, SR, speaker.sample_rate)
+            work = [score_deepfake(), pool.run("embedding", speaker.encode_batch, [y_speaker])]
+            if verifier is not None:
+                work.append(pool.run("transcribe", verifier.verify, y_16k, PASSPHRASE))
+            await asyncio.gather(*work)
+
+        try:
+            return await drive(handle, spec["concurrency"], args.requests, args.warmup)
+        finally:
+            pool.shutdown()
+
+    latencies, elapsed, cpu_seconds = asyncio.run(main())
+
+    return {
+        "name": spec["name"],
+        "env": spec.get("env", {}),
+        "concurrency": spec["concurrency"],
+        "requests": len(latencies),
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 3) if elapsed > 0 else None,
+        "latency": percentiles(latencies),
+        # Busy CPUs on average over the timed window; near the usable CPU count means saturated
+        "cpu_busy": round(cpu_seconds / elapsed, 2) if elapsed > 0 else None,
+        "process_threads": applied,
+        "stage_budgets": describe_budgets(stages),
+        "weights": weights,
+    }
+
+
+# --- parent side ----------------------------------------------------------------------------------
+
+def sweep_configs(args):
+    if args.configs:
+        with open(args.configs) as f:
+            return json.load(f)
+    configs = []
+    for mode in args.modes:
+        for workers in args.thread_workers or [None]:
+            env = {"THREAD_BUDGET_MODE": mode}
+            if workers:
+                env["STAGE_THREAD_WORKERS"] = str(workers)
+            for concurrency in args.concurrency:
+                name = f"{mode}" + (f"-w{workers}" if workers else "") + f"-c{concurrency}"
+                configs.append({"name": name, "env": env, "concurrency": concurrency})
+    return configs
+
+
+def run_config(spec, args, argv):
+    env = dict(os.environ)
+    env.update({k: str(v) for k, v in spec.get("env", {}).items()})
+    cmd = [sys.executable, "-m", "src.benchmark_threads", *argv, "--worker", json.dumps(spec)]
+    proc = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=args.timeout)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit {proc.returncode}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def best_by_concurrency(results):
+    # Highest throughput and lowest p99 among the configurations run at each concurrency
+    best = {}
+    for concurrency in sorted({r["concurrency"] for r in results}):
+        runs = [r for r in results if r["concurrency"] == concurrency]
+        best[str(concurrency)] = {
+            "throughput": max(runs, key=lambda r: r["throughput_rps"] or 0)["name"],
+            "p99": min(runs, key=lambda r: r["latency"]["p99_ms"])["name"],
+        }
+    return best
+
+
+def run_sweep(args, argv):
+    results, failed = [], {}
+    for spec in sweep_configs(args):
+        print(f"[bench] {spec['name']}", file=sys.stderr)
+        try:
+            result = run_config(spec, args, argv)
+        except Exception as e:
+            failed[spec["name"]] = str(e)
+            continue
+        results.append(result)
+        print(f"        {result['throughput_rps']} req/s, p50 {result['latency']['p50_ms']} ms, "
+              f"p99 {result['latency']['p99_ms']} ms", file=sys.stderr)
+
+    return {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "usable_cpus": len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None,
+        },
+        "config": {
+            "audio": args.audio or f"synthetic {args.seconds:g} s",
+            "whisper": args.whisper,
+            "speaker_backend": args.speaker_backend,
+            "requests": args.requests,
+            "warmup": args.warmup,
+        },
+        "failed": failed,
+        "best": best_by_concurrency(results) if results else {},
+        "results": results,
+    }
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    parser = argparse.ArgumentParser(description="Sweep thread budgets and report throughput and p99 latency")
+    parser.add_argument("--out", default=None, help="write the JSON report here")
+    parser.add_argument("--modes", default="off,budget,pinned", help="THREAD_BUDGET_MODE values to sweep")
+    parser.add_argument("--concurrency", default="1,4", help="concurrent clients, comma separated")
+    parser.add_argument("--thread-workers", default="", help="STAGE_THREAD_WORKERS values to sweep (default: leave as is)")
+    parser.add_argument("--configs", default=None, help="JSON list of {name, env, concurrency}, replaces the sweep")
+    parser.add_argument("--requests", type=int, default=16, help="timed requests per configuration")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--audio", default=None, help="fixture clip; a synthetic clip is used if omitted")
+    parser.add_argument("--seconds", type=float, default=6.0, help="clip length (decode cutoff with --audio)")
+    parser.add_argument("--whisper", default="tiny", help="Whisper size, or none to leave it out")
+    parser.add_argument("--speaker-backend", default="ecapa")
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds before a configuration is abandoned")
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    args.modes = [m for m in args.modes.split(",") if m]
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c]
+    args.thread_workers = [int(w) for w in args.thread_workers.split(",") if w]
+
+    if args.worker:
+        print(json.dumps(run_worker(json.loads(args.worker), args)))
+        return 0
+
+    report = run_sweep(args, argv)
+    print(json.dumps(report, indent=2))
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
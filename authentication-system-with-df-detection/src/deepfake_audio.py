@@ -108,23 +108,31 @@ class AudioDeepfakeFusionModel(nn.Module):
 
     def forward(self, mfcc, chroma, tonnetz, contrast, pitch, energy, zcr, onset, centroid, mel_spec):
 
-        # MFCC input is 2D, add channel dim for CNN: (B, 1, H, W)
-        mfcc = mfcc.unsqueeze(1)  
-
         # Pooling for time-dimension on all 1D features
         def pool(x): return x.mean(dim=-1)
 
+        return self.forward_pooled(
+            mfcc, pool(chroma), pool(tonnetz), pool(contrast), pool(pitch),
+            pool(energy), pool(zcr), pool(onset), pool(centroid), pool(mel_spec)
+        )
+
+    def forward_pooled(self, mfcc, chroma, tonnetz, contrast, pitch, energy, zcr, onset, centroid, mel_spec):
+        # Same as forward, but the nine non-MFCC features are already time-pooled (B, 128) vectors
+
+        # MFCC input is 2D, add channel dim for CNN: (B, 1, H, W)
+        mfcc = mfcc.unsqueeze(1)  
+
         # Forward through each branch
         mfcc_out     = self.mfcc_branch(mfcc)
-        chroma_out   = self.chroma_branch(pool(chroma))
-        tonnetz_out  = self.tonnetz_branch(pool(tonnetz))
-        contrast_out = self.contrast_branch(pool(contrast))
-        pitch_out    = self.pitch_branch(pool(pitch))
-        energy_out   = self.energy_branch(pool(energy))
-        zcr_out      = self.zcr_branch(pool(zcr))
-        onset_out    = self.onset_branch(pool(onset))
-        centroid_out = self.centroid_branch(pool(centroid))
-        mel_spec_out = self.mel_spec_branch(pool(mel_spec))
+        chroma_out   = self.chroma_branch(chroma)
+        tonnetz_out  = self.tonnetz_branch(tonnetz)
+        contrast_out = self.contrast_branch(contrast)
+        pitch_out    = self.pitch_branch(pitch)
+        energy_out   = self.energy_branch(energy)
+        zcr_out      = self.zcr_branch(zcr)
+        onset_out    = self.onset_branch(onset)
+        centroid_out = self.centroid_branch(centroid)
+        mel_spec_out = self.mel_spec_branch(mel_spec)
 
         # Concatenate all feature vectors into one
         fusion = torch.cat([
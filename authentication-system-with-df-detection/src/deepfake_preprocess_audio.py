@@ -1,8 +1,13 @@
+import io
+from functools import lru_cache
+
 import numpy as np
 import librosa
 import torch
 import torch.nn.functional as F
 
+from src.metrics import stage_timer
+
 def dfpreprocess_audio(y, sr=22050, target_duration=6.0, apply_preemphasis=False, coef=0.5, normalise='rms'):
     y, _ = librosa.effects.trim(y)
     if apply_preemphasis:
@@ -34,20 +39,99 @@ def dfpad_or_resize(tensor, target_shape=(128, 259)):
 
     return F.pad(torch.tensor(tensor, dtype=torch.float32), (0, pad_w, 0, pad_h)).unsqueeze(0)
 
+def dfpooled_or_resize(tensor, target_shape=(128, 259)):
+    # Same result as dfpad_or_resize(tensor).mean(dim=-1) without building the padded matrix:
+    # padded rows pool to exactly 0, and real rows are averaged over the full padded width
+    if tensor.ndim == 1:
+        tensor = tensor[None, :]
+    h = min(tensor.shape[0], target_shape[0])
+    w = min(tensor.shape[1], target_shape[1])
+
+    # Row-major like the padded tensor, so each row is reduced in the same order (librosa can return F-ordered arrays)
+    rows = torch.tensor(tensor[:h, :w], dtype=torch.float32).contiguous()
+    if w < target_shape[1]:
+        # Only the (few) real rows get width padding, so the mean divides by the same width
+        rows = F.pad(rows, (0, target_shape[1] - w))
+
+    pooled = torch.zeros(1, target_shape[0])
+    pooled[0, :h] = rows.mean(dim=-1)
+    return pooled
+
+# Order of the feature tensors expected by AudioDeepfakeFusionModel.forward
+DF_FEATURE_ORDER = [
+    'mfcc', 'chroma', 'tonnetz', 'spectral_contrast', 'pitch',
+    'energy', 'zcr', 'onset_strength', 'spectral_centroid', 'mel_spectrogram'
+]
+
+# Shared STFT settings, these match the librosa defaults each feature used to compute on its own
+DF_N_FFT = 2048
+DF_HOP_LENGTH = 512
+DF_N_MELS = 128
+
+
+# Filterbanks only depend on sr/n_fft, so build them once per process instead of once per request
+@lru_cache(maxsize=8)
+def _df_mel_basis(sr, n_fft=DF_N_FFT, n_mels=DF_N_MELS):
+    return librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels)
+
+
+@lru_cache(maxsize=64)
+def _df_chroma_basis(sr, tuning, n_fft=DF_N_FFT, n_chroma=12):
+    return librosa.filters.chroma(sr=sr, n_fft=n_fft, tuning=tuning, n_chroma=n_chroma)
+
+
+def dfcompute_spectral_frames(y, n_fft=DF_N_FFT, hop_length=DF_HOP_LENGTH):
+    # One complex STFT for the whole clip, magnitude and power are derived from it
+    stft = librosa.stft(y, n_fft=n_fft, hop_length=hop_length)
+    magnitude = np.abs(stft)
+    return {"stft": stft, "magnitude": magnitude, "power": magnitude ** 2}
+
+
+def _dfspectral_features(magnitude, power, sr):
+    # Features that come straight from the shared STFT frames
+
+    # Mel power spectrogram and its dB version feed mfcc, onset strength and the mel branch
+    mel = np.einsum("...ft,mf->...mt", power, _df_mel_basis(sr), optimize=True)
+    mel_db = librosa.power_to_db(mel)
+
+    # Chroma filter depends on the estimated tuning of this clip
+    tuning = librosa.estimate_tuning(S=power, sr=sr, bins_per_octave=12)
+    chroma = np.einsum("cf,...ft->...ct", _df_chroma_basis(sr, tuning), power, optimize=True)
+
+    return {
+        "mfcc": librosa.feature.mfcc(S=mel_db, n_mfcc=20),
+        "chroma": librosa.util.normalize(chroma, norm=np.inf, axis=-2),
+        "spectral_contrast": librosa.feature.spectral_contrast(S=magnitude, sr=sr),
+        "onset_strength": librosa.onset.onset_strength(S=mel_db, sr=sr).reshape(1, -1),
+        "spectral_centroid": librosa.feature.spectral_centroid(S=magnitude, sr=sr),
+        "mel_spectrogram": mel
+    }
+
+
+def _dfharmonic(y, stft):
+    # Harmonic component for tonnetz, reusing the shared STFT for the HPSS split
+    stft_harm = librosa.decompose.hpss(stft)[0]
+    return librosa.istft(stft_harm, dtype=y.dtype, hop_length=DF_HOP_LENGTH, length=y.shape[-1])
+
+
+def dfextract_raw_features(y, sr, frames=None):
+    if frames is None:
+        frames = dfcompute_spectral_frames(y)
+
+    spectral = _dfspectral_features(frames["magnitude"], frames["power"], sr)
+    features = {
+        "tonnetz": librosa.feature.tonnetz(y=_dfharmonic(y, frames["stft"]), sr=sr),
+        "pitch": librosa.yin(y, fmin=50, fmax=300, sr=sr).reshape(1, -1),
+        "energy": librosa.feature.rms(y=y),
+        "zcr": librosa.feature.zero_crossing_rate(y),
+        **spectral
+    }
+    return {k: features[k] for k in DF_FEATURE_ORDER}
+
+
 def dfextract_features_from_audio(y, sr, target_shape=(128, 259)):
     try:
-        feature_dict = {
-            "mfcc": librosa.feature.mfcc(y=y, sr=sr, n_mfcc=20),
-            "chroma": librosa.feature.chroma_stft(y=y, sr=sr),
-            "tonnetz": librosa.feature.tonnetz(y=librosa.effects.harmonic(y), sr=sr),
-            "spectral_contrast": librosa.feature.spectral_contrast(y=y, sr=sr),
-            "pitch": librosa.yin(y, fmin=50, fmax=300, sr=sr).reshape(1, -1),
-            "energy": librosa.feature.rms(y=y),
-            "zcr": librosa.feature.zero_crossing_rate(y),
-            "onset_strength": librosa.onset.onset_strength(y=y, sr=sr).reshape(1, -1),
-            "spectral_centroid": librosa.feature.spectral_centroid(y=y, sr=sr),
-            "mel_spectrogram": librosa.feature.melspectrogram(y=y, sr=sr, n_mels=128)
-        }
+        feature_dict = dfextract_raw_features(y, sr)
 
         for k in feature_dict:
             feature_dict[k] = dfpad_or_resize(feature_dict[k], target_shape)
@@ -59,15 +143,100 @@ def dfextract_features_from_audio(y, sr, target_shape=(128, 259)):
         return None
 
 
+def dfextract_pooled_features_from_audio(y, sr, target_shape=(128, 259)):
+    # Fast path for AudioDeepfakeFusionModel.forward_pooled: only mfcc keeps its padded 2-D shape,
+    # the other nine features go straight to their time-pooled (1, 128) vectors
+    try:
+        feature_dict = dfextract_raw_features(y, sr)
 
+        for k in feature_dict:
+            if k == "mfcc":
+                feature_dict[k] = dfpad_or_resize(feature_dict[k], target_shape)
+            else:
+                feature_dict[k] = dfpooled_or_resize(feature_dict[k], target_shape)
 
+        return feature_dict
 
+    except Exception as e:
+        print(f"[ERROR] Feature extraction failed: {e}")
+        return None
 
 
+def dfwaveform_features(y, sr=22050, target_duration=6.0, target_shape=(128, 259), pooled=False):
+    # Preprocess + feature extraction for an already decoded waveform
+    with stage_timer("preprocess"):
+        y = dfpreprocess_audio(y, sr=sr, target_duration=target_duration, apply_preemphasis=False, coef=0.5, normalise='rms')
+    with stage_timer("feature_extraction"):
+        if pooled:
+            return dfextract_pooled_features_from_audio(y, sr, target_shape=target_shape)
+        return dfextract_features_from_audio(y, sr, target_shape=target_shape)
+
+
+def dfload_features(audio, sr=22050, target_duration=6.0, target_shape=(128, 259), pooled=False):
+    # Full load -> preprocess -> feature pipeline as one picklable call, so it can run in a worker pool.
+    # audio is either a file path or the raw bytes of an uploaded file
+    if isinstance(audio, (bytes, bytearray)):
+        audio = io.BytesIO(audio)
+    with stage_timer("decode"):
+        y, sr = librosa.load(audio, sr=sr)
+    return dfwaveform_features(y, sr, target_duration=target_duration, target_shape=target_shape, pooled=pooled)
+
+
+def dfextract_windowed_features(y, sr=22050, window_duration=6.0, hop_duration=3.0, target_shape=(128, 259), pooled=False):
+    # Scores a recording longer than one 6 s window: it is split into overlapping windows that
+    # are returned as one (B, ...) batch. The STFT and the frame-wise features (tonnetz, pitch,
+    # zcr, rms) are computed once over the whole recording and sliced per window, so overlapping
+    # frames are never recomputed. Window starts are whole hops apart so frames line up.
+    # Each window gets the same RMS normalisation dfpreprocess_audio applies to a single clip,
+    # applied as a gain on its slice of frames. Spans are (start, end) seconds in the input y,
+    # leading silence that trim removes included.
+    try:
+        y, (offset, _) = librosa.effects.trim(y)
+        length = len(y)
+
+        window = int(sr * window_duration)
+        hop_frames = max(1, int(round(hop_duration * sr / DF_HOP_LENGTH)))
+        hop = hop_frames * DF_HOP_LENGTH
+        n_windows = 1 if length <= window else 1 + int(np.ceil((length - window) / hop))
+        n_frames = 1 + window // DF_HOP_LENGTH
+
+        # Zero-pad the tail so the last window is full length, like a short single clip
+        total = (n_windows - 1) * hop + window
+        if length < total:
+            y = np.pad(y, (0, total - length))
+
+        frames = dfcompute_spectral_frames(y)
+        tonnetz = librosa.feature.tonnetz(y=_dfharmonic(y, frames["stft"]), sr=sr)
+        pitch = librosa.yin(y, fmin=50, fmax=300, sr=sr).reshape(1, -1)
+        energy = librosa.feature.rms(y=y)
+        zcr = librosa.feature.zero_crossing_rate(y)
+
+        resize = dfpooled_or_resize if pooled else dfpad_or_resize
+        windows, spans = [], []
+        for i in range(n_windows):
+            start = i * hop
+            segment = y[start:min(start + window, length)]
+            rms = np.sqrt(np.mean(segment ** 2)) if segment.size else 0.0
+            gain = 1.0 / (rms + 1e-6)
+
+            cols = slice(i * hop_frames, i * hop_frames + n_frames)
+            raw = _dfspectral_features(frames["magnitude"][:, cols] * gain, frames["power"][:, cols] * gain ** 2, sr)
+            raw.update({
+                "tonnetz": tonnetz[:, cols],
+                "pitch": pitch[:, cols],
+                "energy": energy[:, cols] * gain,
+                "zcr": zcr[:, cols],
+            })
+
+            windows.append({
+                k: dfpad_or_resize(raw[k], target_shape) if k == "mfcc" else resize(raw[k], target_shape)
+                for k in DF_FEATURE_ORDER
+            })
+            spans.append(((offset + start) / sr, (offset + min(start + window, length)) / sr))
+
+        batch = {k: torch.cat([w[k] for w in windows], dim=0) for k in DF_FEATURE_ORDER}
+        return batch, spans
 
-
-
-
-
-
-
+    except Exception as e:
+        print(f"[ERROR] Windowed feature extraction failed: {e}")
+        return None
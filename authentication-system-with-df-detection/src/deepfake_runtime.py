@@ -0,0 +1,165 @@
+"""
+CPU serving runtimes for AudioDeepfakeFusionModel.
+
+- eager:       the fp32 PyTorch model loaded from df_model.pth (what the server always used)
+- int8:        dynamic int8 quantisation of every Linear layer, applied at load time
+- torchscript: a pre-built artifact (int8 + traced with fixed input shapes) loaded with torch.jit.load
+
+Build the artifact and the parity / latency / memory report with:
+
+    python -m src.deepfake_runtime --out src/pth_models/df_model_int8.pt --report df_runtime_report.json
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from src.deepfake_audio import AudioDeepfakeFusionModel
+
+DF_NUM_INPUTS = 10
+DF_INPUT_SHAPE = (128, 259)
+DEFAULT_PTH = os.path.join(os.path.dirname(__file__), "pth_models", "df_model.pth")
+DEFAULT_ARTIFACT = os.path.join(os.path.dirname(__file__), "pth_models", "df_model_int8.pt")
+
+
+def load_fp32_model(pth_path=DEFAULT_PTH):
+    model = AudioDeepfakeFusionModel()
+    if pth_path is not None:
+        model.load_state_dict(torch.load(pth_path, map_location=torch.device('cpu'), weights_only=True))
+    model.eval()
+    return model
+
+
+def quantize_model(model):
+    # Weights of every Linear (incl. the 262144x128 MFCC fc) stored as int8, activations quantised on the fly
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def example_inputs(batch_size=1):
+    return tuple(torch.zeros(batch_size, *DF_INPUT_SHAPE) for _ in range(DF_NUM_INPUTS))
+
+
+def example_pooled_inputs(batch_size=1):
+    # forward_pooled: 2-D mfcc plus nine (B, 128) pooled vectors
+    return (torch.zeros(batch_size, *DF_INPUT_SHAPE),) + tuple(
+        torch.zeros(batch_size, DF_INPUT_SHAPE[0]) for _ in range(DF_NUM_INPUTS - 1)
+    )
+
+
+def export_torchscript(model, path, batch_size=1):
+    # forward and forward_pooled traced with fixed input shapes and frozen so constants are folded
+    with torch.no_grad():
+        traced = torch.jit.trace_module(model, {
+            "forward": example_inputs(batch_size),
+            "forward_pooled": example_pooled_inputs(batch_size),
+        })
+        traced = torch.jit.freeze(traced, preserved_attrs=["forward_pooled"])
+    traced.save(path)
+    return traced
+
+
+def load_runtime(mode="eager", pth_path=DEFAULT_PTH, artifact_path=DEFAULT_ARTIFACT):
+    if mode == "eager":
+        return load_fp32_model(pth_path)
+    if mode == "int8":
+        return quantize_model(load_fp32_model(pth_path))
+    if mode == "torchscript":
+        model = torch.jit.load(artifact_path, map_location="cpu")
+        model.eval()
+        return model
+    raise ValueError(f"Unknown deepfake runtime '{mode}', expected eager, int8 or torchscript")
+
+
+def serialized_size(model):
+    # Size of the weights as saved, a proxy for the resident memory they take per worker
+    buffer = io.BytesIO()
+    if isinstance(model, torch.jit.ScriptModule):
+        torch.jit.save(model, buffer)
+    else:
+        torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def time_model(model, inputs, repeats=20):
+    with torch.no_grad():
+        model(*inputs)
+        times = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            model(*inputs)
+            times.append(1000 * (time.perf_counter() - started))
+    return {"median_ms": float(np.median(times)), "p95_ms": float(np.percentile(times, 95))}
+
+
+def compare_models(reference, candidate, samples, batch_sizes=(1, 8), repeats=20):
+    # samples: list of input tuples, each (1, 128, 259) x 10
+    with torch.no_grad():
+        ref = torch.cat([reference(*x) for x in samples]).view(-1)
+        cand = torch.cat([candidate(*x) for x in samples]).view(-1)
+
+    report = {
+        "samples": len(samples),
+        "max_abs_diff": float((ref - cand).abs().max()),
+        "mean_abs_diff": float((ref - cand).abs().mean()),
+        "label_agreement": float(((ref >= 0.5) == (cand >= 0.5)).float().mean()),
+        "size_bytes": {"reference": serialized_size(reference), "candidate": serialized_size(candidate)},
+        "latency": {},
+    }
+    for batch_size in batch_sizes:
+        inputs = tuple(torch.cat([samples[i % len(samples)][k] for i in range(batch_size)]) for k in range(DF_NUM_INPUTS))
+        report["latency"][f"batch_{batch_size}"] = {
+            "reference": time_model(reference, inputs, repeats),
+            "candidate": time_model(candidate, inputs, repeats),
+        }
+    return report
+
+
+def load_samples(audio_dir=None, count=16, seed=0):
+    # Real clips give a meaningful parity check, random features are the offline fallback
+    if audio_dir:
+        from src.deepfake_preprocess_audio import DF_FEATURE_ORDER, dfload_features
+
+        samples = []
+        for name in sorted(os.listdir(audio_dir))[:count]:
+            features = dfload_features(os.path.join(audio_dir, name))
+            if features is not None:
+                samples.append(tuple(features[k] for k in DF_FEATURE_ORDER))
+        return samples
+
+    generator = torch.Generator().manual_seed(seed)
+    return [tuple(torch.randn(1, *DF_INPUT_SHAPE, generator=generator) for _ in range(DF_NUM_INPUTS)) for _ in range(count)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build and validate the int8 TorchScript deepfake model")
+    parser.add_argument("--pth", default=DEFAULT_PTH, help="fp32 checkpoint (random weights if missing)")
+    parser.add_argument("--out", default=DEFAULT_ARTIFACT, help="where to write the TorchScript artifact")
+    parser.add_argument("--audio-dir", default=None, help="directory of clips for the parity check")
+    parser.add_argument("--samples", type=int, default=16)
+    parser.add_argument("--tolerance", type=float, default=0.02, help="max allowed probability difference")
+    parser.add_argument("--report", default=None, help="write the JSON report here")
+    args = parser.parse_args(argv)
+
+    reference = load_fp32_model(args.pth if os.path.exists(args.pth) else None)
+    candidate = export_torchscript(quantize_model(reference), args.out)
+
+    report = compare_models(reference, candidate, load_samples(args.audio_dir, args.samples))
+    report["artifact"] = args.out
+    report["parity_ok"] = report["max_abs_diff"] <= args.tolerance
+
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0 if report["parity_ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class EmbeddingCache:
+    # In-process cache of enrolled speaker embeddings keyed by uid, with the sample rate each was enrolled at.
+    # Embeddings are stored as contiguous float32 arrays, entries expire after ttl_seconds
+    # and the least recently used entry is evicted once max_entries is reached.
+
+    def __init__(self, max_entries=10000, ttl_seconds=300.0):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = float(ttl_seconds)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, uid):
+        template = self.get_template(uid)
+        return None if template is None else template[0]
+
+    def get_template(self, uid):
+        # (embedding, sample rate) or None
+        with self._lock:
+            entry = self._entries.get(uid)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            embedding, stored_at, sample_rate = entry
+            if self.ttl > 0 and time.monotonic() - stored_at > self.ttl:
+                del self._entries[uid]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(uid)
+            self.hits += 1
+            return embedding, sample_rate
+
+    def put(self, uid, embedding, sample_rate=None):
+        embedding = np.array(embedding, dtype=np.float32)
+        # Cached arrays are shared between requests, so don't let anyone modify them in place
+        embedding.flags.writeable = False
+
+        with self._lock:
+            self._entries[uid] = (embedding, time.monotonic(), sample_rate)
+            self._entries.move_to_end(uid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return embedding
+
+    def invalidate(self, uid):
+        with self._lock:
+            return self._entries.pop(uid, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+import torch
+
+from src.metrics import metrics, stage_timer
+
+BATCH_SIZE = metrics.histogram(
+    "audioshield_deepfake_batch_size", "Clips per batched deepfake forward pass", buckets=(1, 2, 4, 8, 16, 32)
+)
+
+
+class DeepfakeBatcher:
+    # Collects single-clip feature tensors from concurrent requests and runs them
+    # through AudioDeepfakeFusionModel as one batch.
+    # A batch is flushed when it reaches max_batch_size or when the oldest request
+    # has waited max_wait_ms, whichever comes first.
+    # get_model is called for every batch, so the model can be loaded lazily.
+    # run_forward(fn, batch) awaits fn(batch) somewhere off the event loop, e.g. in a worker pool
+    # stage with its own thread budget; the loop's default executor otherwise.
+
+    def __init__(self, get_model, max_batch_size=8, max_wait_ms=10.0, run_forward=None):
+        self.get_model = get_model
+        self.run_forward = run_forward
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = None
+        self._worker = None
+
+        # Running stats
+        self._batches = 0
+        self._items = 0
+        self._batch_size_counts = {}
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._forward_total = 0.0
+
+    def _ensure_worker(self):
+        # The queue and worker task are bound to the running event loop, so create them lazily
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, inputs):
+        # inputs: ordered list of (1, ...) tensors, one per model argument
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((inputs, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self):
+        # Block for the first item, then keep pulling until the batch is full or the deadline passes
+        batch = [await self._queue.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _forward(self, batch):
+        # Stack each model argument along the batch dimension
+        stacked = [torch.cat(tensors, dim=0) for tensors in zip(*(item[0] for item in batch))]
+        BATCH_SIZE.observe(len(batch))
+        with torch.no_grad(), stage_timer("deepfake_forward"):
+            return self.get_model()(*stacked).view(-1).tolist()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            started = time.perf_counter()
+            for _, _, enqueued in batch:
+                waited = started - enqueued
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+
+            try:
+                # Run the forward pass off the event loop so other requests keep being served
+                if self.run_forward is not None:
+                    probs = await self.run_forward(self._forward, batch)
+                else:
+                    probs = await loop.run_in_executor(None, self._forward, batch)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self._forward_total += time.perf_counter() - started
+            self._batches += 1
+            self._items += len(batch)
+            self._batch_size_counts[len(batch)] = self._batch_size_counts.get(len(batch), 0) + 1
+
+            # Hand each caller back its own probability
+            for (_, future, _), prob in zip(batch, probs):
+                if not future.done():
+                    future.set_result(prob)
+
+    def stats(self):
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "batches": self._batches,
+            "requests": self._items,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "mean_batch_size": self._items / self._batches if self._batches else 0.0,
+            "batch_size_counts": dict(sorted(self._batch_size_counts.items())),
+            "mean_queue_wait_ms": 1000.0 * self._wait_total / self._items if self._items else 0.0,
+            "max_queue_wait_ms": 1000.0 * self._wait_max,
+            "mean_forward_ms": 1000.0 * self._forward_total / self._batches if self._batches else 0.0,
+        }
@@ -4,35 +4,46 @@ Main FastAPI server for the Audio Shield project.
 This server handles:
 - Real-time recording and transcription (Whisper)
 - Deepfake detection via a fusion model
-- Voice authentication using speaker embeddings (speechbrains pre trained model - spkrec-ecapa-voxceleb)
+- Voice authentication using speaker embeddings (speechbrains pre trained model - spkrec-ecapa-voxceleb,
+  or the voice_audio fusion model, chosen with SPEAKER_BACKEND)
 - Email verification and Firebase integration
 - Audio preprocessing, conversion, and feature extraction
 
 """
 
 # FastAPI core
-from fastapi import FastAPI, Query, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, Query, File, UploadFile, Form, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi import Request
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.middleware import SlowAPIMiddleware
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
+from limits import parse as parse_rate_limit
+from src.rate_limit_storage import SHARED_RATE_LIMIT_URI  # also registers the sqlite:// limiter storage
+from src.shared_weights import SHARED_MODEL_WEIGHTS, file_tag, load_shared_module
+import os
 
 
 
 
 # 2) Initialize the Limiter, telling it to use Redis storage
+# memory:// is per process, so with several workers (SHARED_MODEL_WEIGHTS=1) the counters go in a
+# SQLite file every worker on the host shares instead; RATE_LIMIT_STORAGE_URI overrides either
 limiter = Limiter(
     key_func=get_remote_address,
-    storage_uri="memory://"
+    storage_uri=os.environ.get(
+        "RATE_LIMIT_STORAGE_URI",
+        SHARED_RATE_LIMIT_URI if SHARED_MODEL_WEIGHTS else "memory://",
+    )
     #using memory as its a local proof of cooncept so need need to use redis
 
 )
 
 # Whisper & Audio I/O
 import whisper
+from src.whisper_verify import PassphraseVerifier
 import sounddevice as sd
 import librosa
 import io
@@ -46,44 +57,92 @@ import torchaudio
 
 # Firebase
 import firebase_admin
-from firebase_admin import credentials, firestore,initialize_app
+from firebase_admin import auth as firebase_auth, credentials, firestore,initialize_app
 
 # Deepfake detection
 from src.deepfake_audio import AudioDeepfakeFusionModel
-from src.deepfake_preprocess_audio import dfextract_features_from_audio, dfpreprocess_audio
+from src.deepfake_preprocess_audio import dfextract_features_from_audio, dfpreprocess_audio, dfwaveform_features, DF_FEATURE_ORDER
+from src.deepfake_preprocess_audio import dfextract_windowed_features
+from src.deepfake_runtime import load_runtime, DEFAULT_ARTIFACT
+from src.inference_batcher import DeepfakeBatcher
+
+# Worker pool for blocking stages
+from src.worker_pool import StageExecutor, StageTimeout, server_stage_configs
+from src.thread_budget import configure_process_threads, plan_stage_budgets
+from src.admission import AdmissionController, Overloaded, lane_config_from_env, with_priority
+from src.admission import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
 
 # Speaker verification
 from scipy.spatial.distance import cosine
+from src.embedding_cache import EmbeddingCache
+from src.speaker_backends import configured_backend
+from src.speaker_index import SpeakerIndex, claim_save_lock
 
 # Audio format conversion
 from pydub import AudioSegment
+from src.audio_decode import decode_audio_bytes, resample_audio, StreamingDecoder, AudioDecodeError
+from src.audio_cache import AudioArtifactCache, content_key
+from src.audio_quality import AudioQualityError, QUALITY_GATE, assess_audio, check_audio, voiced_region, voiced_span
+from src.speech_enhance import NOISE_REDUCTION, NoiseProfileCache, SpectralGate, estimate_noise_profile, reduce_noise
+
+# Model loading
+from src.model_registry import ModelRegistry
+from src.metrics import metrics, stage_timer, timed
+from starlette.routing import Match
 
 # Utilities
 import re
-import os
+from typing import List, Optional
+import time
+import asyncio
 
 
 from dotenv import load_dotenv
 
 load_dotenv(".env.local")  # Load environment variables
 
-if not firebase_admin._apps:
-    private_key = os.environ["FIREBASE_PRIVATE_KEY"].replace("\\n", "\n")
-
-    cred = credentials.Certificate({
-        "type": "service_account",
-        "project_id": os.environ["FIREBASE_PROJECT_ID"],
-        "private_key_id": os.environ["FIREBASE_PRIVATE_KEY_ID"],
-        "private_key": private_key,
-        "client_email": os.environ["FIREBASE_CLIENT_EMAIL"],
-        "client_id": os.environ["FIREBASE_CLIENT_ID"],
-        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-        "token_uri": "https://oauth2.googleapis.com/token",
-        "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-        "client_x509_cert_url": f"https://www.googleapis.com/robot/v1/metadata/x509/{os.environ['FIREBASE_CLIENT_EMAIL'].replace('@', '%40')}"
-    })
-
-    initialize_app(cred)
+# Models and Firebase are loaded on first use or by the background warm-up, not at import
+registry = ModelRegistry()
+
+def init_firebase():
+    if not firebase_admin._apps:
+        private_key = os.environ["FIREBASE_PRIVATE_KEY"].replace("\\n", "\n")
+
+        cred = credentials.Certificate({
+            "type": "service_account",
+            "project_id": os.environ["FIREBASE_PROJECT_ID"],
+            "private_key_id": os.environ["FIREBASE_PRIVATE_KEY_ID"],
+            "private_key": private_key,
+            "client_email": os.environ["FIREBASE_CLIENT_EMAIL"],
+            "client_id": os.environ["FIREBASE_CLIENT_ID"],
+            "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+            "token_uri": "https://oauth2.googleapis.com/token",
+            "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
+            "client_x509_cert_url": f"https://www.googleapis.com/robot/v1/metadata/x509/{os.environ['FIREBASE_CLIENT_EMAIL'].replace('@', '%40')}"
+        })
+
+        initialize_app(cred)
+    return firebase_admin.get_app()
+
+registry.register("firebase", init_firebase)
+
+# One Firestore client for the process instead of one per request
+def load_firestore():
+    registry.get("firebase")
+    return firestore.client()
+
+registry.register("firestore", load_firestore)
+
+# uid of the Firebase ID token in the Authorization: Bearer header, None without a valid one.
+# Needed wherever the server writes user data itself, since the admin SDK bypasses the Firestore rules
+def verified_uid(request: Request):
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return firebase_auth.verify_id_token(token, app=registry.get("firebase"))["uid"]
+    except Exception:
+        return None
 
 
 #FastAPI App Setup 
@@ -94,14 +153,244 @@ app = FastAPI()
 app.state.limiter = limiter
 app.add_middleware(SlowAPIMiddleware)
 
+# Request metrics, exported on /metrics in Prometheus text format (METRICS_ENABLED=0 turns them off)
+REQUESTS = metrics.counter("audioshield_requests_total", "HTTP requests by endpoint and status", ("method", "endpoint", "status"))
+REQUEST_SECONDS = metrics.histogram("audioshield_request_duration_seconds", "HTTP request latency", ("method", "endpoint"))
+REQUESTS_IN_FLIGHT = metrics.gauge("audioshield_requests_in_flight", "HTTP requests currently being served", ("endpoint",))
+RATE_LIMITED = metrics.counter("audioshield_rate_limited_total", "Requests rejected by the rate limiter", ("endpoint",))
+QUALITY_ISSUES = metrics.counter("audioshield_quality_issues_total", "Uploads the audio quality gate rejected or flagged", ("issue", "action"))
+
+def endpoint_label(request: Request) -> str:
+    # Route template rather than the raw path, so unknown URLs can't blow up the label set
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+if metrics.enabled:
+    @app.middleware("http")
+    async def record_request_metrics(request: Request, call_next):
+        endpoint = endpoint_label(request)
+        REQUESTS_IN_FLIGHT.inc(endpoint)
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, request.method, endpoint)
+            REQUESTS.inc(request.method, endpoint, str(status))
+            REQUESTS_IN_FLIGHT.dec(endpoint)
+
 # Override the default 429 handler to return JSON
 @app.exception_handler(RateLimitExceeded)
 async def ratelimit_handler(request: Request, exc: RateLimitExceeded):
+    RATE_LIMITED.inc(endpoint_label(request))
     return JSONResponse(
         status_code=429,
         content={"detail": "Rate limit exceeded. Try again later."}
     )
 
+# A stage that runs past its timeout returns 504 instead of hanging the request
+@app.exception_handler(StageTimeout)
+async def stage_timeout_handler(request: Request, exc: StageTimeout):
+    return JSONResponse(status_code=504, content={"detail": str(exc)})
+
+# Blocking audio/model/Firestore work is dispatched here so the event loop stays responsive.
+# Per-stage limits and timeouts (defaults in worker_pool.server_stage_configs) can be overridden with
+# STAGE_<NAME>_LIMIT / _TIMEOUT / _POOL.
+# THREAD_BUDGET_MODE=budget|pinned gives every stage its own torch thread count (and core set), so
+# Whisper, the deepfake model, the speaker model and librosa don't oversubscribe the CPUs; per-stage
+# overrides are STAGE_<NAME>_THREADS / _CORES, see src/thread_budget.py and src.benchmark_threads
+configure_process_threads()
+stage_pool = StageExecutor(
+    stages=plan_stage_budgets(server_stage_configs()),
+    thread_workers=int(os.environ.get("STAGE_THREAD_WORKERS", os.cpu_count() or 4)),
+    process_workers=int(os.environ.get("STAGE_PROCESS_WORKERS", "0")),
+)
+
+@app.on_event("shutdown")
+def shutdown_stage_pool():
+    stage_pool.shutdown()
+
+# Admission control in front of the models, on top of the per-IP rate limits: each model lane runs a
+# bounded number of requests, queues a bounded number more by priority (logins before dashboard
+# analysis) and sheds the rest with a 503 and Retry-After instead of letting every request time out.
+# Per-lane settings can be overridden with ADMIT_<LANE>_CONCURRENCY / _QUEUE / _MAX_WAIT
+admission = AdmissionController(
+    lanes={
+        "whisper": lane_config_from_env("whisper", concurrency=1, queue_size=8, max_wait=20),
+        # Enough concurrency for the deepfake batcher to fill its batches
+        "deepfake": lane_config_from_env("deepfake", concurrency=8, queue_size=32, max_wait=10),
+        "speaker": lane_config_from_env("speaker", concurrency=4, queue_size=32, max_wait=5),
+    },
+    enabled=os.environ.get("ADMISSION_CONTROL", "1") != "0",
+)
+
+def overloaded_response(e: Overloaded):
+    return JSONResponse(
+        status_code=503,
+        content={"error": str(e), "lane": e.lane, "reason": e.reason, "retry_after": e.retry_after},
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return overloaded_response(exc)
+
+@app.get("/admission-stats/")
+async def admission_stats():
+    return admission.stats()
+
+# Decoded waveforms, deepfake features and speaker embeddings keyed by a hash of the uploaded bytes,
+# so retries and the same clip sent to several endpoints are only processed once
+audio_cache = AudioArtifactCache(
+    max_entries=int(os.environ.get("AUDIO_CACHE_SIZE", "512")),
+    max_bytes=int(float(os.environ.get("AUDIO_CACHE_MAX_MB", "256")) * 1024 * 1024),
+)
+
+async def cached_decode(data: bytes, sr: int = 22050, max_duration: float = None, key: str = None):
+    key = key or content_key(data)
+    y = audio_cache.get("waveform", key, (sr, max_duration))
+    if y is not None:
+        return y
+
+    # A full decode of the same upload already holds the truncated one as a prefix
+    if max_duration is not None:
+        full = audio_cache.peek("waveform", key, (sr, None))
+        if full is not None:
+            return full[:int(sr * max_duration)]
+
+    y = await stage_pool.run("decode", decode_audio_bytes, data, sr, max_duration)
+    return audio_cache.put("waveform", key, (sr, max_duration), y)
+
+# A 22.05 kHz decode of the upload resampled to sr, shared by Whisper and the speaker model when both run at 16 kHz
+async def cached_resample(y, key: str, sr: int):
+    resampled = audio_cache.get("waveform", key, ("resampled", sr))
+    if resampled is None:
+        resampled = await stage_pool.run("decode", resample_audio, y, 22050, sr)
+        resampled = audio_cache.put("waveform", key, ("resampled", sr), resampled)
+    return resampled
+
+# Cheap quality gate in front of every model (see src/audio_quality.py): silent, clipped or too short
+# recordings are rejected before Whisper, the deepfake features or the speaker model run, and only
+# the voiced region is passed on. Returns (voiced waveform, report or None)
+def gate_audio(y, sr: int):
+    try:
+        y, report = check_audio(y, sr)
+    except AudioQualityError as e:
+        for issue in e.report["issues"]:
+            QUALITY_ISSUES.inc(issue, "rejected")
+        raise
+    if report is not None:
+        for issue in report["issues"]:
+            QUALITY_ISSUES.inc(issue, "flagged")
+    return y, report
+
+# Cache key for artifacts computed on the voiced region of an upload rather than the whole of it
+def voiced_key(key: str, report):
+    if key is None or report is None:
+        return key
+    start, end = report["voiced"]
+    return f"{key}:{start}-{end}"
+
+def quality_rejected(e: AudioQualityError):
+    return JSONResponse(content=e.content(), status_code=422)
+
+# In QUALITY_GATE=flag mode the issues found are returned alongside the result
+def with_quality(result, report):
+    if report is not None and not report["ok"] and isinstance(result, dict):
+        result["quality"] = report
+    return result
+
+# Spectral gating for noisy microphones (see src/speech_enhance.py) on what Whisper and the speaker
+# model hear, the deepfake model always gets the audio as recorded. The noise profile is estimated
+# from the untrimmed recording, so the silence the quality gate cut away counts too. For a caller with
+# a Firebase ID token it is cached per user and X-Device-Id header and reused for the next recordings;
+# an unauthenticated uid is never a cache key, or anyone could plant a profile for someone else
+noise_profiles = NoiseProfileCache(
+    max_entries=int(os.environ.get("NOISE_PROFILE_CACHE_SIZE", "10000")),
+    ttl_seconds=float(os.environ.get("NOISE_PROFILE_TTL", "900")),
+)
+
+async def noise_device(request: Request, uid: str = None):
+    if NOISE_REDUCTION != "on" or "authorization" not in request.headers:
+        return None
+    token_uid = await stage_pool.run("firestore", verified_uid, request)
+    if token_uid is None or (uid and token_uid != uid):
+        return None
+    return f"{token_uid}:{request.headers.get('x-device-id', '')}"
+
+# (gated y, cache key for what is computed on it); source is the untrimmed recording y was cut from
+async def denoise(y, sr: int, device: str = None, key: str = None, source=None):
+    if NOISE_REDUCTION != "on":
+        return y, key
+    profile = noise_profiles.get((device, sr)) if device else None
+    if profile is None:
+        profile = await stage_pool.run("features", estimate_noise_profile, y if source is None else source, sr)
+        if device:
+            noise_profiles.put((device, sr), profile)
+    y, _ = await stage_pool.run("features", reduce_noise, y, sr, profile)
+    return y, (f"{key}:nr-{profile.tag()}" if key else key)
+
+@app.get("/noise-profile-stats/")
+async def noise_profile_stats():
+    return noise_profiles.stats()
+
+@timed("upload_read")
+async def read_upload(file: UploadFile) -> bytes:
+    return await file.read()
+
+# Load and prime every model in the background so the first requests don't pay for it
+@app.on_event("startup")
+async def start_model_warmup():
+    if os.environ.get("MODEL_WARMUP", "1") != "0":
+        app.state.warmup_task = asyncio.create_task(registry.warm_up())
+
+#Liveness: the process is up and serving
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok", "models": registry.status()}
+
+#Readiness: every model is loaded and warmed, safe to route traffic here
+@app.get("/readyz")
+async def readyz():
+    ready = registry.ready()
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready": ready, "models": registry.status()},
+    )
+
+MODEL_LOAD_SECONDS = metrics.gauge("audioshield_model_load_seconds", "Time taken to load each model", ("model",))
+MODEL_WARMUP_SECONDS = metrics.gauge("audioshield_model_warmup_seconds", "Time taken by each model's warm-up inference", ("model",))
+MODEL_READY = metrics.gauge("audioshield_model_ready", "1 once a model is loaded and warmed", ("model",))
+CACHE_HITS = metrics.counter("audioshield_cache_hits_total", "Lookups served from an in-process cache", ("cache",))
+CACHE_MISSES = metrics.counter("audioshield_cache_misses_total", "Lookups that missed an in-process cache", ("cache",))
+CACHE_ENTRIES = metrics.gauge("audioshield_cache_entries", "Entries held by an in-process cache", ("cache",))
+
+#Prometheus scrape endpoint
+@app.get("/metrics")
+async def metrics_endpoint():
+    if not metrics.enabled:
+        return PlainTextResponse("Metrics are disabled (METRICS_ENABLED=0).\n", status_code=404)
+
+    # Model and cache state is read at scrape time instead of being tracked on every call
+    for name, status in registry.status().items():
+        MODEL_READY.set(status["state"] == "ready", name)
+        if status["load_seconds"] is not None:
+            MODEL_LOAD_SECONDS.set(status["load_seconds"], name)
+        if status["warmup_seconds"] is not None:
+            MODEL_WARMUP_SECONDS.set(status["warmup_seconds"], name)
+    for name, cache in (("audio", audio_cache), ("embedding", embedding_cache)):
+        stats = cache.stats()
+        CACHE_HITS.set(stats["hits"], name)
+        CACHE_MISSES.set(stats["misses"], name)
+        CACHE_ENTRIES.set(stats["size"], name)
+
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # Allow frontend access (adjust origins in prod)
 app.add_middleware(
     CORSMiddleware,
@@ -112,13 +401,73 @@ app.add_middleware(
 )
 
 # Load Whisper transcription model, you can this if transcribing isnt good enough,
-#("ting","base","small","medium" and "large")
-model = whisper.load_model("medium")
+#("tiny","base","small","medium" and "large"), set with WHISPER_MODEL
+WHISPER_SAMPLE_RATE = whisper.audio.SAMPLE_RATE
+
+# "verify" scores the known passphrase with a bounded, fixed-language decode,
+# "transcribe" runs the full open-ended transcription and a substring check
+WHISPER_PASSPHRASE_MODE = os.environ.get("WHISPER_PASSPHRASE_MODE", "verify")
+
+def load_whisper():
+    name = os.environ.get("WHISPER_MODEL", "medium")
+    if SHARED_MODEL_WEIGHTS:
+        model = load_shared_whisper(name)
+    else:
+        model = whisper.load_model(name)
+    # The verifier shares the loaded model and is built alongside it
+    model.passphrase_verifier = PassphraseVerifier(
+        model,
+        language=os.environ.get("WHISPER_LANGUAGE", "en"),
+        threshold=float(os.environ.get("WHISPER_VERIFY_THRESHOLD", "0.6")),
+    )
+    return model
+
+def load_shared_whisper(name):
+    def materialize():
+        model = whisper.load_model(name, device="cpu")
+        return model, {"dims": vars(model.dims)}
+
+    tag = file_tag(name) if os.path.isfile(name) else name
+    return load_shared_module(
+        f"whisper-{os.path.basename(tag)}",
+        lambda meta: whisper.model.Whisper(whisper.model.ModelDimensions(**meta["dims"])),
+        materialize,
+        meta_init=False,
+    )
+
+def warmup_whisper(model):
+    silence = np.zeros(WHISPER_SAMPLE_RATE, dtype=np.float32)
+    if WHISPER_PASSPHRASE_MODE == "verify":
+        model.passphrase_verifier.verify(silence, "warm up")
+    else:
+        model.transcribe(silence)
+
+registry.register("whisper", load_whisper, warmup_whisper)
 
 # Simple preprocessor for comparing text against expected passphrase
 def clean_text(text: str) -> str:
     return re.sub(r"[^\w\s]", "", text).lower().strip()
 
+# Transcribe 16 kHz audio and check it contains the expected passphrase
+async def check_passphrase(audio, passphrase: str):
+    async with admission.slot("whisper"):
+        model = await stage_pool.run("transcribe", registry.get, "whisper")
+        # Whisper wraps the array with torch.from_numpy, which wants it writable (cached audio isn't)
+        if not audio.flags.writeable:
+            audio = audio.copy()
+        if WHISPER_PASSPHRASE_MODE == "verify":
+            return await stage_pool.run("transcribe", model.passphrase_verifier.verify, audio, passphrase)
+
+        result = await stage_pool.run("transcribe", model.transcribe, audio)
+    raw_text = result.get("text", "")
+
+    # clean & compare against expected passphrase
+    cleaned_text = clean_text(raw_text)
+    cleaned_pass = clean_text(passphrase)
+    confirmed = cleaned_pass in cleaned_text
+
+    return {"text": raw_text, "confirmed": confirmed}
+
 #Whisper Transcription Endpoint
 @app.post("/listen/")
 @limiter.limit("10/minute")
@@ -127,70 +476,110 @@ async def listen(
     file: UploadFile = File(...),
     passphrase: str = Query(...)
 ):
+    admission.admit(("whisper",), PRIORITY_NORMAL)
 
-    # 1) save the incoming WebM to a temp file
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as temp_webm:
-        temp_webm.write(await file.read())
-        webm_path = temp_webm.name
-
+    # 1) decode the incoming WebM in memory at Whisper's 16 kHz, keep only the voiced region
+    decoded = await cached_decode(await read_upload(file), WHISPER_SAMPLE_RATE)
     try:
-        # 2) convert WebM → WAV
-        wav_path = convert_webm_to_wav(webm_path)
-
-        # 3) run Whisper transcription
-        result = model.transcribe(wav_path)
-        raw_text = result.get("text", "")
+        audio, report = gate_audio(decoded, WHISPER_SAMPLE_RATE)
+    except AudioQualityError as e:
+        return quality_rejected(e)
+    audio, _ = await denoise(audio, WHISPER_SAMPLE_RATE, await noise_device(request), source=decoded)
 
-        # 4) clean & compare against expected passphrase
-        cleaned_text = clean_text(raw_text)
-        cleaned_pass = clean_text(passphrase)
-        confirmed = cleaned_pass in cleaned_text
-
-        return {"text": raw_text, "confirmed": confirmed}
-    finally:
-        # 5) clean up temp files
-        for p in (webm_path, wav_path):
-            try:
-                os.remove(p)
-            except Exception:
-                pass
+    # 2) run Whisper transcription and compare against the expected passphrase
+    return with_quality(await check_passphrase(audio, passphrase), report)
 
 
 #Deepfake Detection (WAV upload)
-model_df = AudioDeepfakeFusionModel()
 model_path = os.path.join(os.path.dirname(__file__), "pth_models", "df_model.pth")
-model_df.load_state_dict(torch.load(model_path, map_location=torch.device('cpu'),weights_only=True))
-model_df.eval()
 
-@app.post("/predict/")
-@limiter.limit("4/minute")  # Rate limiting to prevent abuse
-async def predict(request: Request, file: UploadFile = File(...)):
-    try:
-        # Read and decode uploaded WAV file
-        audio_bytes = await file.read()
-        y, sr = librosa.load(io.BytesIO(audio_bytes), sr=22050)
+# DF_MODEL_RUNTIME: "eager" (fp32), "int8" (quantised at load) or "torchscript" (prebuilt artifact,
+# see src/deepfake_runtime.py)
+def load_deepfake_model():
+    runtime = os.environ.get("DF_MODEL_RUNTIME", "eager")
+    if SHARED_MODEL_WEIGHTS and runtime == "eager":
+        # int8 repacks and torchscript reloads the weights, so only the fp32 model is shared
+        return load_shared_module(
+            f"deepfake-{file_tag(model_path)}",
+            lambda meta: AudioDeepfakeFusionModel(),
+            lambda: (load_runtime("eager", pth_path=model_path), {}),
+        )
+    return load_runtime(
+        runtime,
+        pth_path=model_path,
+        artifact_path=os.environ.get("DF_MODEL_ARTIFACT", DEFAULT_ARTIFACT),
+    )
 
-        # Preprocess the audio (normalise, trim/pad, etc.)
-        y = dfpreprocess_audio(y, sr=22050, target_duration=6.0, apply_preemphasis=False, coef=0.5, normalise='rms')
+def warmup_deepfake_model(model_df):
+    with torch.no_grad():
+        model_df(*[torch.zeros(1, 128, 259) for _ in DF_FEATURE_ORDER])
 
-        # Extract 10 audio features
-        features = dfextract_features_from_audio(y, sr, target_shape=(128, 259))
-        if features is None:
-            return {"error": "Feature extraction failed."}
+registry.register("deepfake", load_deepfake_model, warmup_deepfake_model)
 
-        # Run the model prediction using the ordered feature inputs
-        inputs = [features[k] for k in [
-            'mfcc', 'chroma', 'tonnetz', 'spectral_contrast', 'pitch',
-            'energy', 'zcr', 'onset_strength', 'spectral_centroid', 'mel_spectrogram'
-        ]]
+# With DF_POOLED_FEATURES the nine 1-D features are pooled during extraction and fed to
+# forward_pooled, instead of being padded to 128x259 and pooled inside the model (same outputs)
+DF_POOLED_FEATURES = os.environ.get("DF_POOLED_FEATURES", "1") != "0"
+
+def get_deepfake_forward():
+    model_df = registry.get("deepfake")
+    return model_df.forward_pooled if DF_POOLED_FEATURES else model_df
 
-        with torch.no_grad():
-            output = model_df(*inputs)
-            prob = output.item()
-            label = "bonafide" if prob >= 0.5 else "spoof"
+# Concurrent deepfake requests share one batched forward pass of at most DF_BATCH_MAX_SIZE inputs
+DF_BATCH_MAX_SIZE = max(1, int(os.environ.get("DF_BATCH_MAX_SIZE", "8")))
 
-        return {"prediction": label, "confidence": round(prob, 2)}
+df_batcher = DeepfakeBatcher(
+    get_deepfake_forward,
+    max_batch_size=DF_BATCH_MAX_SIZE,
+    max_wait_ms=float(os.environ.get("DF_BATCH_MAX_WAIT_MS", "10")),
+    run_forward=lambda fn, batch: stage_pool.run("deepfake_model", fn, batch),
+)
+
+# Decode cutoff for the deepfake path: the 6 s window plus headroom for leading silence that trim removes
+DF_DECODE_MAX_SECONDS = float(os.environ.get("DF_DECODE_MAX_SECONDS", "8"))
+
+async def predict_deepfake(features):
+    prob = await df_batcher.submit([features[k] for k in DF_FEATURE_ORDER])
+    label = "bonafide" if prob >= 0.5 else "spoof"
+    return {"prediction": label, "confidence": round(prob, 2)}
+
+# Preprocess a decoded 22.05 kHz waveform, extract features and score it, None if extraction fails.
+# key is the content key of the upload y was decoded from, the features are then cached
+async def score_deepfake(y, key: str = None):
+    params = (22050, len(y), DF_POOLED_FEATURES)
+    features = audio_cache.get("features", key, params) if key else None
+    async with admission.slot("deepfake"):
+        if features is None:
+            features = await stage_pool.run("features", dfwaveform_features, y, 22050, 6.0, (128, 259), DF_POOLED_FEATURES)
+            if features is None:
+                return None
+            if key:
+                audio_cache.put("features", key, params, features)
+        return await predict_deepfake(features)
+
+
+@app.post("/predict/")
+@limiter.limit("4/minute")  # Rate limiting to prevent abuse
+async def predict(request: Request, file: UploadFile = File(...)):
+    admission.admit(("deepfake",), PRIORITY_LOW)
+    try:
+        # Decode the uploaded WAV file and gate it before preprocessing (normalise, trim/pad, etc.)
+        # and extracting the 10 audio features in the worker pool
+        audio_bytes = await read_upload(file)
+        key = content_key(audio_bytes)
+        y, report = gate_audio(await cached_decode(audio_bytes, 22050, key=key), 22050)
 
+        # Run the model prediction using the ordered feature inputs
+        result = await score_deepfake(y, voiced_key(key, report))
+        if result is None:
+            return {"error": "Feature extraction failed."}
+        return with_quality(result, report)
+
+    except AudioQualityError as e:
+        return quality_rejected(e)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except StageTimeout as e:
+        return JSONResponse(content={"error": str(e)}, status_code=504)
     except Exception as e:
         return {"error": f"Prediction failed: {str(e)}"}
 
@@ -199,44 +588,160 @@ async def predict(request: Request, file: UploadFile = File(...)):
 @app.post("/deepfake-auth-predict/")
 @limiter.limit("10/minute")
 async def deepfake_auth_predict(request: Request, file: UploadFile = File(...)):
+    admission.admit(("deepfake",), PRIORITY_NORMAL)
     try:
-        # Save uploaded WEBM file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as temp_webm:
-            temp_webm.write(await file.read())
-            webm_path = temp_webm.name
-
-        # Convert to WAV
-        wav_path = convert_webm_to_wav(webm_path)
-
-        # Preprocess audio
-        y, sr = librosa.load(wav_path, sr=22050)
-        y = dfpreprocess_audio(y, sr=sr, target_duration=6.0, apply_preemphasis=False, coef=0.5, normalise="rms")
-        features = dfextract_features_from_audio(y, sr, target_shape=(128, 259))
-        if features is None:
+        # Decode uploaded WEBM in memory, only as much as the 6 s window needs
+        data = await read_upload(file)
+        key = content_key(data)
+        y = await cached_decode(data, 22050, DF_DECODE_MAX_SECONDS, key)
+        y, report = gate_audio(y, 22050)
+
+        # Preprocess audio, extract features and run prediction
+        result = await score_deepfake(y, voiced_key(key, report))
+        if result is None:
             return {"error": "Feature extraction failed."}
+        return with_quality(result, report)
+    except AudioQualityError as e:
+        return quality_rejected(e)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except StageTimeout as e:
+        return JSONResponse(content={"error": str(e)}, status_code=504)
+    except Exception as e:
+        return JSONResponse(content={"error": f"Deepfake auth prediction failed: {str(e)}"}, status_code=500)
 
-        # Run prediction
-        inputs = [features[k] for k in features]
-        with torch.no_grad():
-            output = model_df(*inputs)
-            prob = output.item()
-            label = "bonafide" if prob >= 0.5 else "spoof"
 
-        return {"prediction": label, "confidence": round(prob, 2)}
+#Deepfake Detection over a whole recording (any length, scored in overlapping 6 s windows)
+DF_WINDOWED_MAX_SECONDS = float(os.environ.get("DF_WINDOWED_MAX_SECONDS", "600"))
+
+def run_deepfake_batch(inputs):
+    with torch.no_grad(), stage_timer("deepfake_forward"):
+        return get_deepfake_forward()(*inputs).view(-1).tolist()
+
+@app.post("/predict-windowed/")
+@limiter.limit("4/minute")
+async def predict_windowed(request: Request, file: UploadFile = File(...), hop_seconds: float = Form(3.0)):
+    admission.admit(("deepfake",), PRIORITY_LOW)
+    try:
+        decoded = await stage_pool.run("decode", decode_audio_bytes, await read_upload(file), 22050, DF_WINDOWED_MAX_SECONDS)
+        y, report = gate_audio(decoded, 22050)
+        # Windows are cut from the voiced region, their times are reported on the whole recording
+        offset = voiced_span(len(decoded), 22050, report)[0] / 22050
+
+        # Features for every window from one shared STFT, then the windows in forward passes of
+        # DF_BATCH_MAX_SIZE, so a long recording neither holds the model for one huge pass nor
+        # needs the activations of every window at once
+        async with admission.slot("deepfake"):
+            result = await stage_pool.run(
+                "features", dfextract_windowed_features, y, 22050, 6.0, max(0.5, hop_seconds), (128, 259), DF_POOLED_FEATURES
+            )
+            if result is None:
+                return {"error": "Feature extraction failed."}
+            batch, spans = result
+
+            inputs = [batch[k] for k in DF_FEATURE_ORDER]
+            probs = []
+            for i in range(0, len(spans), DF_BATCH_MAX_SIZE):
+                probs += await stage_pool.run("deepfake_model", run_deepfake_batch,
+                                              [x[i:i + DF_BATCH_MAX_SIZE] for x in inputs])
+
+        windows = [
+            {"start": round(offset + start, 2), "end": round(offset + end, 2), "confidence": round(prob, 4),
+             "prediction": "bonafide" if prob >= 0.5 else "spoof"}
+            for (start, end), prob in zip(spans, probs)
+        ]
+        worst = min(probs)
+        return with_quality({
+            # A recording is flagged if any window looks spoofed
+            "prediction": "bonafide" if worst >= 0.5 else "spoof",
+            "mean_confidence": round(float(np.mean(probs)), 4),
+            "min_confidence": round(worst, 4),
+            "max_spoof_probability": round(1.0 - worst, 4),
+            "windows": windows,
+        }, report)
+    except AudioQualityError as e:
+        return quality_rejected(e)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except StageTimeout as e:
+        return JSONResponse(content={"error": str(e)}, status_code=504)
     except Exception as e:
-        return JSONResponse(content={"error": f"Deepfake auth prediction failed: {str(e)}"}, status_code=500)
+        return JSONResponse(content={"error": f"Windowed prediction failed: {str(e)}"}, status_code=500)
 
 
-#Speaker Verification Model
-from speechbrain.inference.speaker import SpeakerRecognition
-speaker_model = SpeakerRecognition.from_hparams(source="pretrained_models/spkrec-ecapa-voxceleb")
+#Deepfake batching stats
+@app.get("/deepfake-batch-stats/")
+async def deepfake_batch_stats():
+    return df_batcher.stats()
+
+
+#Decoded audio / feature / embedding cache usage
+@app.get("/audio-cache-stats/")
+async def audio_cache_stats():
+    return audio_cache.stats()
+
 
+#Worker pool stage usage
+@app.get("/stage-stats/")
+async def stage_stats():
+    return stage_pool.stats()
 
 
-def get_embedding(wav_path: str):
-    signal, fs = torchaudio.load(wav_path)
-    embedding = speaker_model.encode_batch(signal)
-    return embedding.squeeze().detach().cpu().numpy().tolist()
+#Speaker Verification Model
+# SPEAKER_BACKEND picks the embedding model behind every speaker endpoint (see src/speaker_backends.py):
+# "ecapa" (SpeechBrain spkrec-ecapa-voxceleb, 16 kHz, 192-dim) or "fusion" (voice_audio.AudioFusionModel,
+# 22.05 kHz, 128-dim). Templates only compare against embeddings from the backend that enrolled them
+# SPEAKER_SAMPLE_RATE is the rate every speaker waveform is decoded or resampled to. For ecapa, 22050
+# reproduces embeddings enrolled before the 16 kHz path existed
+SpeakerBackend, SPEAKER_SAMPLE_RATE = configured_backend()
+SPEAKER_BACKEND = SpeakerBackend.name
+# Rate of templates stored without a sampleRate field, i.e. enrolled before the 16 kHz path existed.
+# A template is always compared with an embedding made at its own rate
+LEGACY_TEMPLATE_SAMPLE_RATE = int(os.environ.get("LEGACY_TEMPLATE_SAMPLE_RATE", "22050"))
+
+def load_speaker_backend():
+    return SpeakerBackend.load(sample_rate=SPEAKER_SAMPLE_RATE, shared=SHARED_MODEL_WEIGHTS)
+
+def warmup_speaker_backend(backend):
+    backend.encode_batch([np.zeros(SPEAKER_SAMPLE_RATE, dtype=np.float32)])
+
+registry.register("speaker", load_speaker_backend, warmup_speaker_backend)
+
+
+
+def get_embedding(audio, sr: int = SPEAKER_SAMPLE_RATE, target_sr: int = SPEAKER_SAMPLE_RATE):
+    # audio is a WAV path or an already decoded mono float32 waveform sampled at sr, embedded at target_sr
+    if isinstance(audio, str):
+        signal, sr = torchaudio.load(audio)
+        audio = signal.mean(dim=0).numpy()
+    audio = resample_audio(audio, sr, target_sr)
+    return get_embeddings_batch([audio])[0].tolist()
+
+# Several SPEAKER_SAMPLE_RATE waveforms in one batched forward pass of the speaker backend, (N, dim) array
+def get_embeddings_batch(waveforms):
+    backend = registry.get("speaker")
+    with stage_timer("speaker_forward"):
+        return backend.encode_batch(waveforms)
+
+# Unit-length average of the unit-length utterance embeddings, so every utterance weighs the same
+def enrollment_template(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    template = embeddings.mean(axis=0)
+    return template / max(np.linalg.norm(template), 1e-12)
+
+# Embedding of a decoded waveform sampled at sr, made at target_sr (default sr); cached when key (the
+# upload's content key) is given
+async def embed_waveform(y, key: str = None, sr: int = SPEAKER_SAMPLE_RATE, target_sr: int = None):
+    target_sr = target_sr or sr
+    params = (SPEAKER_BACKEND, sr, target_sr, len(y))
+    embedding = audio_cache.get("embedding", key, params) if key else None
+    if embedding is None:
+        async with admission.slot("speaker"):
+            embedding = await stage_pool.run("embedding", get_embedding, y, sr, target_sr)
+        if key:
+            embedding = audio_cache.put("embedding", key, params, embedding)
+    return list(embedding)
 
 
 #Convert WEBM to WAV
@@ -252,66 +757,702 @@ def convert_webm_to_wav(webm_path):
 @app.post("/extract-embedding/")
 @limiter.limit("10/minute")
 async def extract_embedding(request: Request, file: UploadFile = File(...)):
+    admission.admit(("speaker",), PRIORITY_NORMAL)
     try:
-        # Save WEBM audio
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as temp_webm:
-            temp_webm.write(await file.read())
-            webm_path = temp_webm.name
+        # Decode WEBM audio in memory and extract embedding
+        data = await read_upload(file)
+        key = content_key(data)
+        decoded = await cached_decode(data, SPEAKER_SAMPLE_RATE, key=key)
+        signal, report = gate_audio(decoded, SPEAKER_SAMPLE_RATE)
+        signal, signal_key = await denoise(signal, SPEAKER_SAMPLE_RATE, await noise_device(request),
+                                           voiced_key(key, report), decoded)
+        embedding = await embed_waveform(signal, signal_key)
+
+        return JSONResponse(content=with_quality({"embedding": embedding}, report), status_code=200)
+    except AudioQualityError as e:
+        return quality_rejected(e)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except StageTimeout as e:
+        return JSONResponse(content={"error": str(e)}, status_code=504)
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+
+
+#Enrollment: several utterances decoded at the speaker model's rate and embedded in one batched
+#forward pass, averaged into a normalised template. With uid the template is also stored as the
+#user's enrolled embedding, which needs that user's Firebase ID token (see verified_uid)
+ENROLL_MAX_UTTERANCES = int(os.environ.get("ENROLL_MAX_UTTERANCES", "10"))
+
+def store_enrollment(uid: str, template, utterances: int):
+    registry.get("firestore").collection("voiceEmbeddings").document(uid).set({
+        "embedding": template,
+        "backend": SPEAKER_BACKEND,
+        "sampleRate": SPEAKER_SAMPLE_RATE,
+        "utterances": utterances,
+        "createdAt": firestore.SERVER_TIMESTAMP,
+    })
 
-        # Convert and extract embedding
-        wav_path = convert_webm_to_wav(webm_path)
-        embedding = get_embedding(wav_path)
+@app.post("/enroll-embedding/")
+@limiter.limit("10/minute")
+async def enroll_embedding(request: Request, files: List[UploadFile] = File(...), uid: Optional[str] = Form(None)):
+    admission.admit(("speaker",), PRIORITY_NORMAL)
+    if uid:
+        token_uid = await stage_pool.run("firestore", verified_uid, request)
+        if token_uid is None:
+            return JSONResponse(content={"error": "Storing an enrollment needs a valid Firebase ID token."}, status_code=401)
+        if token_uid != uid:
+            return JSONResponse(content={"error": "The ID token does not belong to this uid."}, status_code=403)
+    if not 1 <= len(files) <= ENROLL_MAX_UTTERANCES:
+        return JSONResponse(content={"error": f"Expected 1 to {ENROLL_MAX_UTTERANCES} utterances."}, status_code=400)
+
+    try:
+        uploads = [await read_upload(file) for file in files]
+        signals = await asyncio.gather(*(cached_decode(data, SPEAKER_SAMPLE_RATE) for data in uploads), return_exceptions=True)
+    except StageTimeout as e:
+        return JSONResponse(content={"error": str(e)}, status_code=504)
+
+    failed = [i for i, signal in enumerate(signals) if isinstance(signal, Exception) or len(signal) == 0]
+    if failed:
+        return JSONResponse(content={"error": "Audio decode failed.", "failed_utterances": failed}, status_code=400)
+
+    # Every utterance goes through the quality gate, one bad recording fails the enrollment
+    decoded, gated, rejected, reports = signals, [], {}, []
+    for i, signal in enumerate(signals):
+        try:
+            signal, report = gate_audio(signal, SPEAKER_SAMPLE_RATE)
+        except AudioQualityError as e:
+            rejected[i] = e.content()
+        else:
+            gated.append(signal)
+            reports.append(report)
+    if rejected:
+        return JSONResponse(content={
+            "error": "Audio rejected by the quality gate.",
+            "failed_utterances": sorted(rejected),
+            "quality": {str(i): content for i, content in rejected.items()},
+        }, status_code=422)
+    signals = gated
 
-        # Clean up
-        os.remove(webm_path)
-        os.remove(wav_path)
+    try:
+        # One after the other, so for a signed-in user the noise profile estimated from the first
+        # utterance serves the rest
+        device = await noise_device(request, uid)
+        signals = [(await denoise(signal, SPEAKER_SAMPLE_RATE, device, source=source))[0]
+                   for signal, source in zip(signals, decoded)]
+        async with admission.slot("speaker"):
+            embeddings = await stage_pool.run("embedding", get_embeddings_batch, signals)
+        template = enrollment_template(embeddings)
+
+        # How well each utterance agrees with the template, a low value points at a bad recording
+        similarities = embeddings @ template / np.maximum(np.linalg.norm(embeddings, axis=1), 1e-12)
+        template = template.tolist()
+
+        if uid:
+            await stage_pool.run("firestore", store_enrollment, uid, template, len(signals))
+            embedding_cache.put(uid, template, SPEAKER_SAMPLE_RATE)
+            if registry.is_loaded("speaker_index"):
+                registry.get("speaker_index").add(uid, template)
 
-        return JSONResponse(content={"embedding": embedding}, status_code=200)
+        return {
+            "embedding": template,
+            "utterances": len(signals),
+            "backend": SPEAKER_BACKEND,
+            "sample_rate": SPEAKER_SAMPLE_RATE,
+            "similarities": [round(float(x), 4) for x in similarities],
+            "stored": bool(uid),
+            **({"quality": reports} if any(r is not None and not r["ok"] for r in reports) else {}),
+        }
+    except Overloaded as e:
+        return overloaded_response(e)
+    except StageTimeout as e:
+        return JSONResponse(content={"error": str(e)}, status_code=504)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 
-
 #Compare New vs Stored Embedding using cosine similarity
 def compare_embeddings(embedding1, embedding2, threshold=0.6):
     similarity = 1 - cosine(embedding1, embedding2)
     return similarity, similarity >= threshold
 
 
+#Fetch the enrolled embedding document (blocking network call)
+@timed("firestore_fetch")
+def fetch_embedding_doc(uid: str):
+    return registry.get("firestore").collection("voiceEmbeddings").document(uid).get()
+
+
+# Enrolled embeddings cached in-process so repeat logins and retries skip Firestore
+embedding_cache = EmbeddingCache(
+    max_entries=int(os.environ.get("EMBEDDING_CACHE_SIZE", "10000")),
+    ttl_seconds=float(os.environ.get("EMBEDDING_CACHE_TTL", "300")),
+)
+
+# (enrolled embedding, rate it was enrolled at); a template from another speaker backend can't be compared
+async def get_stored_template(uid: str):
+    template = embedding_cache.get_template(uid)
+    if template is not None:
+        return template
+
+    # Retrieve stored embedding from Firestore
+    doc = await stage_pool.run("firestore", fetch_embedding_doc, uid)
+    if not doc.exists:
+        raise HTTPException(status_code=404, detail="User embedding not found.")
+
+    data = doc.to_dict()
+    stored_embedding = data.get("embedding")
+    if not stored_embedding:
+        raise HTTPException(status_code=404, detail="Stored embedding is missing.")
+    backend = data.get("backend", SPEAKER_BACKEND)
+    if backend != SPEAKER_BACKEND:
+        raise ValueError(f"Enrolled with the {backend} speaker backend, the server runs {SPEAKER_BACKEND}; "
+                         f"re-enroll with this backend.")
+
+    sample_rate = int(data.get("sampleRate", LEGACY_TEMPLATE_SAMPLE_RATE))
+    return embedding_cache.put(uid, stored_embedding, sample_rate), sample_rate
+
+async def get_stored_embedding(uid: str):
+    return (await get_stored_template(uid))[0]
+
+
+#Embed a decoded waveform sampled at sr and compare it with the user's enrolled embedding. The
+#embedding is made at the rate the template was enrolled at: from source(template_sr), a coroutine
+#returning the same recording at that rate, when the caller has a better copy than signal, otherwise
+#by resampling signal. new_embedding (made at SPEAKER_SAMPLE_RATE) is only used for templates
+#enrolled at that rate
+async def verify_speaker(signal, uid: str, new_embedding=None, key: str = None, sr: int = SPEAKER_SAMPLE_RATE,
+                         source=None):
+    stored_embedding, template_sr = await get_stored_template(uid)
+    if template_sr != sr and source is not None:
+        (signal, key), sr = await source(template_sr), template_sr
+    if new_embedding is None or template_sr != SPEAKER_SAMPLE_RATE:
+        new_embedding = await embed_waveform(signal, key, sr, template_sr)
+    if len(stored_embedding) != len(new_embedding):
+        raise ValueError(f"Enrolled embedding has {len(stored_embedding)} dimensions, the {SPEAKER_BACKEND} "
+                         f"backend produces {len(new_embedding)}; re-enroll with this backend.")
+
+    # Compare new vs stored
+    similarity, confirmed = compare_embeddings(new_embedding, stored_embedding)
+
+    return {
+        "similarity": float(similarity),
+        "confirmed": bool(confirmed)
+    }
+
+
 #Speaker Verification (Login Check)
 @app.post("/verify-embedding/")
 @limiter.limit("10/minute")
 async def verify_embedding(request: Request, file: UploadFile = File(...), uid: str = Form(...)):
+    admission.admit(("speaker",), PRIORITY_HIGH)
+    try:
+        # Decode uploaded WEBM in memory, embed it and compare with the stored embedding
+        data = await read_upload(file)
+        key = content_key(data)
+        # Decoded straight at the rate the user's template was enrolled at
+        _, template_sr = await get_stored_template(uid)
+        decoded = await cached_decode(data, template_sr, key=key)
+        signal, report = gate_audio(decoded, template_sr)
+        signal, signal_key = await denoise(signal, template_sr, await noise_device(request, uid),
+                                           voiced_key(key, report), decoded)
+        return with_quality(await verify_speaker(signal, uid, key=signal_key, sr=template_sr), report)
+
+    except AudioQualityError as e:
+        return quality_rejected(e)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except StageTimeout as e:
+        return JSONResponse(content={"error": str(e)}, status_code=504)
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+
+#1:N speaker index over all enrolled embeddings, loaded from SPEAKER_INDEX_PATH if saved there and
+#still in step with the voiceEmbeddings collection, otherwise rebuilt from it. Only the worker that
+#owns SPEAKER_INDEX_PATH writes it back at shutdown
+SPEAKER_INDEX_PATH = os.environ.get("SPEAKER_INDEX_PATH", os.path.join(os.path.dirname(__file__), "speaker_index"))
+speaker_index_lock = None
+
+def saved_index_current(index, collection):
+    # Same documents as when the file was saved and none of them changed since; only ids and
+    # update times are read, not the embeddings
+    if index.synced_at is None:
+        return False
+    ids = set()
+    for doc in collection.select([]).stream():
+        if doc.update_time is not None and doc.update_time.timestamp() > index.synced_at:
+            return False
+        ids.add(doc.id)
+    return ids == set(index._uids) | set(index.skipped)
+
+# An enrolled template the current speaker backend's embeddings can be compared with. Documents
+# written before the backend was recorded are taken on their length alone
+def template_compatible(data):
+    embedding = data.get("embedding")
+    if not embedding or len(embedding) != SpeakerBackend.embedding_dim:
+        return False
+    return data.get("backend", SPEAKER_BACKEND) == SPEAKER_BACKEND
+
+def build_speaker_index(collection):
+    index = SpeakerIndex(dim=SpeakerBackend.embedding_dim)
+    index.synced_at = time.time()
+    uids, embeddings = [], []
+    for doc in collection.stream():
+        data = doc.to_dict()
+        embedding = data.get("embedding")
+        if template_compatible(data):
+            uids.append(doc.id)
+            embeddings.append(embedding)
+        else:
+            index.skipped.append(doc.id)
+    if uids:
+        index.add_many(uids, embeddings)
+    return index
+
+def load_speaker_index():
+    global speaker_index_lock
+    if speaker_index_lock is None:
+        os.makedirs(os.path.dirname(os.path.abspath(SPEAKER_INDEX_PATH)), exist_ok=True)
+        speaker_index_lock = claim_save_lock(SPEAKER_INDEX_PATH)
+
+    collection = registry.get("firestore").collection("voiceEmbeddings")
+    if SpeakerIndex.exists(SPEAKER_INDEX_PATH):
+        try:
+            index = SpeakerIndex.load(SPEAKER_INDEX_PATH)
+        except (OSError, ValueError) as e:
+            print(f"[WARN] Saved speaker index unusable, rebuilding: {e}")
+        else:
+            if index.dim != SpeakerBackend.embedding_dim:
+                print(f"[WARN] Saved speaker index has {index.dim} dimensions, the {SPEAKER_BACKEND} backend "
+                      f"produces {SpeakerBackend.embedding_dim}; rebuilding")
+            elif saved_index_current(index, collection):
+                return index
+    return build_speaker_index(collection)
+
+# Built on the first /identify-speaker/ call rather than in the warm-up, so a cold worker is ready
+# without scanning the collection
+registry.register("speaker_index", load_speaker_index, lazy=True)
+
+@app.on_event("shutdown")
+def save_speaker_index():
+    if registry.is_loaded("speaker_index") and speaker_index_lock is not None:
+        registry.get("speaker_index").save(SPEAKER_INDEX_PATH)
+
+
+#Who is speaking: top-k enrolled users closest to the uploaded voice
+@app.post("/identify-speaker/")
+@limiter.limit("10/minute")
+async def identify_speaker(request: Request, file: UploadFile = File(...), k: int = Form(5), threshold: float = Form(0.6)):
+    admission.admit(("speaker",), PRIORITY_NORMAL)
     try:
-        # Save uploaded WEBM
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as temp_file:
-            temp_file.write(await file.read())
-            webm_path = temp_file.name
+        data = await read_upload(file)
+        key = content_key(data)
+        decoded = await cached_decode(data, SPEAKER_SAMPLE_RATE, key=key)
+        signal, report = gate_audio(decoded, SPEAKER_SAMPLE_RATE)
+        signal, signal_key = await denoise(signal, SPEAKER_SAMPLE_RATE, await noise_device(request),
+                                           voiced_key(key, report), decoded)
+        embedding = await embed_waveform(signal, signal_key)
+        index = await stage_pool.run("speaker_index", registry.get, "speaker_index")
+
+        matches = index.search(embedding, k=max(1, min(k, 100)))
+        return with_quality({
+            "matches": [{"uid": uid, "similarity": score} for uid, score in matches],
+            # A new voice this close to an enrolled one is likely a duplicate enrollment
+            "duplicate": bool(matches) and matches[0][1] >= threshold,
+        }, report)
+    except AudioQualityError as e:
+        return quality_rejected(e)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except StageTimeout as e:
+        return JSONResponse(content={"error": str(e)}, status_code=504)
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
 
-        # Convert and get new embedding
-        wav_path = convert_webm_to_wav(webm_path)
-        new_embedding = get_embedding(wav_path)
 
-        # Clean up temp files
-        os.remove(webm_path)
-        os.remove(wav_path)
+#Drop a cached enrolled embedding, called when a user deletes their account (enrollments stored
+#through /enroll-embedding/ update the cache and index themselves). Needs that user's Firebase ID
+#token, like storing an enrollment. The speaker index is refreshed from Firestore for that uid too
+@app.post("/invalidate-embedding/")
+@limiter.limit("10/minute")
+async def invalidate_embedding(request: Request, uid: str = Form(...)):
+    token_uid = await stage_pool.run("firestore", verified_uid, request)
+    if token_uid is None:
+        return JSONResponse(content={"error": "Invalidating an embedding needs a valid Firebase ID token."}, status_code=401)
+    if token_uid != uid:
+        return JSONResponse(content={"error": "The ID token does not belong to this uid."}, status_code=403)
+    invalidated = embedding_cache.invalidate(uid)
 
-        # Retrieve stored embedding from Firestore
-        doc = firestore.client().collection("voiceEmbeddings").document(uid).get()
-        if not doc.exists:
-            raise HTTPException(status_code=404, detail="User embedding not found.")
+    if registry.is_loaded("speaker_index"):
+        index = registry.get("speaker_index")
+        try:
+            index.add(uid, await get_stored_embedding(uid))
+        except (HTTPException, ValueError):
+            # Gone, or enrolled with another speaker backend
+            index.remove(uid)
 
-        stored_embedding = doc.to_dict().get("embedding")
-        if not stored_embedding:
-            raise HTTPException(status_code=404, detail="Stored embedding is missing.")
+    return {"invalidated": invalidated}
 
-        # Compare new vs stored
-        similarity, confirmed = compare_embeddings(new_embedding, stored_embedding)
 
-        return {
-            "similarity": float(similarity),
-            "confirmed": bool(confirmed)
-        }
+@app.get("/embedding-cache-stats/")
+async def embedding_cache_stats():
+    return embedding_cache.stats()
 
+
+#Combined login check: decode once, run passphrase, deepfake and speaker checks concurrently
+AUTH_LANES = ("whisper", "deepfake", "speaker")
+
+def _stage_failed(name, result):
+    if name == "deepfake":
+        return result is None or result["prediction"] == "spoof"
+    return not result["confirmed"]
+
+
+@app.post("/authenticate/")
+@limiter.limit("10/minute")
+async def authenticate(request: Request, file: UploadFile = File(...), uid: str = Form(...), passphrase: str = Form(...)):
+    admission.admit(AUTH_LANES, PRIORITY_HIGH)
+    timings = {}
+    started = time.perf_counter()
+
+    try:
+        # One decode at 22.05 kHz, Whisper and ECAPA get in-memory resamples to 16 kHz
+        data = await read_upload(file)
+        key = content_key(data)
+        y = await cached_decode(data, 22050, key=key)
+        # Rejected before any resample; the voiced span (in seconds) trims every copy
+        y_voiced, report = gate_audio(y, 22050)
+        y_16k_full = await cached_resample(y, key, WHISPER_SAMPLE_RATE)
+        y_speaker_full = await cached_resample(y, key, SPEAKER_SAMPLE_RATE)
+        y_16k = voiced_region(y_16k_full, WHISPER_SAMPLE_RATE, report)
+        y_speaker = voiced_region(y_speaker_full, SPEAKER_SAMPLE_RATE, report)
+        # Whisper and the speaker model share one gated copy when both run at 16 kHz
+        stage_key = voiced_key(key, report)
+        device = await noise_device(request, uid)
+        y_16k, speaker_key = await denoise(y_16k, WHISPER_SAMPLE_RATE, device, stage_key, y_16k_full)
+        if SPEAKER_SAMPLE_RATE == WHISPER_SAMPLE_RATE:
+            y_speaker = y_16k
+        else:
+            y_speaker, speaker_key = await denoise(y_speaker, SPEAKER_SAMPLE_RATE, device, stage_key, y_speaker_full)
+        timings["decode"] = round(1000 * (time.perf_counter() - started), 1)
+    except AudioQualityError as e:
+        return quality_rejected(e)
+    except StageTimeout as e:
+        return JSONResponse(content={"error": str(e)}, status_code=504)
     except Exception as e:
-        return JSONResponse(content={"error": str(e)}, status_code=500)
\ No newline at end of file
+        return JSONResponse(content={"error": f"Audio decode failed: {str(e)}"}, status_code=400)
+
+    # A template enrolled at another rate is embedded from the 22.05 kHz decode, not from y_speaker
+    async def speaker_source(template_sr):
+        y_template_full = await cached_resample(y, key, template_sr)
+        return await denoise(voiced_region(y_template_full, template_sr, report), template_sr, device,
+                             stage_key, y_template_full)
+
+    return with_quality(await run_auth_stages({
+        "passphrase": check_passphrase(y_16k, passphrase),
+        "deepfake": score_deepfake(y_voiced[:int(22050 * DF_DECODE_MAX_SECONDS)], stage_key),
+        "speaker": verify_speaker(y_speaker, uid, key=speaker_key, source=speaker_source),
+    }, timings, started), report)
+
+
+# Runs the passphrase/deepfake/speaker coroutines concurrently and builds the verdict,
+# returning as soon as any of them fails
+async def run_auth_stages(stages, timings, started):
+    async def timed(name, coro):
+        stage_start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            timings[name] = round(1000 * (time.perf_counter() - stage_start), 1)
+
+    tasks = {asyncio.create_task(timed(name, coro)): name for name, coro in stages.items()}
+
+    results = {name: {"skipped": True} for name in tasks.values()}
+    failed_stage = None
+    pending = set(tasks)
+
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name = tasks[task]
+                try:
+                    result = task.result()
+                except Overloaded:
+                    raise
+                except HTTPException as e:
+                    result, failed = {"error": e.detail}, True
+                except Exception as e:
+                    result, failed = {"error": str(e)}, True
+                else:
+                    failed = _stage_failed(name, result)
+                    if result is None:
+                        result = {"error": "Feature extraction failed."}
+                results[name] = result
+                if failed and failed_stage is None:
+                    failed_stage = name
+
+            # A hard failure decides the verdict, so stop waiting on the other stages
+            if failed_stage is not None:
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+
+    timings["total"] = round(1000 * (time.perf_counter() - started), 1)
+
+    return {
+        "authenticated": failed_stage is None,
+        "failed_stage": failed_stage,
+        "passphrase": results["passphrase"],
+        "deepfake": results["deepfake"],
+        "speaker": results["speaker"],
+        "timings_ms": timings,
+    }
+
+
+#Streaming login check over a WebSocket
+# The client sends MediaRecorder chunks as binary messages while the user speaks and the text message
+# "end" when recording stops. Chunks are decoded as they arrive, the enrolled embedding is fetched up
+# front, and every STREAM_SPECULATE_SECONDS of new audio the deepfake score and speaker embedding are
+# computed on what has been recorded so far. At end-of-speech only the work invalidated by the last
+# chunks is redone: the deepfake input is fixed once DF_DECODE_MAX_SECONDS of speech have been
+# recorded, the embedding is reused only if its voiced region is unchanged. The recording goes through
+# the quality gate at end-of-speech, speculation already works on the voiced region of each snapshot.
+# With NOISE_REDUCTION on the decoded stream also goes through a streaming spectral gate chunk by
+# chunk, its noise profile estimated from the first NOISE_PROFILE_SECONDS of the session; its output
+# doesn't depend on how the stream was chunked, so embeddings speculated on it stay valid.
+STREAM_MAX_SECONDS = float(os.environ.get("STREAM_MAX_SECONDS", "30"))
+STREAM_SPECULATE_SECONDS = float(os.environ.get("STREAM_SPECULATE_SECONDS", "1.0"))
+# A session is closed if no message arrives for STREAM_IDLE_SECONDS or "end" hasn't come STREAM_MAX_SECONDS
+# after it opened, so an abandoned socket doesn't keep its ffmpeg process
+STREAM_IDLE_SECONDS = float(os.environ.get("STREAM_IDLE_SECONDS", "10"))
+# slowapi doesn't see WebSockets, the same per-IP limit as /authenticate/ is counted by hand
+STREAM_RATE_LIMIT = parse_rate_limit(os.environ.get("STREAM_RATE_LIMIT", "10/minute"))
+
+def _consume_exception(task):
+    # Speculative work may fail or be abandoned, the final pass recomputes whatever is missing
+    if not task.cancelled():
+        task.exception()
+
+
+class StreamingAuthSession:
+    def __init__(self, uid: str, passphrase: str):
+        self.uid = uid
+        self.passphrase = passphrase
+        self.decoder = StreamingDecoder(22050, max_duration=STREAM_MAX_SECONDS)
+        self.df_samples = int(22050 * DF_DECODE_MAX_SECONDS)
+        self.speculated_samples = 0
+        # ((start, end) samples covered, task) of the latest speculative deepfake score and embedding
+        self.df_task = None
+        self.embedding_task = None
+        # Spectral gate over the decoded stream
+        self.denoiser = SpectralGate(22050) if NOISE_REDUCTION == "on" else None
+        self.denoised = []
+        self.denoised_input = 0
+
+        # Warm the embedding cache while the user is still speaking
+        self.stored_task = self._spawn(get_stored_embedding(uid))
+
+    @staticmethod
+    def _spawn(coro, priority=None):
+        task = asyncio.create_task(coro if priority is None else with_priority(priority, coro))
+        task.add_done_callback(_consume_exception)
+        return task
+
+    @staticmethod
+    async def _embed(y):
+        async with admission.slot("speaker"):
+            return await stage_pool.run("embedding", get_embedding, y, 22050)
+
+    @staticmethod
+    def _pending(entry):
+        return entry is not None and not entry[1].done()
+
+    def _denoise(self, y, final=False):
+        # Gates the samples decoded since the last call; the output is sample aligned with the
+        # decoded stream, it only trails it by what the gate still holds back
+        self.denoised.append(self.denoiser.process(y[self.denoised_input:]))
+        self.denoised_input = len(y)
+        if final:
+            self.denoised.append(self.denoiser.flush())
+        if len(self.denoised) > 1:
+            self.denoised = [np.concatenate(self.denoised)]
+        return self.denoised[0]
+
+    async def enhance(self):
+        if self.denoiser is not None:
+            await stage_pool.run("features", self._denoise, self.decoder.snapshot())
+
+    def speculate(self):
+        if self._pending(self.df_task) or self._pending(self.embedding_task):
+            return
+        y = self.decoder.snapshot()
+        if len(y) - self.speculated_samples < 22050 * STREAM_SPECULATE_SECONDS:
+            return
+        self.speculated_samples = len(y)
+
+        report = assess_audio(y, 22050) if QUALITY_GATE != "off" else None
+        if report is not None and "silent" in report["issues"]:
+            return
+        start, end = voiced_span(len(y), 22050, report)
+
+        # Speculative work queues behind real requests and is the first to be shed
+        df_span = (start, min(end, start + self.df_samples))
+        if self.df_task is None or self.df_task[0] != df_span:
+            self.df_task = (df_span, self._spawn(score_deepfake(y[df_span[0]:df_span[1]]), PRIORITY_LOW))
+        y_speech = y
+        if self.denoiser is not None:
+            y_speech = self.denoised[0] if self.denoised else y[:0]
+            end = min(end, len(y_speech))
+            if end - start < 22050 * STREAM_SPECULATE_SECONDS:
+                return
+        self.embedding_task = ((start, end), self._spawn(self._embed(y_speech[start:end]), PRIORITY_LOW))
+
+    def progress(self):
+        message = {"type": "progress", "seconds": round(self.decoder.seconds, 2)}
+        if self.df_task is not None and self.df_task[1].done() and not self.df_task[1].cancelled() \
+                and self.df_task[1].exception() is None:
+            message["deepfake"] = self.df_task[1].result()
+        return message
+
+    @staticmethod
+    async def _reuse(entry, span):
+        # Result of a speculative task that covered exactly this span, None if there is none
+        if entry is None:
+            return None
+        covered, task = entry
+        if covered != span:
+            task.cancel()
+            return None
+        try:
+            return await task
+        except Exception:
+            return None
+
+    async def _deepfake(self, y, span):
+        start, end = span
+        df_span = (start, min(end, start + self.df_samples))
+        result = await self._reuse(self.df_task, df_span)
+        self.reused["deepfake"] = result is not None
+        return result if result is not None else await score_deepfake(y[df_span[0]:df_span[1]])
+
+    async def _speaker(self, span, y_speaker, y_speech):
+        embedding = await self._reuse(self.embedding_task, span)
+        _, template_sr = await get_stored_template(self.uid)
+        if template_sr != SPEAKER_SAMPLE_RATE:
+            embedding = None  # speculated at SPEAKER_SAMPLE_RATE, the template needs its own rate
+        self.reused["speaker"] = embedding is not None
+
+        async def source(template_sr):
+            return await stage_pool.run("decode", resample_audio, y_speech, 22050, template_sr), None
+
+        return await verify_speaker(y_speaker, self.uid, embedding, source=source)
+
+    async def finish(self):
+        loop = asyncio.get_running_loop()
+        timings = {}
+        started = time.perf_counter()
+        self.reused = {"deepfake": False, "speaker": False}
+
+        # Flush ffmpeg, the decoded stream is a prefix-stable copy of what a full decode returns
+        y = await loop.run_in_executor(None, self.decoder.close)
+        y_voiced, report = gate_audio(y, 22050)
+        span = voiced_span(len(y), 22050, report)
+        y_speech = y_voiced
+        if self.denoiser is not None:
+            y_speech = (await stage_pool.run("features", self._denoise, y, True))[span[0]:span[1]]
+        y_16k = await stage_pool.run("decode", resample_audio, y_speech, 22050, WHISPER_SAMPLE_RATE)
+        y_speaker = y_16k if SPEAKER_SAMPLE_RATE == WHISPER_SAMPLE_RATE else \
+            await stage_pool.run("decode", resample_audio, y_speech, 22050, SPEAKER_SAMPLE_RATE)
+        timings["decode"] = round(1000 * (time.perf_counter() - started), 1)
+
+        result = await run_auth_stages({
+            "passphrase": check_passphrase(y_16k, self.passphrase),
+            "deepfake": self._deepfake(y, span),
+            "speaker": self._speaker(span, y_speaker, y_speech),
+        }, timings, started)
+        result["audio_seconds"] = round(len(y) / 22050, 2)
+        result["reused"] = self.reused
+        return with_quality(result, report)
+
+    def abort(self):
+        for entry in (self.df_task, self.embedding_task):
+            if entry is not None:
+                entry[1].cancel()
+        self.decoder.abort()
+
+
+@app.websocket("/ws/authenticate")
+async def authenticate_stream(websocket: WebSocket, uid: str = Query(...), passphrase: str = Query(...)):
+    client = websocket.client.host if websocket.client else "unknown"
+    if not limiter.limiter.hit(STREAM_RATE_LIMIT, "ws-authenticate", client):
+        RATE_LIMITED.inc("/ws/authenticate")
+        # 1008: policy violation, closing before accept rejects the handshake
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + STREAM_MAX_SECONDS
+
+    try:
+        admission.admit(AUTH_LANES, PRIORITY_HIGH)
+    except Overloaded as e:
+        # 1013: try again later
+        await websocket.send_json({"type": "error", "error": str(e), "retry_after": e.retry_after})
+        await websocket.close(code=1013)
+        return
+
+    try:
+        session = StreamingAuthSession(uid, passphrase)
+    except AudioDecodeError as e:
+        await websocket.send_json({"type": "error", "error": str(e)})
+        await websocket.close()
+        return
+
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(websocket.receive(),
+                                                 min(STREAM_IDLE_SECONDS, max(0.0, deadline - loop.time())))
+            except asyncio.TimeoutError:
+                expired = loop.time() >= deadline
+                await websocket.send_json({"type": "error", "error": (
+                    f"Recording not finished within {STREAM_MAX_SECONDS:g} seconds." if expired
+                    else f"No audio received for {STREAM_IDLE_SECONDS:g} seconds.")})
+                await websocket.close(code=1008)
+                return
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes"):
+                # Writing to ffmpeg can block if it falls behind
+                await loop.run_in_executor(None, session.decoder.feed, message["bytes"])
+                await session.enhance()
+                session.speculate()
+                await websocket.send_json(session.progress())
+            elif message.get("text") == "end":
+                break
+
+        try:
+            result = await session.finish()
+        except AudioQualityError as e:
+            await websocket.send_json({"type": "error", **e.content()})
+        except Overloaded as e:
+            await websocket.send_json({"type": "error", "error": str(e), "retry_after": e.retry_after})
+        except StageTimeout as e:
+            await websocket.send_json({"type": "error", "error": str(e)})
+        except AudioDecodeError as e:
+            await websocket.send_json({"type": "error", "error": f"Audio decode failed: {str(e)}"})
+        except HTTPException as e:
+            await websocket.send_json({"type": "error", "error": e.detail})
+        except Exception as e:
+            await websocket.send_json({"type": "error", "error": str(e)})
+        else:
+            await websocket.send_json({"type": "result", **result})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        session.abort()
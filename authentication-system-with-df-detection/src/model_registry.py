@@ -0,0 +1,93 @@
+import asyncio
+import threading
+import time
+
+
+class _Entry:
+    def __init__(self, name, loader, warmup=None, lazy=False):
+        self.name = name
+        self.loader = loader
+        self.warmup = warmup
+        self.lazy = lazy
+        self.lock = threading.Lock()
+        self.value = None
+        self.state = "unloaded"  # unloaded -> loading -> warming -> ready, or failed
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self.error = None
+
+
+class ModelRegistry:
+    # Loads models (and other heavy resources such as the Firebase app) on first use instead of
+    # at import time. warm_up() loads everything in the background and runs a dummy inference
+    # on each model, and status() feeds the /healthz and /readyz endpoints. Lazy entries (slow to
+    # build and only needed by some endpoints) are left to their first get() and don't gate readiness.
+
+    def __init__(self):
+        self._entries = {}
+
+    def register(self, name, loader, warmup=None, lazy=False):
+        # loader() returns the loaded object, warmup(obj) runs a throwaway inference on it
+        self._entries[name] = _Entry(name, loader, warmup, lazy)
+
+    def get(self, name):
+        entry = self._entries[name]
+        if entry.state == "ready":
+            return entry.value
+
+        # Only one thread loads a given model, others wait for it
+        with entry.lock:
+            if entry.state != "ready":
+                self._load(entry)
+        return entry.value
+
+    def _load(self, entry):
+        try:
+            entry.state = "loading"
+            entry.error = None
+            started = time.perf_counter()
+            value = entry.loader()
+            entry.load_seconds = round(time.perf_counter() - started, 3)
+
+            if entry.warmup is not None:
+                entry.state = "warming"
+                started = time.perf_counter()
+                entry.warmup(value)
+                entry.warmup_seconds = round(time.perf_counter() - started, 3)
+
+            entry.value = value
+            entry.state = "ready"
+        except Exception as e:
+            # Left as failed, the next get() tries again
+            entry.state = "failed"
+            entry.error = str(e)
+            raise
+
+    def is_loaded(self, name):
+        return self._entries[name].state == "ready"
+
+    async def warm_up(self, names=None):
+        # Load and warm every model concurrently in worker threads
+        loop = asyncio.get_running_loop()
+        names = list(names or (name for name, entry in self._entries.items() if not entry.lazy))
+        results = await asyncio.gather(
+            *(loop.run_in_executor(None, self.get, name) for name in names),
+            return_exceptions=True,
+        )
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                print(f"[ERROR] Warm-up of {name} failed: {result}")
+
+    def ready(self):
+        return all(entry.state == "ready" for entry in self._entries.values() if not entry.lazy)
+
+    def status(self):
+        return {
+            name: {
+                "state": entry.state,
+                "load_seconds": entry.load_seconds,
+                "warmup_seconds": entry.warmup_seconds,
+                "error": entry.error,
+            }
+            for name, entry in self._entries.items()
+        }
@@ -0,0 +1,90 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from limits.storage import Storage
+
+# One file per host, shared by every worker process
+SHARED_RATE_LIMIT_URI = f"sqlite://{os.path.join(tempfile.gettempdir(), 'audioshield_rate_limits.db')}"
+
+
+class SQLiteStorage(Storage):
+    # Rate limit counters in a local SQLite file, so every worker process on the host sees the same
+    # counts (memory:// keeps a separate counter per worker, which multiplies the effective limit by
+    # the worker count). Registered with limits as sqlite:///path/to/file.db. Supports the
+    # fixed-window strategy, which is what slowapi uses by default.
+
+    STORAGE_SCHEME = ["sqlite"]
+
+    def __init__(self, uri: str, wrap_exceptions: bool = False, **options):
+        self.path = uri.split("://", 1)[1] or ":memory:"
+        if self.path.startswith("//"):
+            self.path = self.path[1:]
+        self._local = threading.local()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, count INTEGER NOT NULL, expiry REAL NOT NULL)")
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connection(self):
+        # One connection per thread; WAL lets readers in other workers carry on during a write
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def incr(self, key: str, expiry: float, amount: int = 1) -> int:
+        conn = self._connection()
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent workers can't both read the old count
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT count, expiry FROM counters WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] <= now:
+                count = amount
+                conn.execute("INSERT OR REPLACE INTO counters (key, count, expiry) VALUES (?, ?, ?)", (key, count, now + expiry))
+            else:
+                count = row[0] + amount
+                conn.execute("UPDATE counters SET count = ? WHERE key = ?", (count, key))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return count
+
+    def get(self, key: str) -> int:
+        row = self._connection().execute(
+            "SELECT count FROM counters WHERE key = ? AND expiry > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key: str) -> float:
+        row = self._connection().execute(
+            "SELECT expiry FROM counters WHERE key = ? AND expiry > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else time.time()
+
+    def check(self) -> bool:
+        try:
+            self._connection().execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self) -> int:
+        return self._connection().execute("DELETE FROM counters").rowcount
+
+    def clear(self, key: str) -> None:
+        self._connection().execute("DELETE FROM counters WHERE key = ?", (key,))
+
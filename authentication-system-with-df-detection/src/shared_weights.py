@@ -0,0 +1,127 @@
+"""
+Model weights shared between server workers.
+
+With several uvicorn workers every process normally holds its own copy of Whisper, the deepfake
+fusion model and ECAPA. With SHARED_MODEL_WEIGHTS=1 each model's tensors are written once to a flat
+file in SHARED_WEIGHTS_DIR (by whichever worker gets there first) and every worker then memory-maps
+that file with torch.load(mmap=True) and points the model's parameters and buffers at the mapped
+storage. The pages live in the OS page cache and are shared read-only between workers (the mapping is
+copy-on-write, and inference never writes to the weights), so adding a worker no longer adds a full
+copy of the models.
+
+uvicorn starts its workers with spawn rather than fork, so sharing pages loaded by a pre-fork parent
+is not an option there; the mmap files work the same under uvicorn, gunicorn or several containers
+sharing a volume.
+"""
+
+import fcntl
+import os
+
+import torch
+import torch.nn as nn
+
+SHARED_MODEL_WEIGHTS = os.environ.get("SHARED_MODEL_WEIGHTS", "0") == "1"
+SHARED_WEIGHTS_DIR = os.environ.get(
+    "SHARED_WEIGHTS_DIR", os.path.join(os.path.dirname(__file__), "pth_models", "shared")
+)
+
+
+def shared_path(name):
+    return os.path.join(SHARED_WEIGHTS_DIR, f"{name}.pt")
+
+
+def file_tag(path):
+    # Part of the shared file name, so replacing a checkpoint produces a fresh export instead of
+    # serving the stale one
+    stat = os.stat(path)
+    return f"{stat.st_size:x}-{int(stat.st_mtime):x}"
+
+
+def module_tensors(module):
+    # Every parameter and buffer, including non-persistent buffers that a state_dict leaves out
+    tensors, sparse = {}, []
+    for name, tensor in list(module.named_parameters()) + list(module.named_buffers()):
+        tensor = tensor.detach().cpu()
+        if tensor.is_sparse:
+            # Stored dense so the whole file can be mapped, turned back into sparse on load
+            tensor = tensor.to_dense()
+            sparse.append(name)
+        tensors[name] = tensor.contiguous()
+    return tensors, sparse
+
+
+def export_shared(module, path, meta=None):
+    # Written to a temporary file and renamed, so a worker never maps a half written file
+    tensors, sparse = module_tensors(module)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save({"tensors": tensors, "sparse": sparse, "meta": meta or {}}, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def ensure_exported(path, materialize):
+    # materialize() -> (module, meta) loads the model the normal way; only one worker runs it, the
+    # others wait on the lock and then find the file
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(path):
+                module, meta = materialize()
+                export_shared(module, path, meta)
+                del module
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def load_shared(path):
+    return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+
+
+def _set_tensor(module, name, tensor, sparse):
+    owner_name, _, attr = name.rpartition(".")
+    owner = module.get_submodule(owner_name) if owner_name else module
+    if attr in owner._parameters:
+        owner._parameters[attr] = nn.Parameter(tensor, requires_grad=False)
+    elif attr in owner._buffers:
+        owner._buffers[attr] = tensor.to_sparse() if sparse else tensor
+    else:
+        raise KeyError(f"'{name}' is not a parameter or buffer of {type(module).__name__}")
+
+
+def assign_shared(module, shared):
+    # Point every parameter and buffer at the mapped tensors; the module's own copies are released
+    sparse = set(shared["sparse"])
+    expected = {name for name, _ in module.named_parameters()} | {name for name, _ in module.named_buffers()}
+    missing = expected - set(shared["tensors"])
+    if missing:
+        raise KeyError(f"Shared weights are missing {sorted(missing)[:5]}")
+    for name, tensor in shared["tensors"].items():
+        _set_tensor(module, name, tensor, name in sparse)
+    return module.eval()
+
+
+def load_shared_module(name, build, materialize, meta_init=True):
+    # build(meta) constructs the model, on the meta device when meta_init (no weight memory is
+    # allocated); the tensors then all come from the shared file. Models whose constructor runs ops
+    # the meta device lacks (Whisper's sparse alignment heads) are built normally and their freshly
+    # initialised weights freed once the mapped ones are assigned
+    path = shared_path(name)
+    ensure_exported(path, materialize)
+    shared = load_shared(path)
+    if meta_init:
+        with torch.device("meta"):
+            module = build(shared["meta"])
+    else:
+        module = build(shared["meta"])
+    return assign_shared(module, shared)
+
+
+def share_loaded_module(name, module):
+    # For models that can only be built by their own loader (SpeechBrain): swap the freshly loaded
+    # private tensors for the shared mapping
+    path = shared_path(name)
+    ensure_exported(path, lambda: (module, {}))
+    return assign_shared(module, load_shared(path))
@@ -0,0 +1,139 @@
+import os
+
+import numpy as np
+import torch
+
+from src.audio_decode import resample_audio
+from src.shared_weights import file_tag, load_shared_module, share_loaded_module
+
+ECAPA_SOURCE = "pretrained_models/spkrec-ecapa-voxceleb"
+VOICE_MODEL_PATH = os.environ.get(
+    "VOICE_MODEL_PATH", os.path.join(os.path.dirname(__file__), "pth_models", "voice_model.pth")
+)
+
+
+class EcapaBackend:
+    # SpeechBrain spkrec-ecapa-voxceleb: raw 16 kHz waveforms in, Fbank and sentence mean
+    # normalisation happen inside the model, 192-dim embeddings out
+
+    name = "ecapa"
+    sample_rate = 16000
+    embedding_dim = 192
+
+    def __init__(self, model, sample_rate=None):
+        self.model = model
+        if sample_rate:
+            self.sample_rate = sample_rate
+
+    @classmethod
+    def load(cls, sample_rate=None, shared=False, source=ECAPA_SOURCE):
+        from speechbrain.inference.speaker import SpeakerRecognition
+
+        model = SpeakerRecognition.from_hparams(source=source)
+        if shared:
+            # SpeechBrain builds the modules itself, the loaded weights are then swapped for the shared ones
+            checkpoint = os.path.join(source, "embedding_model.ckpt")
+            tag = file_tag(checkpoint) if os.path.exists(checkpoint) else "ecapa"
+            share_loaded_module(f"speaker-{tag}", model.mods)
+        return cls(model, sample_rate)
+
+    def preprocess(self, y):
+        return np.asarray(y, dtype=np.float32)
+
+    def encode_batch(self, waveforms):
+        # Zero padded to the longest clip, with wav_lens (relative lengths) so the normalisation and
+        # attentive pooling ignore the padding. (N, 192) array
+        waveforms = [self.preprocess(y) for y in waveforms]
+        longest = max(len(y) for y in waveforms)
+        batch = torch.zeros(len(waveforms), longest)
+        for i, y in enumerate(waveforms):
+            batch[i, :len(y)] = torch.tensor(y)
+        wav_lens = torch.tensor([len(y) / longest for y in waveforms])
+
+        with torch.no_grad():
+            embeddings = self.model.encode_batch(batch, wav_lens)
+        return embeddings.reshape(len(waveforms), -1).cpu().numpy()
+
+
+class FusionBackend:
+    # voice_audio.AudioFusionModel, trained in ml-models/voice-identification.ipynb: 22.05 kHz audio
+    # trimmed, RMS normalised and cut/padded to 6 s, then a 128x259 mel spectrogram plus time-averaged
+    # MFCC (20), chroma, tonnetz and spectral contrast. 128-dim unit-length embeddings out
+
+    name = "fusion"
+    sample_rate = 22050
+    embedding_dim = 128
+    target_duration = 6.0
+
+    def __init__(self, model, sample_rate=None):
+        self.check_sample_rate(sample_rate)
+        self.model = model.eval()
+
+    @classmethod
+    def check_sample_rate(cls, sample_rate):
+        # The features are tied to the training rate, another SPEAKER_SAMPLE_RATE can't be honoured
+        if sample_rate and sample_rate != cls.sample_rate:
+            raise ValueError(f"The {cls.name} speaker backend only runs at {cls.sample_rate} Hz, "
+                             f"got SPEAKER_SAMPLE_RATE={sample_rate}")
+
+    @classmethod
+    def load(cls, sample_rate=None, shared=False, path=VOICE_MODEL_PATH):
+        from src.voice_audio import AudioFusionModel
+
+        cls.check_sample_rate(sample_rate)
+
+        def load_model():
+            model = AudioFusionModel()
+            model.load_state_dict(torch.load(path, map_location="cpu", weights_only=True))
+            return model.eval()
+
+        if shared:
+            return cls(load_shared_module(f"voice-fusion-{file_tag(path)}", lambda meta: AudioFusionModel(),
+                                          lambda: (load_model(), {})), sample_rate)
+        return cls(load_model(), sample_rate)
+
+    def preprocess(self, y):
+        from src.voice_preprocess import preprocess_audio
+
+        return preprocess_audio(np.asarray(y, dtype=np.float32), self.sample_rate, self.target_duration)
+
+    def features(self, waveforms):
+        # Every clip is exactly target_duration long after preprocessing, so the whole batch goes
+        # through the batched torch feature backend in one pass
+        from src.torch_features import extract_voice_features_batch
+
+        batch = np.stack([self.preprocess(y) for y in waveforms]).astype(np.float32)
+        features = extract_voice_features_batch(batch, self.sample_rate)
+        return (
+            features["mel_spectrogram"].unsqueeze(1),
+            features["mfcc"],
+            features["chroma"],
+            features["tonnetz"],
+            features["spectral_contrast"],
+        )
+
+    def encode_batch(self, waveforms):
+        with torch.no_grad():
+            embeddings = self.model(*self.features(waveforms))
+        return embeddings.cpu().numpy()
+
+
+SPEAKER_BACKENDS = {backend.name: backend for backend in (EcapaBackend, FusionBackend)}
+
+
+def get_backend_class(name):
+    if name not in SPEAKER_BACKENDS:
+        raise ValueError(f"Unknown speaker backend '{name}', expected one of {sorted(SPEAKER_BACKENDS)}")
+    return SPEAKER_BACKENDS[name]
+
+
+def configured_backend():
+    # (backend class, sample rate) from SPEAKER_BACKEND / SPEAKER_SAMPLE_RATE, read the same way by
+    # the server and src.batch_score
+    backend_class = get_backend_class(os.environ.get("SPEAKER_BACKEND", "ecapa"))
+    return backend_class, int(os.environ.get("SPEAKER_SAMPLE_RATE", backend_class.sample_rate))
+
+
+def embed_one(backend, y, sr):
+    # Embedding of one decoded waveform sampled at sr, resampled to the backend's rate first
+    return backend.encode_batch([resample_audio(y, sr, backend.sample_rate)])[0].tolist()
@@ -0,0 +1,145 @@
+import fcntl
+import json
+import os
+import threading
+
+import numpy as np
+
+
+class SpeakerIndex:
+    # 1:N speaker identification over every enrolled embedding.
+    # Embeddings are L2-normalised rows of one float32 matrix, so cosine similarity against
+    # all users is a single matrix-vector product. Rows are added/removed incrementally
+    # (removal swaps the last row into the hole) and the matrix can be saved and memory-mapped back.
+
+    def __init__(self, dim=192, capacity=1024):
+        self.dim = dim
+        self._matrix = np.zeros((max(1, capacity), dim), dtype=np.float32)
+        self._uids = []
+        self._rows = {}
+        self._lock = threading.Lock()
+        # Wall-clock time the rows were last known to match the source they were built from, and
+        # source ids that were looked at but not indexed (e.g. no embedding), both kept with save()
+        self.synced_at = None
+        self.skipped = []
+
+    def __len__(self):
+        return len(self._uids)
+
+    @staticmethod
+    def _normalise(embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+    def _reserve(self, size):
+        # Grow by doubling; also turns a memory-mapped matrix into an in-memory one
+        if size <= self._matrix.shape[0] and self._matrix.flags.writeable:
+            return
+        capacity = max(size, 2 * self._matrix.shape[0])
+        matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+        matrix[:len(self._uids)] = self._matrix[:len(self._uids)]
+        self._matrix = matrix
+
+    def add(self, uid, embedding):
+        self.add_many([uid], [embedding])
+
+    def add_many(self, uids, embeddings):
+        vectors = self._normalise(embeddings)
+        if vectors.ndim != 2 or vectors.shape != (len(uids), self.dim):
+            raise ValueError(f"Expected {len(uids)} embeddings of {self.dim} dimensions, got shape {vectors.shape}")
+        with self._lock:
+            self._reserve(len(self._uids) + len(uids))
+            for uid, vector in zip(uids, vectors):
+                row = self._rows.get(uid)
+                if row is None:
+                    row = len(self._uids)
+                    self._uids.append(uid)
+                    self._rows[uid] = row
+                self._matrix[row] = vector
+
+    def remove(self, uid):
+        with self._lock:
+            row = self._rows.pop(uid, None)
+            if row is None:
+                return False
+            self._reserve(len(self._uids))
+
+            # Move the last row into the freed slot to keep the matrix dense
+            last = len(self._uids) - 1
+            if row != last:
+                last_uid = self._uids[last]
+                self._matrix[row] = self._matrix[last]
+                self._uids[row] = last_uid
+                self._rows[last_uid] = row
+            self._uids.pop()
+            return True
+
+    def search(self, embedding, k=5):
+        probe = self._normalise(embedding)
+        if probe.shape != (self.dim,):
+            raise ValueError(f"Expected a {self.dim} dimensional embedding, got shape {probe.shape}")
+        with self._lock:
+            n = len(self._uids)
+            if n == 0:
+                return []
+            scores = self._matrix[:n] @ probe
+            uids = list(self._uids)
+
+        k = min(k, n)
+        # argpartition is O(n); only the k winners get sorted
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(uids[i], float(scores[i])) for i in top]
+
+    def save(self, path):
+        # <path>.npy holds the matrix, <path>.uids.json the row -> uid mapping and sync state. Both are
+        # written to temp files and renamed into place: the index may itself be a memory map of the
+        # old <path>.npy, which must not be truncated while it is being copied
+        with self._lock:
+            n = len(self._uids)
+            matrix = np.array(self._matrix[:n], dtype=np.float32)
+            meta = {"uids": list(self._uids), "dim": self.dim, "synced_at": self.synced_at, "skipped": list(self.skipped)}
+
+        for suffix, write in ((".npy", lambda f: np.save(f, matrix)), (".uids.json", lambda f: f.write(json.dumps(meta).encode()))):
+            tmp_path = f"{path}{suffix}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                write(f)
+            os.replace(tmp_path, path + suffix)
+
+    @classmethod
+    def exists(cls, path):
+        return os.path.exists(path + ".npy") and os.path.exists(path + ".uids.json")
+
+    @classmethod
+    def load(cls, path):
+        # Memory-mapped read-only; the first add/remove copies it into memory
+        # Files from before the sync state was kept hold a bare uid list
+        matrix = np.load(path + ".npy", mmap_mode="r")
+        with open(path + ".uids.json") as f:
+            meta = json.load(f)
+        if isinstance(meta, list):
+            meta = {"uids": meta}
+        uids = meta["uids"]
+        if len(uids) != matrix.shape[0]:
+            raise ValueError(f"{path}.npy has {matrix.shape[0]} rows for {len(uids)} uids")
+
+        index = cls(dim=matrix.shape[1], capacity=1)
+        index._matrix = matrix
+        index._uids = uids
+        index._rows = {uid: row for row, uid in enumerate(uids)}
+        index.synced_at = meta.get("synced_at")
+        index.skipped = meta.get("skipped", [])
+        return index
+
+
+def claim_save_lock(path):
+    # With several workers only one should write <path>: the first to take <path>.lock keeps it
+    # (the returned file) for as long as it runs; None if another process holds it
+    lock = open(path + ".lock", "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
@@ -0,0 +1,256 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+from scipy import fft as sp_fft
+from scipy.ndimage import uniform_filter1d
+
+# NOISE_REDUCTION: "on" runs spectral gating on the audio Whisper and the speaker model see (never
+# on the deepfake input, the gate would smooth away the artifacts it looks for) or "off"
+NOISE_REDUCTION = os.environ.get("NOISE_REDUCTION", "off")
+
+# STFT frame length, rounded up to a power of two (512 at 16 kHz, 1024 at 22.05 kHz), hop of a quarter frame
+NOISE_FRAME_SECONDS = float(os.environ.get("NOISE_FRAME_SECONDS", "0.032"))
+# A bin is speech if it is this many standard deviations above the noise profile's mean level
+NOISE_THRESHOLD_STD = float(os.environ.get("NOISE_THRESHOLD_STD", "1.5"))
+# How much gated bins are attenuated, 1.0 removes them completely
+NOISE_PROP_DECREASE = float(os.environ.get("NOISE_PROP_DECREASE", "1.0"))
+# The mask is smoothed over this much bandwidth and released over this long, against musical noise
+NOISE_SMOOTH_HZ = float(os.environ.get("NOISE_SMOOTH_HZ", "250"))
+NOISE_RELEASE_SECONDS = float(os.environ.get("NOISE_RELEASE_SECONDS", "0.05"))
+# The quietest NOISE_PROFILE_PERCENTILE % of the frames are taken as noise; a SpectralGate without a
+# profile looks at the first NOISE_PROFILE_SECONDS of its input only
+NOISE_PROFILE_PERCENTILE = float(os.environ.get("NOISE_PROFILE_PERCENTILE", "20"))
+NOISE_PROFILE_SECONDS = float(os.environ.get("NOISE_PROFILE_SECONDS", "1.0"))
+
+# Sum of the squared periodic Hann windows overlapping at any sample with a hop of a quarter frame
+_WINDOW_GAIN = 1.5
+
+
+def frame_length(sr):
+    return 1 << max(6, int(np.ceil(np.log2(sr * NOISE_FRAME_SECONDS))))
+
+
+@dataclass(frozen=True, eq=False)
+class NoiseProfile:
+    # Per frequency bin level of the background noise in dB, for one sample rate and frame length
+    sr: int
+    n_fft: int
+    mean_db: np.ndarray
+    std_db: np.ndarray
+    frames: int
+
+    def tag(self):
+        # Short fingerprint, for cache keys of anything computed on audio gated with this profile
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(self.mean_db.tobytes())
+        digest.update(self.std_db.tobytes())
+        return digest.hexdigest()
+
+    def threshold_power(self):
+        # |X|^2 a bin has to exceed to count as speech
+        return (10 ** ((self.mean_db + NOISE_THRESHOLD_STD * self.std_db) / 10)).astype(np.float32)
+
+
+def _profile_from_spectrum(spectrum, sr, n_fft):
+    # Quietest frames of a (frames, bins) STFT; frames of digital silence (padding, muted input)
+    # say nothing about the microphone and are left out
+    power = np.einsum("ij,ij->i", spectrum.real, spectrum.real) + np.einsum("ij,ij->i", spectrum.imag, spectrum.imag)
+    candidates = np.flatnonzero(power > 1e-10)
+    if len(candidates):
+        count = max(1, int(np.ceil(len(candidates) * NOISE_PROFILE_PERCENTILE / 100)))
+        quietest = candidates[np.argsort(power[candidates], kind="stable")[:count]]
+        db = 20 * np.log10(np.abs(spectrum[quietest]) + 1e-10)
+        mean_db, std_db = db.mean(axis=0), db.std(axis=0)
+    else:
+        mean_db = np.full(spectrum.shape[1], -200.0)
+        std_db = np.zeros(spectrum.shape[1])
+        quietest = ()
+    mean_db, std_db = mean_db.astype(np.float32), std_db.astype(np.float32)
+    mean_db.flags.writeable = False
+    std_db.flags.writeable = False
+    return NoiseProfile(sr=sr, n_fft=n_fft, mean_db=mean_db, std_db=std_db, frames=len(quietest))
+
+
+def estimate_noise_profile(y, sr):
+    # Profile of a whole recording, best taken on the untrimmed audio so the silence around the
+    # speech counts and not just the pauses inside it
+    n_fft = frame_length(sr)
+    y = np.asarray(y, dtype=np.float32).reshape(-1)
+    if len(y) < n_fft:
+        y = np.pad(y, (0, n_fft - len(y)))
+    window = np.hanning(n_fft + 1)[:-1].astype(np.float32)
+    frames = np.lib.stride_tricks.sliding_window_view(y, n_fft)[::n_fft // 4]
+    return _profile_from_spectrum(sp_fft.rfft(frames * window, axis=1), sr, n_fft)
+
+
+class SpectralGate:
+    # Streaming spectral gating: feed any number of chunks to process() and call flush() at the end.
+    # Each call frames the new samples, takes one vectorised STFT, gates every bin below the noise
+    # profile's threshold and overlap-adds the result, so the output is identical however the input
+    # was chunked, and lags the input by at most one frame. The concatenated output has exactly the
+    # length of the input.
+    # Without a profile one is estimated from the first NOISE_PROFILE_SECONDS of audio (input is
+    # held back until that much has arrived) and kept in .profile, so it can be reused for the
+    # device's next recordings.
+
+    def __init__(self, sr, profile=None):
+        self.sr = sr
+        self.n_fft = frame_length(sr)
+        self.hop = self.n_fft // 4
+        if profile is not None and (profile.sr, profile.n_fft) != (sr, self.n_fft):
+            raise ValueError(f"Noise profile is for {profile.sr} Hz / {profile.n_fft} point frames, "
+                             f"the gate runs at {sr} Hz / {self.n_fft}")
+        self.profile = profile
+        self._threshold = profile.threshold_power() if profile is not None else None
+
+        self.window = np.hanning(self.n_fft + 1)[:-1].astype(np.float32)
+        self.smooth_bins = max(1, int(round(NOISE_SMOOTH_HZ * self.n_fft / sr)))
+        self.log_release = -self.hop / (sr * NOISE_RELEASE_SECONDS) if NOISE_RELEASE_SECONDS > 0 else -np.inf
+
+        # The stream starts with n_fft - hop zeros, so the first real sample is covered by as many
+        # frames as every other one; that lead-in is dropped from the output
+        self._pending = np.zeros(self.n_fft - self.hop, dtype=np.float32)
+        self._overlap = np.zeros(self.n_fft - self.hop, dtype=np.float32)
+        self._skip = self.n_fft - self.hop
+        self._mask = np.zeros(self.n_fft // 2 + 1, dtype=np.float32)
+        self._received = 0
+        self._emitted = 0
+
+    def process(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float32).reshape(-1)
+        self._received += len(chunk)
+        self._pending = np.concatenate([self._pending, chunk])
+        if self.profile is None and self._received < self.sr * NOISE_PROFILE_SECONDS:
+            return np.zeros(0, dtype=np.float32)
+        return self._run()
+
+    def flush(self):
+        # Zero pad so every remaining sample is covered by full frames, then cut to the input length
+        self._pending = np.concatenate([self._pending, np.zeros(self.n_fft, dtype=np.float32)])
+        y = self._run()
+        y = y[:max(0, self._received - self._emitted + len(y))]
+        self._emitted = self._received
+        return y
+
+    def _run(self):
+        n_frames = (len(self._pending) - self.n_fft) // self.hop + 1
+        if n_frames <= 0:
+            return np.zeros(0, dtype=np.float32)
+        frames = np.lib.stride_tricks.sliding_window_view(self._pending, self.n_fft)[::self.hop][:n_frames]
+        spectrum = sp_fft.rfft(frames * self.window, axis=1)
+
+        if self.profile is None:
+            # Only frames that lie entirely within the first NOISE_PROFILE_SECONDS of real input, so
+            # the profile (and the output) doesn't depend on how the input was chunked: frame f covers
+            # input samples f * hop - (n_fft - hop) onwards, the first ones overlap the zero lead-in
+            lead_in = (self.n_fft - self.hop) // self.hop
+            end = min(int(self.sr * NOISE_PROFILE_SECONDS), self._received) // self.hop
+            self.profile = _profile_from_spectrum(spectrum[lead_in:end] if end > lead_in else spectrum,
+                                                  self.sr, self.n_fft)
+            self._threshold = self.profile.threshold_power()
+        spectrum *= self._gains(spectrum)
+
+        # Overlap-add: frame f covers hops f..f+3, so each quarter of the frames lands on a shifted run of hops
+        out = sp_fft.irfft(spectrum, n=self.n_fft, axis=1) * self.window
+        complete = n_frames * self.hop
+        acc = np.zeros(complete + self.n_fft - self.hop, dtype=np.float32)
+        acc[:len(self._overlap)] += self._overlap
+        for q in range(self.n_fft // self.hop):
+            acc[q * self.hop:q * self.hop + complete] += out[:, q * self.hop:(q + 1) * self.hop].reshape(-1)
+
+        self._overlap = acc[complete:]
+        self._pending = self._pending[complete:]
+        y = acc[:complete] / _WINDOW_GAIN
+        if self._skip:
+            dropped = min(self._skip, len(y))
+            y, self._skip = y[dropped:], self._skip - dropped
+        self._emitted += len(y)
+        return y
+
+    def _gains(self, spectrum):
+        # Binary speech/noise decision per bin, smoothed across frequency, then held open for
+        # NOISE_RELEASE_SECONDS after speech: mask[t] = max(raw[t], release * mask[t - 1]), computed
+        # for all frames at once as a running maximum in the log domain
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        raw = (power > self._threshold).astype(np.float32)
+        if self.smooth_bins > 1:
+            raw = uniform_filter1d(raw, self.smooth_bins, axis=1, mode="nearest")
+
+        if np.isfinite(self.log_release):
+            steps = (np.arange(-1, len(raw), dtype=np.float32) * np.float32(self.log_release))[:, None]
+            log_mask = np.log(np.maximum(np.vstack([self._mask[None, :], raw]), np.float32(1e-6)))
+            log_mask -= steps
+            np.maximum.accumulate(log_mask, axis=0, out=log_mask)
+            log_mask += steps
+            mask = np.exp(log_mask[1:])
+        else:
+            mask = raw
+        self._mask = mask[-1]
+        return np.float32(1.0 - NOISE_PROP_DECREASE) + np.float32(NOISE_PROP_DECREASE) * mask
+
+
+def reduce_noise(y, sr, profile=None):
+    # Whole clip in one pass, (denoised waveform, profile used). Without a profile it is estimated
+    # from the same STFT the gate runs on
+    gate = SpectralGate(sr, profile)
+    y = np.concatenate([gate.process(y), gate.flush()])
+    return y, gate.profile
+
+
+class NoiseProfileCache:
+    # Noise profiles keyed by device (or user) and sample rate, so one estimate serves the device's
+    # next recordings. Entries expire after ttl_seconds, as the room or microphone may change, and
+    # the least recently used entry is evicted once max_entries is reached.
+
+    def __init__(self, max_entries=10000, ttl_seconds=900.0):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = float(ttl_seconds)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self.ttl > 0 and time.monotonic() - entry[1] > self.ttl):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, profile):
+        with self._lock:
+            self._entries[key] = (profile, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return profile
+
+    def invalidate(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
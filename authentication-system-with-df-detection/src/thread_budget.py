@@ -0,0 +1,156 @@
+import os
+import threading
+from dataclasses import dataclass, replace
+
+import torch
+
+# THREAD_BUDGET_MODE: "off" (torch/BLAS defaults, every model sizes its pools to the whole machine),
+# "budget" (each stage gets its own torch intra-op thread count) or "pinned" (budgets plus a core set
+# per stage, so Whisper, the deepfake model and the speaker model never share cores)
+THREAD_BUDGET_MODE = os.environ.get("THREAD_BUDGET_MODE", "off")
+# Process wide pools, applied once at startup when budgets are on
+BLAS_THREADS = int(os.environ.get("BLAS_THREADS", "1"))
+TORCH_INTEROP_THREADS = int(os.environ.get("TORCH_INTEROP_THREADS", "1"))
+
+# Share of the cores each model stage gets by default; decode and feature work is single threaded
+# librosa/NumPy and runs on whatever is left
+MODEL_STAGE_SHARES = {"transcribe": 0.5, "deepfake_model": 0.25, "embedding": 0.25}
+SINGLE_THREAD_STAGES = ("decode", "features", "firestore", "speaker_index")
+
+_ALL_CORES = tuple(sorted(os.sched_getaffinity(0))) if hasattr(os, "sched_getaffinity") else None
+_local = threading.local()
+# torch's intra-op thread count at startup, what a stage without a budget is explicitly set to
+_DEFAULT_THREADS = torch.get_num_threads()
+
+
+@dataclass(frozen=True)
+class ThreadBudget:
+    # torch intra-op threads for calls made by the stage (None = leave as is)
+    threads: int = None
+    # CPU ids the calling thread, and the OpenMP threads it starts, are pinned to (None = all)
+    cores: tuple = None
+
+
+def parse_cores(spec):
+    # "0-3,6" -> (0, 1, 2, 3, 6)
+    cores = set()
+    for part in str(spec).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            cores.update(range(int(start), int(end) + 1))
+        else:
+            cores.add(int(part))
+    return tuple(sorted(cores)) or None
+
+
+def budget_from_env(name):
+    # e.g. STAGE_TRANSCRIBE_THREADS=4, STAGE_TRANSCRIBE_CORES=0-3; None if neither is set
+    prefix = f"STAGE_{name.upper()}_"
+    threads, cores = os.environ.get(prefix + "THREADS"), os.environ.get(prefix + "CORES")
+    if not threads and not cores:
+        return None
+    return ThreadBudget(threads=int(threads) if threads else None, cores=parse_cores(cores) if cores else None)
+
+
+def default_budgets(stage_names, mode, cores=None):
+    # Splits the machine between the model stages by MODEL_STAGE_SHARES. In pinned mode every model
+    # stage gets a contiguous, disjoint core range of that size and the single threaded stages get
+    # the rest (all cores if nothing is left); with fewer cores than model stages ranges are shared
+    cores = tuple(cores or _ALL_CORES or range(os.cpu_count() or 1))
+    models = [name for name in MODEL_STAGE_SHARES if name in stage_names]
+    total = sum(MODEL_STAGE_SHARES[name] for name in models) or 1.0
+
+    budgets, offset = {}, 0
+    for name in models:
+        count = max(1, int(len(cores) * MODEL_STAGE_SHARES[name] / total))
+        if mode == "pinned":
+            start = offset if offset + count <= len(cores) else max(0, len(cores) - count)
+            budgets[name] = ThreadBudget(threads=count, cores=cores[start:start + count])
+            offset = start + count
+        else:
+            budgets[name] = ThreadBudget(threads=count)
+
+    rest = cores[offset:] or cores
+    for name in stage_names:
+        if name not in budgets:
+            budgets[name] = ThreadBudget(threads=1, cores=rest if mode == "pinned" else None)
+    return budgets
+
+
+def plan_stage_budgets(stages, mode=None, cores=None):
+    # Fills in the budget of every StageConfig that has none from default_budgets; explicit
+    # STAGE_<NAME>_THREADS / _CORES settings are kept. With mode "off" the configs are unchanged
+    mode = mode or THREAD_BUDGET_MODE
+    if mode == "off":
+        return dict(stages)
+    if mode not in ("budget", "pinned"):
+        raise ValueError(f"Unknown THREAD_BUDGET_MODE '{mode}', expected off, budget or pinned")
+    defaults = default_budgets(list(stages), mode, cores)
+    planned = {}
+    for name, config in stages.items():
+        budget = config.budget or defaults[name]
+        if mode == "budget" and config.budget is None:
+            budget = replace(budget, cores=None)
+        planned[name] = replace(config, budget=budget)
+    return planned
+
+
+def configure_process_threads(mode=None, blas_threads=BLAS_THREADS, interop_threads=TORCH_INTEROP_THREADS):
+    # Process wide settings that can't be per stage: BLAS pools (OpenBLAS/MKL keep one global count)
+    # and torch's inter-op pool, which can only be sized before its first use. Call once at startup
+    mode = mode or THREAD_BUDGET_MODE
+    if mode == "off":
+        return {}
+    applied = {}
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+            applied["torch_interop_threads"] = interop_threads
+        except RuntimeError:
+            pass  # already started, keeps its size
+    if blas_threads:
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            threadpool_limits = None
+        if threadpool_limits is not None:
+            threadpool_limits(limits=blas_threads, user_api="blas")
+            applied["blas_threads"] = blas_threads
+    return applied
+
+
+def apply_budget(budget):
+    # Applied on the worker thread right before a stage call. The CPU affinity is per thread, torch's
+    # thread count only partly: torch.set_num_threads sets the calling thread's OpenMP count but also
+    # a process wide value (and MKL's global count), which every thread that hasn't set its own picks
+    # up on its first parallel op. So a stage without a budget is set to the startup count explicitly
+    # rather than left alone, or it would run with whatever budget another stage applied last. Cached
+    # per thread; StageExecutor gives every budgeted stage its own threads, so each is set up once
+    budget = budget or ThreadBudget(threads=_DEFAULT_THREADS)
+    if getattr(_local, "budget", None) == budget:
+        return
+    if budget.threads:
+        torch.set_num_threads(budget.threads)
+    if hasattr(os, "sched_setaffinity"):
+        cores = budget.cores or _ALL_CORES
+        if cores and cores != getattr(_local, "cores", None):
+            os.sched_setaffinity(0, cores)
+            _local.cores = cores
+    _local.budget = budget
+
+
+def run_with_budget(budget, fn, *args):
+    # Module level so it pickles for the process pool
+    apply_budget(budget)
+    return fn(*args)
+
+
+def describe_budgets(stages):
+    return {
+        name: {"threads": config.budget.threads, "cores": list(config.budget.cores) if config.budget.cores else None}
+        if config.budget is not None else None
+        for name, config in stages.items()
+    }
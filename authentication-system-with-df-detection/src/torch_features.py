@@ -0,0 +1,317 @@
+"""
+Batched torch backend for the spectral features.
+
+TorchFeatureExtractor takes a (B, T) batch of preprocessed waveforms and computes the STFT, mel
+spectrogram, MFCC, RMS, zero crossing rate, spectral centroid, spectral contrast and onset strength
+for every clip at once as tensor ops, reproducing the librosa calls used in deepfake_preprocess_audio
+and voice_preprocess (same windows, padding, filterbanks and dB scaling).
+
+Chroma (tuning estimate), tonnetz (HPSS + CQT) and pitch (YIN) have no batched equivalent here and
+are still computed per clip with librosa by dfextract_features_batch / extract_voice_features_batch.
+
+Check parity against librosa with (exits non-zero on failure):
+
+    python -m src.torch_features --audio a.webm b.wav --tolerance 1e-3
+
+Every feature must be within --tolerance relative to its peak, except spectral contrast, which is in
+dB and is held to a mean absolute difference (--contrast-tolerance-db).
+"""
+
+import argparse
+import json
+import sys
+
+import librosa
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from src.deepfake_preprocess_audio import (
+    DF_FEATURE_ORDER, DF_HOP_LENGTH, DF_N_FFT, DF_N_MELS, _df_chroma_basis, _df_mel_basis, _dfharmonic,
+)
+
+AMIN = 1e-10
+TOP_DB = 80.0
+
+
+def power_to_db(S, top_db=TOP_DB):
+    # librosa.power_to_db with ref=1.0, clipped top_db below the max of each clip
+    log_spec = 10.0 * torch.log10(torch.clamp(S, min=AMIN))
+    if top_db is not None:
+        peak = log_spec.amax(dim=tuple(range(1, log_spec.ndim)), keepdim=True)
+        log_spec = torch.maximum(log_spec, peak - top_db)
+    return log_spec
+
+
+def _dct_basis(n_mfcc, n_mels):
+    # Orthonormal DCT-II, what librosa.feature.mfcc applies over the mel axis
+    n = np.arange(n_mels)
+    k = np.arange(n_mfcc)[:, None]
+    basis = np.cos(np.pi * k * (2 * n + 1) / (2 * n_mels)) * np.sqrt(2.0 / n_mels)
+    basis[0] /= np.sqrt(2.0)
+    return torch.tensor(basis, dtype=torch.float32)
+
+
+def _frame(y, frame_length, hop_length, pad_mode):
+    # Centered framing as in librosa.util.frame after padding by frame_length // 2: (B, n_frames, frame_length)
+    y = F.pad(y.unsqueeze(1), (frame_length // 2, frame_length // 2), mode=pad_mode).squeeze(1)
+    return y.unfold(-1, frame_length, hop_length)
+
+
+class TorchFeatureExtractor:
+    def __init__(self, sr=22050, n_fft=DF_N_FFT, hop_length=DF_HOP_LENGTH, n_mels=DF_N_MELS, device="cpu"):
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.device = torch.device(device)
+
+        self.window = torch.hann_window(n_fft, periodic=True, device=self.device)
+        self.mel_basis = torch.tensor(_df_mel_basis(sr, n_fft, n_mels), device=self.device)
+        self.freqs = torch.tensor(librosa.fft_frequencies(sr=sr, n_fft=n_fft), dtype=torch.float32, device=self.device)
+        self._dct = {}
+        self._contrast_bands = self._build_contrast_bands()
+
+    def _build_contrast_bands(self, n_bands=6, fmin=200.0, quantile=0.02):
+        # Same octave bands (and edge-bin handling) as librosa.feature.spectral_contrast
+        freq = self.freqs.cpu().numpy()
+        octa = np.zeros(n_bands + 2)
+        octa[1:] = fmin * (2.0 ** np.arange(0, n_bands + 1))
+        bands = []
+        for k, (f_low, f_high) in enumerate(zip(octa[:-1], octa[1:])):
+            current = np.logical_and(freq >= f_low, freq <= f_high)
+            idx = np.flatnonzero(current)
+            if k > 0:
+                current[idx[0] - 1] = True
+            if k == n_bands:
+                current[idx[-1] + 1:] = True
+            rows = np.flatnonzero(current)
+            if k < n_bands:
+                rows = rows[:-1]
+            count = int(max(np.rint(quantile * np.sum(current)), 1))
+            bands.append((torch.tensor(rows, device=self.device), count))
+        return bands
+
+    def dct(self, n_mfcc, n_mels):
+        if (n_mfcc, n_mels) not in self._dct:
+            self._dct[(n_mfcc, n_mels)] = _dct_basis(n_mfcc, n_mels).to(self.device)
+        return self._dct[(n_mfcc, n_mels)]
+
+    def as_batch(self, waveforms):
+        y = torch.as_tensor(np.asarray(waveforms) if not torch.is_tensor(waveforms) else waveforms, dtype=torch.float32)
+        return (y if y.ndim == 2 else y.unsqueeze(0)).to(self.device)
+
+    def stft(self, y):
+        # (B, 1 + n_fft/2, frames) complex, librosa.stft defaults (center=True, zero padding).
+        # Computed in double like numpy's FFT: single-precision FFT error swamps the near-silent bins
+        # that spectral contrast's valleys (and dB scaling) are taken from
+        return torch.stft(y.double(), self.n_fft, self.hop_length, window=self.window.double(), center=True,
+                          pad_mode="constant", return_complex=True)
+
+    def mfcc(self, mel_db, n_mfcc=20):
+        return torch.einsum("km,bmt->bkt", self.dct(n_mfcc, mel_db.shape[-2]), mel_db)
+
+    def rms(self, y):
+        frames = _frame(y, self.n_fft, self.hop_length, "constant")
+        return torch.sqrt(torch.mean(frames ** 2, dim=-1)).unsqueeze(1)
+
+    def zero_crossing_rate(self, y, threshold=1e-10):
+        # librosa pads with edge values here, zeros below threshold count as positive
+        frames = _frame(y, self.n_fft, self.hop_length, "replicate")
+        frames = torch.where(frames.abs() <= threshold, torch.zeros_like(frames), frames)
+        sign = torch.signbit(frames)
+        crossings = (sign[..., 1:] != sign[..., :-1]).sum(dim=-1)
+        return (crossings.float() / self.n_fft).unsqueeze(1)
+
+    def spectral_centroid(self, magnitude):
+        norm = magnitude.sum(dim=-2, keepdim=True)
+        norm = torch.where(norm < torch.finfo(magnitude.dtype).tiny, torch.ones_like(norm), norm)
+        return torch.sum(self.freqs[:, None] * (magnitude / norm), dim=-2, keepdim=True)
+
+    def spectral_contrast(self, magnitude):
+        valleys, peaks = [], []
+        for rows, count in self._contrast_bands:
+            ordered = torch.sort(magnitude.index_select(-2, rows), dim=-2).values
+            valleys.append(ordered[..., :count, :].mean(dim=-2))
+            peaks.append(ordered[..., -count:, :].mean(dim=-2))
+        valley = torch.stack(valleys, dim=-2).double()
+        peak = torch.stack(peaks, dim=-2).double()
+        return (power_to_db(peak) - power_to_db(valley)).float()
+
+    def onset_strength(self, mel_db, lag=1):
+        # librosa.onset.onset_strength(S=mel_db) with its default centering
+        onset = torch.clamp(mel_db[..., lag:] - mel_db[..., :-lag], min=0.0).mean(dim=-2, keepdim=True)
+        pad = lag + self.n_fft // (2 * self.hop_length)
+        return F.pad(onset, (pad, 0))[..., :mel_db.shape[-1]]
+
+    def spectral(self, waveforms, n_mfcc=20):
+        # Every batched feature for a (B, T) batch, each shaped (B, n, frames) like the librosa output
+        y = self.as_batch(waveforms)
+        stft = self.stft(y)
+        magnitude = stft.abs().float()
+        power = magnitude ** 2
+        mel = torch.einsum("mf,bft->bmt", self.mel_basis, power)
+        mel_db = power_to_db(mel)
+        return {
+            "y": y,
+            "magnitude": magnitude,
+            "power": power,
+            "mel_spectrogram": mel,
+            "mfcc": self.mfcc(mel_db, n_mfcc),
+            "energy": self.rms(y),
+            "zcr": self.zero_crossing_rate(y),
+            "spectral_centroid": self.spectral_centroid(magnitude),
+            "spectral_contrast": self.spectral_contrast(magnitude),
+            "onset_strength": self.onset_strength(mel_db),
+        }
+
+    def chroma(self, power):
+        # The chroma filterbank depends on each clip's estimated tuning, so only the projection is batched
+        bases = []
+        for clip in power.cpu().numpy():
+            tuning = librosa.estimate_tuning(S=clip, sr=self.sr, bins_per_octave=12)
+            bases.append(torch.tensor(_df_chroma_basis(self.sr, tuning, self.n_fft)))
+        chroma = torch.einsum("bcf,bft->bct", torch.stack(bases).to(self.device), power)
+        norm = chroma.abs().amax(dim=-2, keepdim=True)
+        norm = torch.where(norm < torch.finfo(chroma.dtype).tiny, torch.ones_like(norm), norm)
+        return chroma / norm
+
+
+_extractors = {}
+
+
+def get_extractor(sr=22050, device="cpu"):
+    if (sr, device) not in _extractors:
+        _extractors[(sr, device)] = TorchFeatureExtractor(sr=sr, device=device)
+    return _extractors[(sr, device)]
+
+
+def fit_batch(tensor, target_shape=(128, 259)):
+    # Batched dfpad_or_resize: crop then zero pad every clip's (h, w) feature to target_shape
+    h, w = target_shape
+    tensor = tensor[:, :h, :w]
+    return F.pad(tensor, (0, w - tensor.shape[-1], 0, h - tensor.shape[-2]))
+
+
+def dfraw_features_batch(waveforms, sr=22050, device="cpu"):
+    # Raw (unpadded) features for a batch of preprocessed clips, same keys and shapes as dfextract_raw_features
+    extractor = get_extractor(sr, device)
+    spectral = extractor.spectral(waveforms)
+    y = spectral["y"]
+
+    features = {k: spectral[k] for k in ("mfcc", "spectral_contrast", "onset_strength", "spectral_centroid",
+                                         "mel_spectrogram", "energy", "zcr")}
+    features["chroma"] = extractor.chroma(spectral["power"])
+
+    # Per clip: HPSS/CQT for tonnetz and YIN for pitch
+    tonnetz, pitch = [], []
+    stft = librosa.stft(y.cpu().numpy(), n_fft=DF_N_FFT, hop_length=DF_HOP_LENGTH)
+    for clip, clip_stft in zip(y.cpu().numpy(), stft):
+        tonnetz.append(librosa.feature.tonnetz(y=_dfharmonic(clip, clip_stft), sr=sr))
+        pitch.append(librosa.yin(clip, fmin=50, fmax=300, sr=sr).reshape(1, -1))
+    features["tonnetz"] = torch.tensor(np.stack(tonnetz), dtype=torch.float32, device=extractor.device)
+    features["pitch"] = torch.tensor(np.stack(pitch), dtype=torch.float32, device=extractor.device)
+    return {k: features[k] for k in DF_FEATURE_ORDER}
+
+
+def dfextract_features_batch(waveforms, sr=22050, target_shape=(128, 259), pooled=False, device="cpu"):
+    # (B, T) preprocessed clips (dfpreprocess_audio output) -> model inputs with a batch dimension of B:
+    # (B, 128, 259) per feature, or with pooled=True mfcc (B, 128, 259) plus nine (B, 128) vectors for forward_pooled
+    features = dfraw_features_batch(waveforms, sr, device)
+    out = {}
+    for k, tensor in features.items():
+        fitted = fit_batch(tensor.float(), target_shape)
+        out[k] = fitted.mean(dim=-1) if pooled and k != "mfcc" else fitted
+    return out
+
+
+def extract_voice_features_batch(waveforms, sr=22050, mel_shape=(128, 259), device="cpu"):
+    # Batched voice_preprocess.extract_features_from_audio: mel (B, 128, 259) and time-averaged vectors (B, n)
+    extractor = get_extractor(sr, device)
+    spectral = extractor.spectral(waveforms, n_mfcc=20)
+
+    tonnetz = [
+        librosa.feature.tonnetz(y=librosa.effects.harmonic(clip), sr=sr).mean(axis=1)
+        for clip in spectral["y"].cpu().numpy()
+    ]
+    return {
+        "mel_spectrogram": fit_batch(spectral["mel_spectrogram"], mel_shape),
+        "mfcc": spectral["mfcc"].mean(dim=-1),
+        "chroma": extractor.chroma(spectral["power"]).mean(dim=-1),
+        "tonnetz": torch.tensor(np.stack(tonnetz), dtype=torch.float32, device=extractor.device),
+        "spectral_contrast": spectral["spectral_contrast"].mean(dim=-1),
+    }
+
+
+def parity_report(waveforms, sr=22050):
+    # Max absolute, mean absolute and max relative (to the feature's peak magnitude) difference between
+    # the batched backend and librosa, per feature over every clip in the batch
+    from src.deepfake_preprocess_audio import dfextract_raw_features
+
+    batched = dfraw_features_batch(waveforms, sr)
+    report = {}
+    for b, clip in enumerate(np.asarray(waveforms, dtype=np.float32)):
+        reference = dfextract_raw_features(clip, sr)
+        for k in DF_FEATURE_ORDER:
+            ref = np.asarray(reference[k], dtype=np.float64)
+            got = batched[k][b].double().cpu().numpy()
+            if got.shape != ref.shape:
+                report[k] = {"shape_mismatch": [list(got.shape), list(ref.shape)]}
+                continue
+            diff = np.abs(got - ref)
+            abs_diff = float(np.max(diff))
+            rel_diff = abs_diff / max(float(np.max(np.abs(ref))), 1e-12)
+            entry = report.setdefault(k, {"max_abs_diff": 0.0, "mean_abs_diff": 0.0, "max_rel_diff": 0.0})
+            entry["max_abs_diff"] = max(entry["max_abs_diff"], abs_diff)
+            entry["mean_abs_diff"] = max(entry["mean_abs_diff"], float(np.mean(diff)))
+            entry["max_rel_diff"] = max(entry["max_rel_diff"], rel_diff)
+    return report
+
+
+def parity_ok(entry, feature, tolerance=1e-3, contrast_tolerance_db=0.5):
+    if "max_rel_diff" not in entry:
+        return False
+    if feature == "spectral_contrast":
+        # A peak/valley ratio in dB: frames whose valley sits in near-silent bins can move by a few dB
+        # between FFT implementations, so judge it on the mean difference in dB instead
+        return entry["mean_abs_diff"] <= contrast_tolerance_db
+    return entry["max_rel_diff"] <= tolerance
+
+
+def main(argv=None):
+    from src.audio_decode import decode_audio_bytes
+    from src.deepfake_preprocess_audio import dfpreprocess_audio
+
+    parser = argparse.ArgumentParser(description="Check the batched torch features against librosa")
+    parser.add_argument("--audio", nargs="*", default=None, help="clips to compare (default: synthetic clips)")
+    parser.add_argument("--batch", type=int, default=4, help="number of synthetic clips")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="max allowed relative difference")
+    parser.add_argument("--contrast-tolerance-db", type=float, default=0.5,
+                        help="max allowed mean absolute spectral contrast difference, in dB")
+    args = parser.parse_args(argv)
+
+    sr = 22050
+    if args.audio:
+        clips = []
+        for path in args.audio:
+            with open(path, "rb") as f:
+                clips.append(decode_audio_bytes(f.read(), sr))
+    else:
+        rng = np.random.default_rng(0)
+        t = np.arange(7 * sr) / sr
+        clips = [
+            (np.sin(2 * np.pi * (110 + 40 * i) * t * (1 + 0.05 * np.sin(2 * np.pi * 0.5 * t)))
+             * (0.5 + 0.5 * np.sin(2 * np.pi * 3 * t)) + 0.05 * rng.standard_normal(len(t))).astype(np.float32)
+            for i in range(args.batch)
+        ]
+    waveforms = np.stack([dfpreprocess_audio(clip, sr=sr, target_duration=6.0) for clip in clips])
+
+    report = parity_report(waveforms, sr)
+    for k, entry in report.items():
+        entry["ok"] = parity_ok(entry, k, args.tolerance, args.contrast_tolerance_db)
+    ok = all(entry["ok"] for entry in report.values())
+    print(json.dumps({"clips": len(waveforms), "tolerance": args.tolerance, "parity_ok": ok, "features": report}, indent=2))
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,20 @@
 import librosa
-import noisereduce as nr
 import numpy as np
 import numpy as np
 import torch
 import torch.nn.functional as F
 
-def preprocess_audio(y, sr, target_duration=6.0, apply_preemphasis=False, apply_reduction=False, coef=0.5, normalise='rms'):
+from src.speech_enhance import reduce_noise
+
+def preprocess_audio(y, sr, target_duration=6.0, apply_preemphasis=False, apply_reduction=False, coef=0.5, normalise='rms', noise_profile=None):
     
     # Trim leading/trailing silence
     y, _ = librosa.effects.trim(y)
 
-    # Apply noise reduction
+    # Apply noise reduction (spectral gating, see src/speech_enhance.py); noise_profile is a
+    # NoiseProfile estimated from an earlier recording of the same device, otherwise this clip's own
     if apply_reduction:
-        y = nr.reduce_noise(y=y, sr=sr)
+        y, _ = reduce_noise(y, sr, noise_profile)
 
     # Apply pre-emphasis filter
     if apply_preemphasis:
@@ -50,7 +52,7 @@ def pad_or_resize(tensor, target_shape=(128, 259)):
 def extract_features_from_audio(y, sr, mel_shape=(128, 259)):
     try:
         features_raw = {
-            "mfcc": librosa.feature.mfcc(y=y, sr=sr, n_mfcc=40),
+            "mfcc": librosa.feature.mfcc(y=y, sr=sr, n_mfcc=20),
             "chroma": librosa.feature.chroma_stft(y=y, sr=sr),
             "tonnetz": librosa.feature.tonnetz(y=librosa.effects.harmonic(y), sr=sr),
             "spectral_contrast": librosa.feature.spectral_contrast(y=y, sr=sr),
@@ -0,0 +1,84 @@
+import re
+
+import torch
+import torch.nn.functional as F
+import whisper
+
+
+def _clean_text(text: str) -> str:
+    return re.sub(r"[^\w\s]", "", text).lower().strip()
+
+
+class PassphraseVerifier:
+    # Checks a recording against a known passphrase instead of transcribing it open-ended.
+    #
+    # The audio is encoded once, then:
+    #  - the expected passphrase tokens are scored with a single teacher-forced decoder pass,
+    #    giving a confidence (geometric mean token probability)
+    #  - a greedy decode with a fixed language, temperature 0 (no fallback) and a length
+    #    bounded by the passphrase produces the transcript shown to the user
+    # The passphrase is confirmed if the transcript contains it or the confidence clears the threshold.
+
+    def __init__(self, model, language="en", threshold=0.6, extra_tokens=8):
+        self.model = model
+        self.language = language
+        self.threshold = threshold
+        self.extra_tokens = extra_tokens
+        self.tokenizer = whisper.tokenizer.get_tokenizer(
+            model.is_multilingual,
+            num_languages=model.num_languages,
+            language=language,
+            task="transcribe",
+        )
+        self.fp16 = next(model.parameters()).device.type == "cuda"
+
+    def _encode_audio(self, audio):
+        # Whisper's encoder always sees a 30 s window
+        mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), n_mels=self.model.dims.n_mels)
+        mel = mel.to(next(self.model.parameters()).device)
+        if self.fp16:
+            mel = mel.half()
+        return self.model.embed_audio(mel.unsqueeze(0))
+
+    def _target_variants(self, passphrase):
+        # Whisper usually capitalises the first word, so score both spellings
+        phrase = " ".join(passphrase.split())
+        variants = [phrase, phrase[:1].upper() + phrase[1:]]
+        return [self.tokenizer.encode(" " + v) for v in dict.fromkeys(variants)]
+
+    def score(self, audio_features, passphrase):
+        prefix = list(self.tokenizer.sot_sequence_including_notimestamps)
+        best = 0.0
+        for target in self._target_variants(passphrase):
+            tokens = torch.tensor([prefix + target], device=audio_features.device)
+            logits = self.model.logits(tokens, audio_features)[0].float()
+
+            # Logits at position i predict token i + 1
+            logprobs = F.log_softmax(logits[len(prefix) - 1:-1], dim=-1)
+            target_logprobs = logprobs.gather(-1, torch.tensor(target, device=logprobs.device)[:, None])
+            best = max(best, target_logprobs.mean().exp().item())
+        return best
+
+    def transcribe_bounded(self, audio_features, max_tokens):
+        options = whisper.DecodingOptions(
+            task="transcribe",
+            language=self.language,
+            temperature=0.0,
+            sample_len=max_tokens,
+            without_timestamps=True,
+            fp16=self.fp16,
+        )
+        return whisper.decode(self.model, audio_features, options)[0].text
+
+    @torch.no_grad()
+    def verify(self, audio, passphrase):
+        audio_features = self._encode_audio(audio)
+        confidence = self.score(audio_features, passphrase)
+
+        max_tokens = len(self.tokenizer.encode(" " + passphrase)) + self.extra_tokens
+        text = self.transcribe_bounded(audio_features, max_tokens)
+
+        cleaned_pass = _clean_text(passphrase)
+        confirmed = bool(cleaned_pass) and (cleaned_pass in _clean_text(text) or confidence >= self.threshold)
+
+        return {"text": text, "confirmed": confirmed, "confidence": round(confidence, 4)}
@@ -0,0 +1,154 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+
+from src.metrics import metrics
+from src.thread_budget import ThreadBudget, budget_from_env, run_with_budget
+
+STAGE_QUEUE_SECONDS = metrics.histogram(
+    "audioshield_stage_queue_seconds", "Time a call waited for a free slot in its worker pool stage", ("stage",)
+)
+STAGE_RUN_SECONDS = metrics.histogram(
+    "audioshield_stage_run_seconds", "Time from dispatch to result for each worker pool stage", ("stage",)
+)
+STAGE_IN_FLIGHT = metrics.gauge("audioshield_stage_in_flight", "Calls currently running in each worker pool stage", ("stage",))
+STAGE_TIMEOUTS = metrics.counter("audioshield_stage_timeouts_total", "Worker pool calls that hit their stage timeout", ("stage",))
+
+
+class StageTimeout(Exception):
+    pass
+
+
+@dataclass
+class StageConfig:
+    # Max number of concurrent calls for this stage
+    limit: int = 2
+    # Seconds to wait for a result before giving up (None = no timeout)
+    timeout: float = None
+    # "thread" or "process"; process is only for picklable, model-free functions
+    pool: str = "thread"
+    # torch threads / core set for the stage's calls (see src/thread_budget.py), None = process defaults
+    budget: ThreadBudget = None
+
+
+def stage_config_from_env(name, limit, timeout, pool="thread"):
+    # e.g. STAGE_TRANSCRIBE_LIMIT=2, STAGE_TRANSCRIBE_TIMEOUT=30, STAGE_TRANSCRIBE_POOL=thread,
+    # STAGE_TRANSCRIBE_THREADS=4, STAGE_TRANSCRIBE_CORES=0-3
+    prefix = f"STAGE_{name.upper()}_"
+    timeout = os.environ.get(prefix + "TIMEOUT", timeout)
+    return StageConfig(
+        limit=int(os.environ.get(prefix + "LIMIT", limit)),
+        timeout=float(timeout) if timeout not in (None, "", "0") else None,
+        pool=os.environ.get(prefix + "POOL", pool),
+        budget=budget_from_env(name),
+    )
+
+
+def server_stage_configs():
+    # Stages the server (and src.benchmark_threads) dispatches blocking work to, with their default
+    # limits and timeouts
+    return {
+        "decode": stage_config_from_env("decode", limit=4, timeout=30),
+        "features": stage_config_from_env("features", limit=4, timeout=60),
+        "transcribe": stage_config_from_env("transcribe", limit=1, timeout=120),
+        "embedding": stage_config_from_env("embedding", limit=2, timeout=30),
+        "deepfake_model": stage_config_from_env("deepfake_model", limit=2, timeout=60),
+        "firestore": stage_config_from_env("firestore", limit=8, timeout=10),
+        # Building the speaker index scans the whole voiceEmbeddings collection, once per worker
+        "speaker_index": stage_config_from_env("speaker_index", limit=1, timeout=300),
+    }
+
+
+class StageExecutor:
+    # Runs blocking pipeline stages (decode, feature extraction, model calls, Firestore)
+    # off the asyncio event loop, with a concurrency limit and timeout per stage. A stage with a
+    # thread budget gets its own threads, sized to its limit, so they are pinned and sized once and
+    # OpenMP teams they start never serve another stage; the rest share one pool
+
+    def __init__(self, stages, thread_workers=None, process_workers=0):
+        self.stages = dict(stages)
+        self.thread_workers = thread_workers or os.cpu_count() or 4
+        self.process_workers = process_workers
+        self._threads = ThreadPoolExecutor(max_workers=self.thread_workers, thread_name_prefix="stage")
+        self._stage_threads = {}
+        self._processes = None
+        self._semaphores = {}
+        self._in_use = {stage: 0 for stage in self.stages}
+
+    def _executor(self, stage, config):
+        if config.pool != "process" or self.process_workers <= 0:
+            if config.budget is None:
+                return self._threads
+            if stage not in self._stage_threads:
+                self._stage_threads[stage] = ThreadPoolExecutor(
+                    max_workers=max(1, config.limit), thread_name_prefix=f"stage-{stage}"
+                )
+            return self._stage_threads[stage]
+        if self._processes is None:
+            # spawn so children don't inherit torch thread state or loaded models
+            self._processes = ProcessPoolExecutor(
+                max_workers=self.process_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._processes
+
+    def _semaphore(self, stage, config):
+        # Semaphores are created on first use so they bind to the serving event loop
+        if stage not in self._semaphores:
+            self._semaphores[stage] = asyncio.Semaphore(config.limit)
+        return self._semaphores[stage]
+
+    async def run(self, stage, fn, *args):
+        config = self.stages.get(stage) or StageConfig()
+        semaphore = self._semaphore(stage, config)
+        queued = time.perf_counter()
+        await semaphore.acquire()
+        started = time.perf_counter()
+        STAGE_QUEUE_SECONDS.observe(started - queued, stage)
+        self._in_use[stage] = self._in_use.get(stage, 0) + 1
+        STAGE_IN_FLIGHT.inc(stage)
+
+        def release(_=None):
+            self._in_use[stage] -= 1
+            STAGE_IN_FLIGHT.dec(stage)
+            STAGE_RUN_SECONDS.observe(time.perf_counter() - started, stage)
+            semaphore.release()
+
+        try:
+            # Also without a budget: apply_budget then sets the process default explicitly (see there)
+            future = asyncio.get_running_loop().run_in_executor(self._executor(stage, config), run_with_budget, config.budget, fn, *args)
+        except BaseException:
+            release()
+            raise
+
+        # Work already running in a thread can't be cancelled, so the slot is only freed once it
+        # really finishes; this keeps the concurrency limit honest even after a timeout
+        future.add_done_callback(release)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=config.timeout)
+        except asyncio.TimeoutError:
+            STAGE_TIMEOUTS.inc(stage)
+            raise StageTimeout(f"Stage '{stage}' timed out after {config.timeout}s")
+
+    def stats(self):
+        return {
+            stage: {
+                "limit": config.limit,
+                "timeout": config.timeout,
+                "pool": config.pool,
+                "threads": config.budget.threads if config.budget else None,
+                "cores": list(config.budget.cores) if config.budget and config.budget.cores else None,
+                "in_use": self._in_use.get(stage, 0),
+            }
+            for stage, config in self.stages.items()
+        }
+
+    def shutdown(self):
+        self._threads.shutdown(wait=False)
+        for executor in self._stage_threads.values():
+            executor.shutdown(wait=False)
+        if self._processes is not None:
+            self._processes.shutdown(wait=False)